@@ -0,0 +1,262 @@
+"""Tracks changes to access control data
+
+Any ORM commit that touches members, roles, permissions, or the links
+between them bumps the version number in the 'acl_version' table, in the same
+transaction. Clients can hold on to a version and know that nothing has
+changed as long as it stays the same.
+
+After the commit, each function registered with add_listener() is called
+with an ACLChange. It says which tags changed, or that everything should be
+considered changed when that can't be narrowed down (such as a change to a
+role's permissions).
+
+Commits made by other processes arrive through Doorbot.InvalidationBus, and
+listeners get an ACLChange for those too. When the bus can't say what
+changed, the change has 'everything' set and no version.
+
+The changed tags are also written to the 'acl_changes' table under the new
+version, so any process can find out what changed since a given version.
+Only the last 'acl_changes.history_versions' versions are kept.
+"""
+import itertools
+import Doorbot.Config
+import Doorbot.InvalidationBus
+from collections import namedtuple
+from Doorbot.SQLAlchemy import Member
+from Doorbot.SQLAlchemy import Permission
+from Doorbot.SQLAlchemy import Role
+from Doorbot.SQLAlchemy import acl_changes_table
+from Doorbot.SQLAlchemy import acl_version_table
+from sqlalchemy import delete
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy import insert
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+
+ACLChange = namedtuple( 'ACLChange', [
+    'version',
+    'tags',
+    'everything',
+])
+"""Describes a committed change to access control data"""
+
+DEFAULT_HISTORY_VERSIONS = 1000
+BUS_TOPIC = "acl"
+
+LISTENERS = []
+
+# Member attributes that go into access decisions. Changing anything else,
+# like a password, doesn't count as an ACL change.
+MEMBER_ACL_ATTRS = (
+    "rfid",
+    "active",
+    "full_name",
+    "roles",
+)
+
+
+def add_listener( func ):
+    """Call func with an ACLChange after each commit that changes ACL data"""
+    LISTENERS.append( func )
+    return func
+
+def notify_listeners( change ):
+    """Call every listener with an ACLChange"""
+    for func in LISTENERS:
+        func( change )
+
+def current_version( session ):
+    """Fetch the current ACL version"""
+    version = session.scalar(
+        select( acl_version_table.c.version ).where(
+            acl_version_table.c.id == 1
+        )
+    )
+    return version if version is not None else 0
+
+def bump_version( session ):
+    """Increment the ACL version in the session's transaction
+
+    Returns the new version.
+    """
+    result = session.execute(
+        update( acl_version_table ).where(
+            acl_version_table.c.id == 1
+        ).values(
+            version = acl_version_table.c.version + 1
+        )
+    )
+    if result.rowcount == 0:
+        session.execute(
+            insert( acl_version_table ).values( id = 1, version = 1 )
+        )
+    return current_version( session )
+
+def record_changes( session, version, tags, everything ):
+    """Write what changed in the given version to the change history
+
+    Versions that have fallen out of the history are removed.
+    """
+    rows = [ { "version": version, "rfid": tag } for tag in sorted( tags ) ]
+    if everything:
+        rows.append({ "version": version, "rfid": None })
+    if rows:
+        session.execute( insert( acl_changes_table ), rows )
+
+    conf = Doorbot.Config.get( 'acl_changes', {} )
+    history = conf.get( 'history_versions', DEFAULT_HISTORY_VERSIONS )
+    session.execute(
+        delete( acl_changes_table ).where(
+            acl_changes_table.c.version <= version - history
+        )
+    )
+
+def changes_since( session, since ):
+    """Everything that changed after the given version
+
+    Returns an ACLChange for the current version. If the history doesn't go
+    back far enough to tell which tags changed, 'everything' is set.
+    """
+    version = current_version( session )
+    if since == version:
+        return ACLChange( version = version, tags = frozenset(),
+            everything = False )
+    if since > version:
+        # The client has a version we never gave out, like from before the
+        # database was restored
+        return ACLChange( version = version, tags = frozenset(),
+            everything = True )
+
+    rows = session.execute(
+        select(
+            acl_changes_table.c.version,
+            acl_changes_table.c.rfid,
+        ).where(
+            acl_changes_table.c.version > since
+        )
+    ).all()
+
+    versions = { row.version for row in rows }
+    # Every version after the client's needs to be there, or some changes
+    # were lost
+    everything = len( versions ) < version - since \
+        or any( row.rfid is None for row in rows )
+    tags = frozenset( row.rfid for row in rows if row.rfid is not None )
+    return ACLChange( version = version, tags = tags, everything = everything )
+
+
+#
+# Watch the ORM for changes
+#
+def _pending_changes( session ):
+    return session.info.setdefault( 'acl_changes', {
+        "tags": set(),
+        "everything": False,
+    })
+
+def _has_acl_changes( member ):
+    attrs = inspect( member ).attrs
+    return any(
+        getattr( attrs, key ).history.has_changes()
+        for key in MEMBER_ACL_ATTRS
+    )
+
+def _changed_tags( member ):
+    history = inspect( member ).attrs.rfid.history
+    return [ tag for tag in history.sum() if tag is not None ]
+
+@event.listens_for( Session, "after_flush" )
+def _track_flush( session, flush_context ):
+    for obj in itertools.chain( session.new, session.dirty, session.deleted ):
+        if isinstance( obj, Member ):
+            if obj in session.dirty and not _has_acl_changes( obj ):
+                continue
+
+            changes = _pending_changes( session )
+            tags = _changed_tags( obj )
+            if tags:
+                changes[ "tags" ].update( tags )
+            else:
+                # Can't tell which tag it had, so play it safe
+                changes[ "everything" ] = True
+        elif isinstance( obj, Role ):
+            # A change to only the members of a role shows up on the
+            # members themselves
+            state = inspect( obj )
+            only_members_changed = obj in session.dirty and not any(
+                attr.history.has_changes()
+                for attr in state.attrs
+                if attr.key != "members"
+            )
+            if not only_members_changed:
+                _pending_changes( session )[ "everything" ] = True
+        elif isinstance( obj, Permission ):
+            _pending_changes( session )[ "everything" ] = True
+
+@event.listens_for( Session, "do_orm_execute" )
+def _track_bulk_execute( orm_execute_state ):
+    if not ( orm_execute_state.is_update or orm_execute_state.is_delete ):
+        return
+
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None and mapper.class_ in ( Member, Role, Permission ):
+        _pending_changes( orm_execute_state.session )[ "everything" ] = True
+
+@event.listens_for( Session, "before_commit" )
+def _bump_version( session ):
+    # Changes still waiting to be flushed need to be seen now, so the version
+    # is bumped in the same transaction
+    session.flush()
+
+    changes = session.info.get( 'acl_changes' )
+    if changes is not None:
+        changes[ "version" ] = bump_version( session )
+        record_changes(
+            session,
+            changes[ "version" ],
+            changes[ "tags" ],
+            changes[ "everything" ],
+        )
+        Doorbot.InvalidationBus.publish( session, BUS_TOPIC, {
+            "version": changes[ "version" ],
+            "tags": sorted( changes[ "tags" ] ),
+            "everything": changes[ "everything" ],
+        })
+
+@event.listens_for( Session, "after_commit" )
+def _notify_listeners( session ):
+    changes = session.info.pop( 'acl_changes', None )
+    if changes is None:
+        return
+
+    change = ACLChange(
+        version = changes.get( "version" ),
+        tags = frozenset( changes[ "tags" ] ),
+        everything = changes[ "everything" ],
+    )
+    notify_listeners( change )
+
+@event.listens_for( Session, "after_rollback" )
+def _discard_changes( session ):
+    session.info.pop( 'acl_changes', None )
+
+
+#
+# Hear about commits made by other processes
+#
+def _apply_remote_change( data ):
+    if data is None:
+        change = ACLChange( version = None, tags = frozenset(),
+            everything = True )
+    else:
+        change = ACLChange(
+            version = data[ "version" ],
+            tags = frozenset( data[ "tags" ] ),
+            everything = data[ "everything" ],
+        )
+    notify_listeners( change )
+
+Doorbot.InvalidationBus.add_listener( BUS_TOPIC, _apply_remote_change )
@@ -0,0 +1,273 @@
+"""Compact formats for exporting the tags that have a permission
+
+Doorbots can ask for these instead of JSON with the Accept header. Tags are
+kept as the UTF-8 bytes of the tag string, exactly as stored, so "0009876"
+and "9876" stay different tags. All numbers are big-endian.
+
+Packed tags ('application/vnd.doorbot.tags'), a 20 byte header:
+
+    4 bytes   magic, b"DBTG"
+    1 byte    format version, currently 2
+    1 byte    width of each tag in bytes, w, the length of the longest tag
+    2 bytes   reserved, zero
+    8 bytes   ACL version
+    4 bytes   number of tags
+
+followed by the tags, each padded with NUL bytes to w bytes, sorted by
+their bytes and unique, so a client can pad the tag it read the same way
+and binary search them in place.
+
+Bloom filter ('application/vnd.doorbot.bloom'), a 24 byte header:
+
+    4 bytes   magic, b"DBBF"
+    1 byte    format version, currently 2
+    1 byte    number of hash functions, k
+    2 bytes   reserved, zero
+    8 bytes   ACL version
+    4 bytes   number of tags
+    4 bytes   number of bits in the filter, m
+
+followed by the m bits, rounded up to whole bytes. Bit n is
+'byte[ n // 8 ] & ( 1 << ( n % 8 ) )'. To check a tag, take the SHA-256 of
+its UTF-8 bytes, without any padding, read h1 from the first 8 bytes of the
+digest and h2 from the next 8 with its lowest bit set. The tag may be in the
+set if every bit '( h1 + i * h2 ) % m' for i from 0 to k - 1 is set.
+
+A tag longer than 255 bytes, or with a NUL in it, can't be encoded.
+export_tags() raises UnexportableTags rather than leave it out, and the API
+answers with JSON instead.
+
+Built payloads are cached per permission and format until the ACL version
+changes.
+"""
+import collections
+import hashlib
+import math
+import struct
+import threading
+import Doorbot.Config
+from Doorbot.SQLAlchemy import Permission
+from Doorbot.SQLAlchemy import get_engine
+
+
+PACKED_MIMETYPE = 'application/vnd.doorbot.tags'
+BLOOM_MIMETYPE = 'application/vnd.doorbot.bloom'
+
+PACKED_MAGIC = b"DBTG"
+BLOOM_MAGIC = b"DBBF"
+FORMAT_VERSION = 2
+MAX_TAG_WIDTH = 255
+
+PACKED_HEADER = struct.Struct( ">4sBBHQI" )
+BLOOM_HEADER = struct.Struct( ">4sBBHQII" )
+
+DEFAULT_BLOOM_FP_RATE = 0.01
+MIN_BLOOM_FP_RATE = 0.000001
+MAX_BLOOM_FP_RATE = 0.5
+DEFAULT_CACHE_MAX_SIZE = 64
+STREAM_BATCH_SIZE = 500
+
+__CACHE = None
+
+
+class UnexportableTags( ValueError ):
+    """Raised when a tag can't be encoded in the compact formats"""
+    pass
+
+
+def tag_key( tag ):
+    """Bytes a tag is encoded as"""
+    key = tag.encode( 'utf-8' )
+    if len( key ) > MAX_TAG_WIDTH or b"\x00" in key:
+        raise UnexportableTags( "Tag can't be exported: " + repr( tag ) )
+    return key
+
+def tag_keys( tags ):
+    """Sorted, unique keys for the tags
+
+    Raises UnexportableTags if any of them can't be encoded.
+    """
+    return sorted({ tag_key( tag ) for tag in tags })
+
+def encode_packed( tags, acl_version ):
+    """Encode tags as a sorted array of fixed width keys"""
+    keys = tag_keys( tags )
+    width = max( ( len( key ) for key in keys ), default = 1 )
+    header = PACKED_HEADER.pack(
+        PACKED_MAGIC,
+        FORMAT_VERSION,
+        width,
+        0,
+        acl_version,
+        len( keys ),
+    )
+    body = b"".join( key.ljust( width, b"\x00" ) for key in keys )
+    return header + body
+
+def decode_packed( payload ):
+    """Returns the ACL version and the list of tags"""
+    magic, fmt_version, width, _, acl_version, count = \
+        PACKED_HEADER.unpack_from( payload )
+    if magic != PACKED_MAGIC or fmt_version != FORMAT_VERSION:
+        raise ValueError( "Not a packed tag list" )
+
+    offset = PACKED_HEADER.size
+    return acl_version, [
+        payload[ start : start + width ].rstrip( b"\x00" ).decode( 'utf-8' )
+        for start in range( offset, offset + count * width, width )
+    ]
+
+def bloom_size( count, fp_rate ):
+    """Number of bits and hash functions for a Bloom filter
+
+    Returns a tuple of ( bits, hashes ) that gives about the given false
+    positive rate with count entries.
+    """
+    count = max( count, 1 )
+    bits = math.ceil( -count * math.log( fp_rate ) / ( math.log( 2 ) ** 2 ) )
+    bits = max( bits, 8 )
+    hashes = round( bits / count * math.log( 2 ) )
+    return bits, min( max( hashes, 1 ), 255 )
+
+def _bloom_bits( key, bits, hashes ):
+    digest = hashlib.sha256( key ).digest()
+    h1 = int.from_bytes( digest[0:8], 'big' )
+    h2 = int.from_bytes( digest[8:16], 'big' ) | 1
+    return [ ( h1 + i * h2 ) % bits for i in range( hashes ) ]
+
+def encode_bloom( tags, acl_version, fp_rate = DEFAULT_BLOOM_FP_RATE ):
+    """Encode tags as a Bloom filter with about the given false positive rate"""
+    keys = tag_keys( tags )
+    bits, hashes = bloom_size( len( keys ), fp_rate )
+
+    bit_array = bytearray( ( bits + 7 ) // 8 )
+    for key in keys:
+        for bit in _bloom_bits( key, bits, hashes ):
+            bit_array[ bit // 8 ] |= 1 << ( bit % 8 )
+
+    header = BLOOM_HEADER.pack(
+        BLOOM_MAGIC,
+        FORMAT_VERSION,
+        hashes,
+        0,
+        acl_version,
+        len( keys ),
+        bits,
+    )
+    return header + bytes( bit_array )
+
+def bloom_contains( payload, tag ):
+    """Returns true if the tag may be in the encoded Bloom filter"""
+    magic, fmt_version, hashes, _, _, _, bits = \
+        BLOOM_HEADER.unpack_from( payload )
+    if magic != BLOOM_MAGIC or fmt_version != FORMAT_VERSION:
+        raise ValueError( "Not a Bloom filter" )
+
+    offset = BLOOM_HEADER.size
+    return all(
+        payload[ offset + bit // 8 ] & ( 1 << ( bit % 8 ) )
+        for bit in _bloom_bits( tag.encode( 'utf-8' ), bits, hashes )
+    )
+
+
+class ExportCache:
+    """Encoded payloads, kept until the ACL version changes"""
+
+    def __init__(
+        self,
+        max_size = DEFAULT_CACHE_MAX_SIZE,
+    ):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._engine = None
+        self._entries = collections.OrderedDict()
+
+    def get( self, key, acl_version ):
+        """Returns the cached payload, or None if missing or out of date"""
+        engine = get_engine()
+        with self._lock:
+            if self._engine is not engine:
+                # Versions from one database mean nothing in another
+                self._entries.clear()
+                self._engine = engine
+
+            entry = self._entries.get( key )
+            if entry is None:
+                return None
+
+            version, payload = entry
+            if version != acl_version:
+                del self._entries[ key ]
+                return None
+
+            self._entries.move_to_end( key )
+            return payload
+
+    def set( self, key, acl_version, payload ):
+        with self._lock:
+            self._entries[ key ] = ( acl_version, payload )
+            self._entries.move_to_end( key )
+            while len( self._entries ) > self.max_size:
+                self._entries.popitem( last = False )
+
+    def clear( self ):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__( self ):
+        return len( self._entries )
+
+
+def _conf():
+    return Doorbot.Config.get( 'acl_export', {} )
+
+def default_fp_rate():
+    """Bloom filter false positive rate to use when the client doesn't ask"""
+    return _conf().get( 'bloom_fp_rate', DEFAULT_BLOOM_FP_RATE )
+
+def get_cache():
+    """Get the export cache for this process"""
+    global __CACHE
+
+    if __CACHE is None:
+        __CACHE = ExportCache(
+            max_size = _conf().get( 'cache_max_size', DEFAULT_CACHE_MAX_SIZE ),
+        )
+
+    return __CACHE
+
+def export_tags( permission, mimetype, acl_version, session, fp_rate = None ):
+    """Encoded tags that have the permission, in the given format
+
+    The mimetype is either PACKED_MIMETYPE or BLOOM_MIMETYPE. Results are
+    cached until the ACL version changes. Raises UnexportableTags if any of
+    the tags can't be encoded.
+    """
+    if mimetype == BLOOM_MIMETYPE:
+        if fp_rate is None:
+            fp_rate = default_fp_rate()
+        key = ( permission, mimetype, fp_rate )
+    elif mimetype == PACKED_MIMETYPE:
+        key = ( permission, mimetype )
+    else:
+        raise ValueError( "Unknown export format: " + mimetype )
+
+    cache = get_cache()
+    payload = cache.get( key, acl_version )
+    if payload is not None:
+        return payload
+
+    tags = session.scalars(
+        Permission.tags_with_permission_stmt( permission ),
+        execution_options = {
+            "stream_results": True,
+            "yield_per": STREAM_BATCH_SIZE,
+        },
+    )
+    if mimetype == BLOOM_MIMETYPE:
+        payload = encode_bloom( tags, acl_version, fp_rate )
+    else:
+        payload = encode_packed( tags, acl_version )
+
+    cache.set( key, acl_version, payload )
+    return payload
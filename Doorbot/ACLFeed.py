@@ -0,0 +1,145 @@
+"""Lets requests wait for the next ACL change
+
+Used by the long-poll /v1/acl_changes endpoint. Commits made by this process
+wake up waiting requests right away. Commits made by other processes are
+found by checking the ACL version in the database, which is done at most
+once every 'acl_changes.poll_interval_seconds' no matter how many requests
+are waiting.
+
+A waiting request holds a worker thread (or a greenlet, under the gevent
+uwsgi profile), but no database connection. At most 'acl_changes.max_waiters'
+requests wait at once in each process, so long polls can't starve the
+workers of threads for ordinary requests.
+"""
+import threading
+import time
+import Doorbot.ACL
+import Doorbot.Config
+from Doorbot.SQLAlchemy import get_engine
+from Doorbot.SQLAlchemy import get_session
+
+
+DEFAULT_POLL_INTERVAL_SECONDS = 1.0
+DEFAULT_MAX_WAITERS = 2
+DEFAULT_TIMEOUT_SECONDS = 25
+DEFAULT_MAX_TIMEOUT_SECONDS = 55
+
+__FEED = None
+
+
+class TooManyWaiters( Exception ):
+    """Raised when a request can't wait because others already are"""
+    pass
+
+
+class ACLFeed:
+    """Tracks the latest ACL version and wakes up anyone waiting on it"""
+
+    def __init__(
+        self,
+        poll_interval_seconds = DEFAULT_POLL_INTERVAL_SECONDS,
+        max_waiters = DEFAULT_MAX_WAITERS,
+    ):
+        self.poll_interval_seconds = poll_interval_seconds
+        self.max_waiters = max_waiters
+        self._cond = threading.Condition()
+        self._engine = None
+        self._version = None
+        self._polled_at = 0
+        self._waiters = 0
+
+    def latest_version( self ):
+        """The newest ACL version known to this process"""
+        engine = get_engine()
+        with self._cond:
+            age = time.monotonic() - self._polled_at
+            if self._engine is engine and self._version is not None \
+                and age < self.poll_interval_seconds:
+                return self._version
+
+            # Claim this poll, so everyone else keeps using what we have
+            is_new_engine = self._engine is not engine
+            self._engine = engine
+            self._polled_at = time.monotonic()
+
+        session = get_session()
+        try:
+            version = Doorbot.ACL.current_version( session )
+        finally:
+            session.close()
+
+        with self._cond:
+            if self._engine is engine and ( is_new_engine
+                or self._version is None or version > self._version ):
+                self._version = version
+                self._cond.notify_all()
+            return self._version
+
+    def notify( self, version ):
+        """Wake up waiting requests, since the version changed"""
+        with self._cond:
+            if self._version is None or version > self._version:
+                self._version = version
+            self._cond.notify_all()
+
+    def wait_for_change( self, since, timeout_seconds ):
+        """Wait until the ACL version is something other than 'since'
+
+        Returns the latest version, which is still 'since' if the timeout
+        ran out first. Raises TooManyWaiters if the version hasn't changed
+        and too many requests are already waiting.
+        """
+        version = self.latest_version()
+        if version != since or timeout_seconds <= 0:
+            return version
+
+        with self._cond:
+            if self._waiters >= self.max_waiters:
+                raise TooManyWaiters()
+            self._waiters += 1
+
+        try:
+            deadline = time.monotonic() + timeout_seconds
+            while version == since:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                with self._cond:
+                    if self._version == since:
+                        self._cond.wait(
+                            min( remaining, self.poll_interval_seconds )
+                        )
+                version = self.latest_version()
+        finally:
+            with self._cond:
+                self._waiters -= 1
+
+        return version
+
+
+def get_conf():
+    """Settings for the acl_changes endpoint"""
+    return Doorbot.Config.get( 'acl_changes', {} )
+
+def get_feed():
+    """Get the ACL feed for this process"""
+    global __FEED
+
+    if __FEED is None:
+        conf = get_conf()
+        __FEED = ACLFeed(
+            poll_interval_seconds = conf.get(
+                'poll_interval_seconds',
+                DEFAULT_POLL_INTERVAL_SECONDS,
+            ),
+            max_waiters = conf.get( 'max_waiters', DEFAULT_MAX_WAITERS ),
+        )
+
+    return __FEED
+
+
+@Doorbot.ACL.add_listener
+def _notify_waiters( change ):
+    if __FEED is not None and change.version is not None:
+        __FEED.notify( change.version )
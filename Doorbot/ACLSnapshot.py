@@ -0,0 +1,466 @@
+"""Access decisions from a memory-mapped snapshot file
+
+compile_snapshot() writes every tag's access details to a file, which each
+worker maps into memory. The pages are shared, so there's one copy of the ACL
+no matter how many workers there are, and a new worker can answer from it
+without loading anything. A new file is written next to the old one and
+renamed over it, so readers always see a whole file. Workers notice the new
+file within 'acl_snapshot.check_interval_seconds'.
+
+The file is laid out as:
+
+    header          magic, ACL version, tag count, permission count,
+                    key width, bitmap bytes, permission table size
+    permissions     each name as a 2 byte length and UTF-8, sorted
+    records         one per tag, sorted by tag:
+                        tag, NUL padded to the key width
+                        flags (active, has a name)
+                        offset and length of the full name
+                        bitmap of permissions, in the order above
+    names           UTF-8 full names
+
+All numbers are little endian. Lookups binary search the records in place.
+
+The file is only as current as the ACL version it was compiled from. Tags
+changed since then (see Doorbot.ACL) are looked up the usual way until a
+newer file shows up, and so is everything if the database has moved past
+the file's version when it's opened. A file that couldn't be checked against
+the database is checked again on the next interval, and isn't trusted until
+then. If the database can't be reached, the file is used anyway, since an
+old answer beats none while the door is waiting.
+
+Only the tag lookup falls back to the file. Requests still have to be
+authenticated, and log_entry still has to find its location. Those come from
+Doorbot.AuthCache and Doorbot.LocationRegistry when they're cached, but a
+request that misses either one during an outage fails before it gets here.
+
+refresh() writes a new file if the ACL version has changed. app.py runs it
+every minute under uwsgi, and compile_acl_snapshot.py runs it from cron.
+"""
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import Doorbot.ACL
+import Doorbot.AccessIndex
+import Doorbot.Config
+from Doorbot.AccessIndex import AccessEntry
+from Doorbot.SQLAlchemy import Permission
+from Doorbot.SQLAlchemy import get_session
+from sqlalchemy import select
+
+
+DEFAULT_PATH = "/var/tmp/doorbot-acl.snapshot"
+DEFAULT_CHECK_INTERVAL_SECONDS = 5
+
+MAGIC = b"DBACL\x00\x00\x01"
+HEADER = struct.Struct( "<8sQIIIII" )
+PERMISSION_NAME = struct.Struct( "<H" )
+RECORD = struct.Struct( "<BII" )
+
+FLAG_ACTIVE = 0x01
+FLAG_HAS_NAME = 0x02
+
+LOGGER = logging.getLogger( __name__ )
+
+__SNAPSHOTS = None
+
+
+class BadSnapshot( Exception ):
+    """Raised when a snapshot file can't be read"""
+    pass
+
+
+def _encode( version, entries, permission_names ):
+    permissions = sorted( permission_names )
+    bits = { name: i for i, name in enumerate( permissions ) }
+    bitmap_bytes = ( len( permissions ) + 7 ) // 8
+
+    permission_table = b"".join(
+        PERMISSION_NAME.pack( len( encoded ) ) + encoded
+        for encoded in ( name.encode( 'utf-8' ) for name in permissions )
+    )
+
+    keys = sorted(
+        ( tag.encode( 'utf-8' ), entry ) for tag, entry in entries.items()
+    )
+    key_width = max( ( len( key ) for key, _ in keys ), default = 1 )
+
+    records = []
+    names = []
+    names_size = 0
+    for key, entry in keys:
+        flags = FLAG_ACTIVE if entry.active else 0
+        name = b""
+        if entry.full_name is not None:
+            flags |= FLAG_HAS_NAME
+            name = entry.full_name.encode( 'utf-8' )
+
+        bitmap = bytearray( bitmap_bytes )
+        for permission in entry.permissions:
+            bit = bits[ permission ]
+            bitmap[ bit // 8 ] |= 1 << ( bit % 8 )
+
+        records.append( key.ljust( key_width, b"\x00" ) )
+        records.append( RECORD.pack( flags, names_size, len( name ) ) )
+        records.append( bytes( bitmap ) )
+        names.append( name )
+        names_size += len( name )
+
+    header = HEADER.pack(
+        MAGIC,
+        version,
+        len( keys ),
+        len( permissions ),
+        key_width,
+        bitmap_bytes,
+        len( permission_table ),
+    )
+    return b"".join([ header, permission_table, *records, *names ])
+
+def write( path, version, entries, permission_names ):
+    """Write a snapshot file, replacing any that's there
+
+    Takes a dict of tag to AccessEntry, and the names of all permissions.
+    """
+    data = _encode( version, entries, permission_names )
+    directory = os.path.dirname( os.path.abspath( path ) )
+    os.makedirs( directory, exist_ok = True )
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir = directory,
+        prefix = os.path.basename( path ) + ".",
+    )
+    try:
+        with os.fdopen( fd, "wb" ) as f:
+            f.write( data )
+            f.flush()
+            os.fsync( f.fileno() )
+        os.chmod( tmp_path, 0o644 )
+        os.replace( tmp_path, path )
+    except BaseException:
+        os.unlink( tmp_path )
+        raise
+
+def file_version( path ):
+    """ACL version of the snapshot file, or None if there's no good file"""
+    try:
+        with open( path, "rb" ) as f:
+            header = f.read( HEADER.size )
+    except FileNotFoundError:
+        return None
+
+    if len( header ) < HEADER.size or header[ :len( MAGIC ) ] != MAGIC:
+        return None
+    return HEADER.unpack( header )[1]
+
+
+class Snapshot:
+    """A snapshot file, mapped into memory"""
+
+    def __init__( self, path ):
+        with open( path, "rb" ) as f:
+            self.stat = os.fstat( f.fileno() )
+            if self.stat.st_size < HEADER.size:
+                raise BadSnapshot( path + " is too short" )
+            # The mapping stays valid after the file is closed or renamed over
+            self._mmap = mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ )
+
+        (
+            magic,
+            self.version,
+            self._tag_count,
+            permission_count,
+            self._key_width,
+            self._bitmap_bytes,
+            permission_table_size,
+        ) = HEADER.unpack_from( self._mmap )
+        if magic != MAGIC:
+            raise BadSnapshot( path + " is not an ACL snapshot" )
+
+        self._record_size = self._key_width + RECORD.size + self._bitmap_bytes
+        self._records_offset = HEADER.size + permission_table_size
+        self._names_offset = self._records_offset \
+            + self._tag_count * self._record_size
+        if self.stat.st_size < self._names_offset:
+            raise BadSnapshot( path + " is cut short" )
+
+        self._permissions = []
+        offset = HEADER.size
+        for _ in range( permission_count ):
+            ( length, ) = PERMISSION_NAME.unpack_from( self._mmap, offset )
+            offset += PERMISSION_NAME.size
+            self._permissions.append(
+                self._mmap[ offset : offset + length ].decode( 'utf-8' ) )
+            offset += length
+        self._bits = {
+            name: i for i, name in enumerate( self._permissions )
+        }
+
+    def __len__( self ):
+        return self._tag_count
+
+    def _find( self, tag ):
+        """Offset of the tag's record, or None if it isn't there"""
+        key = tag.encode( 'utf-8' )
+        if len( key ) > self._key_width:
+            return None
+        key = key.ljust( self._key_width, b"\x00" )
+
+        low = 0
+        high = self._tag_count
+        while low < high:
+            middle = ( low + high ) // 2
+            offset = self._records_offset + middle * self._record_size
+            found = self._mmap[ offset : offset + self._key_width ]
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return offset
+        return None
+
+    def _has_bit( self, offset, bit ):
+        byte = self._mmap[
+            offset + self._key_width + RECORD.size + bit // 8 ]
+        return bool( byte & ( 1 << ( bit % 8 ) ) )
+
+    def lookup( self, tag ):
+        """Returns the AccessEntry for the tag, or None if it isn't found"""
+        offset = self._find( tag )
+        if offset is None:
+            return None
+
+        flags, name_offset, name_length = RECORD.unpack_from(
+            self._mmap, offset + self._key_width )
+        full_name = None
+        if flags & FLAG_HAS_NAME:
+            start = self._names_offset + name_offset
+            full_name = self._mmap[ start : start + name_length ] \
+                .decode( 'utf-8' )
+
+        return AccessEntry(
+            active = bool( flags & FLAG_ACTIVE ),
+            full_name = full_name,
+            permissions = frozenset(
+                name for bit, name in enumerate( self._permissions )
+                if self._has_bit( offset, bit )
+            ),
+        )
+
+    def is_known_permission( self, permission ):
+        """Returns true if a permission by that name exists"""
+        return permission in self._bits
+
+    def has_permission( self, tag, permission ):
+        """Returns true if the tag is active and has the named permission"""
+        bit = self._bits.get( permission )
+        if bit is None:
+            return False
+
+        offset = self._find( tag )
+        if offset is None:
+            return False
+        flags = self._mmap[ offset + self._key_width ]
+        return bool( flags & FLAG_ACTIVE ) and self._has_bit( offset, bit )
+
+
+class SnapshotCache:
+    """Keeps the newest snapshot file open, and knows what it's missing"""
+
+    def __init__(
+        self,
+        path = DEFAULT_PATH,
+        check_interval_seconds = DEFAULT_CHECK_INTERVAL_SECONDS,
+    ):
+        self.path = path
+        self.check_interval_seconds = check_interval_seconds
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._checked_at = None
+        # Versions needed before the snapshot can be trusted again, for
+        # each changed tag and for everything
+        self._needed_tags = {}
+        self._needed_all = 0
+        # Whether the snapshot has been checked against the database
+        self._is_verified = False
+
+    def get( self ):
+        """The newest snapshot, or None if there's no good file"""
+        now = time.monotonic()
+        checked_at = self._checked_at
+        if checked_at is not None \
+            and now - checked_at < self.check_interval_seconds:
+            return self._snapshot
+
+        with self._lock:
+            if self._checked_at != checked_at:
+                # Another thread just checked
+                return self._snapshot
+            self._checked_at = now
+
+            try:
+                stat = os.stat( self.path )
+            except FileNotFoundError:
+                self._snapshot = None
+                return None
+
+            snapshot = self._snapshot
+            is_same_file = snapshot is not None \
+                and snapshot.stat.st_ino == stat.st_ino \
+                and snapshot.stat.st_mtime_ns == stat.st_mtime_ns
+            if is_same_file and self._is_verified:
+                return snapshot
+
+        if not is_same_file:
+            try:
+                snapshot = Snapshot( self.path )
+            except ( BadSnapshot, OSError, struct.error ) as e:
+                LOGGER.warning( "Can't read ACL snapshot: %s", e )
+                with self._lock:
+                    self._snapshot = None
+                return None
+
+        # The file may be from long before this process started, so check it
+        # against the database before anyone decides from it. Until then,
+        # everyone keeps using the last one.
+        version = self._database_version()
+
+        with self._lock:
+            if version is None:
+                # Only good for when the database can't be reached. Try
+                # again next time.
+                self._is_verified = False
+            else:
+                self._is_verified = True
+                self._needed_all = max( self._needed_all, version )
+            self._snapshot = snapshot
+            self._needed_tags = {
+                tag: needed for tag, needed in self._needed_tags.items()
+                if needed > snapshot.version
+            }
+
+        return snapshot
+
+    def _database_version( self ):
+        session = get_session()
+        try:
+            return Doorbot.ACL.current_version( session )
+        except Exception as e:
+            LOGGER.warning( "Can't check ACL snapshot version: %s", e )
+            return None
+        finally:
+            session.close()
+
+    def current( self, tag ):
+        """The snapshot if it's up to date for the tag, otherwise None"""
+        snapshot = self.get()
+        if snapshot is None:
+            return None
+        if not self._is_verified \
+            or snapshot.version < self._needed_all \
+            or snapshot.version < self._needed_tags.get( tag, 0 ):
+            return None
+        return snapshot
+
+    def note_change( self, change ):
+        """Stop trusting the snapshot for what changed"""
+        with self._lock:
+            if change.version is not None:
+                needed = change.version
+            elif self._snapshot is not None:
+                # Don't know which version, just that it's after this one
+                needed = self._snapshot.version + 1
+            else:
+                return
+
+            if change.everything:
+                self._needed_all = max( self._needed_all, needed )
+            for tag in change.tags:
+                self._needed_tags[ tag ] = max(
+                    self._needed_tags.get( tag, 0 ), needed )
+
+
+def get_conf():
+    return Doorbot.Config.get( 'acl_snapshot', {} )
+
+def get_snapshots():
+    """Get the snapshot cache for this process
+
+    Returns None if snapshots are turned off with 'acl_snapshot.enabled'.
+    """
+    global __SNAPSHOTS
+
+    if __SNAPSHOTS is None:
+        conf = get_conf()
+        if not conf.get( 'enabled', False ):
+            return None
+        __SNAPSHOTS = SnapshotCache(
+            path = conf.get( 'path', DEFAULT_PATH ),
+            check_interval_seconds = conf.get(
+                'check_interval_seconds',
+                DEFAULT_CHECK_INTERVAL_SECONDS,
+            ),
+        )
+
+    return __SNAPSHOTS
+
+def current( tag ):
+    """The snapshot, if it's turned on and up to date for the tag"""
+    snapshots = get_snapshots()
+    return snapshots.current( tag ) if snapshots is not None else None
+
+def fallback():
+    """The snapshot, however old, for when the database can't be reached"""
+    snapshots = get_snapshots()
+    return snapshots.get() if snapshots is not None else None
+
+def compile_snapshot( path = None, session = None ):
+    """Write a snapshot of the ACL as it is in the database
+
+    Returns the ACL version written.
+    """
+    path = path or get_conf().get( 'path', DEFAULT_PATH )
+    is_own_session = session is None
+    if is_own_session:
+        session = get_session()
+    try:
+        # Read the version first. If it changes while we read the rest, the
+        # file is marked older than it is, and gets replaced on the next run.
+        version = Doorbot.ACL.current_version( session )
+        entries = Doorbot.AccessIndex.fetch_all_entries( session )
+        permission_names = session.scalars( select( Permission.name ) ).all()
+    finally:
+        if is_own_session:
+            session.close()
+
+    write( path, version, entries, permission_names )
+    return version
+
+def refresh():
+    """Compile a new snapshot if the ACL has changed since the last one
+
+    Returns true if a new one was written.
+    """
+    if get_snapshots() is None:
+        return False
+
+    path = get_conf().get( 'path', DEFAULT_PATH )
+    session = get_session()
+    try:
+        if file_version( path ) == Doorbot.ACL.current_version( session ):
+            return False
+        compile_snapshot( path, session )
+    finally:
+        session.close()
+    return True
+
+
+@Doorbot.ACL.add_listener
+def _note_change( change ):
+    if __SNAPSHOTS is not None:
+        __SNAPSHOTS.note_change( change )
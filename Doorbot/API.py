@@ -1,18 +1,33 @@
+import base64
+import csv
 import flask
+import io
 import os
 import re
+import Doorbot.ACL
+import Doorbot.ACLExport
+import Doorbot.ACLSnapshot
+import Doorbot.ACLFeed
+import Doorbot.AccessIndex
+import Doorbot.AuthCache
 import Doorbot.Config
+import Doorbot.EntryLogWriter
+import Doorbot.LocationRegistry
+import Doorbot.NameSearch
+import Doorbot.ResponseCache
+import Doorbot.ScanStats
 from Doorbot.SQLAlchemy import Location
 from Doorbot.SQLAlchemy import EntryLog
 from Doorbot.SQLAlchemy import Member
 from Doorbot.SQLAlchemy import Permission
 from Doorbot.SQLAlchemy import Role
-from Doorbot.SQLAlchemy import get_engine
 from Doorbot.SQLAlchemy import get_session
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from flask_httpauth import HTTPBasicAuth
 from sqlalchemy import select
 from sqlalchemy import delete
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import bindparam
 from sqlalchemy.sql import text
 
 MATCH_INT = re.compile( ''.join([
@@ -31,6 +46,27 @@ MATCH_NAME = re.compile( ''.join([
     '$',
 ]) )
 
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Rows fetched from the database, and written out, at a time when streaming
+STREAM_BATCH_SIZE = 500
+DEFAULT_SEARCH_MAX_LIMIT = 10000
+DEFAULT_SEARCH_MAX_NAME_TAGS = 500
+ENTRY_LOG_CSV_HEADER = [
+    "full_name",
+    "rfid",
+    "entry_time",
+    "was_allowed",
+    "was_found",
+    "location",
+]
+
+# Formats dump_tags_for_permission can answer with, JSON being the default
+DUMP_TAGS_MIMETYPES = [
+    'application/json',
+    Doorbot.ACLExport.PACKED_MIMETYPE,
+    Doorbot.ACLExport.BLOOM_MIMETYPE,
+]
+
 
 app = flask.Flask( "rfid_app",
     static_url_path = '',
@@ -38,6 +74,23 @@ app = flask.Flask( "rfid_app",
 )
 auth = HTTPBasicAuth()
 
+def get_request_session():
+    """Get the database session for the current request
+
+    Every call during a request gets the same session, so a request only
+    holds one connection at a time. The session is closed when the request
+    ends.
+    """
+    if 'db_session' not in flask.g:
+        flask.g.db_session = get_session()
+    return flask.g.db_session
+
+@app.teardown_appcontext
+def close_request_session( exception ):
+    session = flask.g.pop( 'db_session', None )
+    if session is not None:
+        session.close()
+
 def set_error(
     response,
     msg,
@@ -82,22 +135,39 @@ def get(
     instance = session.query( model ).filter_by( **kwargs ).first()
     return instance
 
-def search_scan_logs( tag, offset, limit):
+def encode_log_cursor( entry_time, entry_id ):
+    """Opaque cursor pointing just past the given entry log row"""
+    if isinstance( entry_time, datetime ):
+        entry_time = entry_time.isoformat( sep = ' ' )
+    data = flask.json.dumps([ entry_time, entry_id ]).encode( 'utf-8' )
+    return base64.urlsafe_b64encode( data ).decode( 'ascii' ).rstrip( '=' )
+
+def decode_log_cursor( cursor ):
+    """Returns the entry time and id in a cursor
+
+    Raises ValueError if the cursor isn't valid.
+    """
+    try:
+        padding = '=' * ( -len( cursor ) % 4 )
+        data = base64.urlsafe_b64decode( cursor + padding )
+        entry_time, entry_id = flask.json.loads( data )
+    except ( TypeError, ValueError ) as err:
+        raise ValueError( "Invalid cursor" ) from err
+
+    if not isinstance( entry_time, str ) or not isinstance( entry_id, int ):
+        raise ValueError( "Invalid cursor" )
+    return entry_time, entry_id
+
+def _scan_log_stmt( conditions, limit_clause = "" ):
     # People could scan an RFID that isn't in the system. We still want to 
     # log that, but it means we can't explicitly link the member and entry_log 
     # tables. This is a problem for SQLAlchemy, so don't bother, and use raw 
     # SQL.
-    sql_params = {
-        "offset": offset,
-        "limit": limit,
-    }
     where_clause = ""
-    if tag:
-        where_clause = "WHERE entry_log.rfid = :rfid"
-        sql_params[ 'rfid' ] = tag
+    if conditions:
+        where_clause = "WHERE " + " AND ".join( conditions )
 
-    conn = get_engine().connect()
-    stmt = text( """
+    return _scan_log_text( """
         SELECT
             members.full_name AS full_name
             ,entry_log.rfid AS rfid
@@ -105,26 +175,244 @@ def search_scan_logs( tag, offset, limit):
             ,entry_log.entry_time AS entry_time
             ,entry_log.is_active_tag AS is_active_tag
             ,entry_log.is_found_tag AS is_found_tag
+            ,entry_log.id AS id
         FROM entry_log
         LEFT OUTER JOIN members ON entry_log.rfid = members.rfid
         LEFT OUTER JOIN locations ON entry_log.location = locations.id
     """ + where_clause +
     """
-        ORDER BY entry_log.entry_time DESC
+        ORDER BY entry_log.entry_time DESC, entry_log.id DESC
+    """ + limit_clause )
+
+def _scan_log_text( sql ):
+    stmt = text( sql )
+    if ":rfids" in sql:
+        stmt = stmt.bindparams( bindparam( "rfids", expanding = True ) )
+    return stmt
+
+def _scan_log_conditions( tag, cursor, name_tags = None ):
+    conditions = []
+    sql_params = {}
+    if tag:
+        conditions.append( "entry_log.rfid = :rfid" )
+        sql_params[ 'rfid' ] = tag
+    if name_tags is not None:
+        # Seek on the rfid index for each member, rather than joining every
+        # row to members to check the name
+        conditions.append( "entry_log.rfid IN :rfids" )
+        sql_params[ 'rfids' ] = list( name_tags )
+    if cursor:
+        # Seek to the row instead of counting past everything before it.
+        # Ties on entry_time are broken by id, so no row is skipped or
+        # repeated.
+        cursor_time, cursor_id = decode_log_cursor( cursor )
+        conditions.append(
+            "(entry_log.entry_time, entry_log.id) < (:cursor_time, :cursor_id)"
+        )
+        # Same as above, but in a form PostgreSQL can use to skip partitions
+        # that are all newer than the cursor
+        conditions.append( "entry_log.entry_time <= :cursor_time" )
+        sql_params[ 'cursor_time' ] = cursor_time
+        sql_params[ 'cursor_id' ] = cursor_id
+
+    return conditions, sql_params
+
+def scan_log_name_tags( name, session ):
+    """Tags to search the entry log for, given part of a member's name
+
+    Returns None if no name was given. Only the first 'search.max_name_tags'
+    matching members are searched for.
+    """
+    if not name:
+        return None
+
+    conf = Doorbot.Config.get( 'search', {} )
+    return Doorbot.NameSearch.tags_for_name(
+        name,
+        session,
+        conf.get( 'max_name_tags', DEFAULT_SEARCH_MAX_NAME_TAGS ),
+    )
+
+def search_scan_logs(
+    tag,
+    offset,
+    limit,
+    session,
+    cursor = None,
+    name = None,
+):
+    """Search the entry log, newest first
+
+    Returns a tuple of the rows and the cursor for the next page. The cursor
+    is None if there are no more rows. When a cursor is given, the offset is
+    ignored and the page starts right after the row the cursor points to.
+    Searching by name finds scans of tags belonging to members whose names
+    contain it.
+    """
+    name_tags = scan_log_name_tags( name, session )
+    if name_tags == []:
+        return [], None
+
+    conditions, sql_params = _scan_log_conditions( tag, cursor, name_tags )
+    # One more than asked for, to know if there's a next page
+    sql_params[ 'limit' ] = limit + 1
+    sql_params[ 'offset' ] = 0 if cursor else offset
+
+    stmt = _scan_log_stmt( conditions, """
         LIMIT :limit
         OFFSET :offset
     """ )
+    logs = session.execute( stmt, sql_params ).all()
 
-    logs = conn.execute( stmt, sql_params )
-    return logs
+    next_cursor = None
+    if len( logs ) > limit:
+        logs = logs[ :limit ]
+        last = logs[ -1 ]
+        next_cursor = encode_log_cursor( last.entry_time, last.id )
 
-def search_tag_list(
+    return logs, next_cursor
+
+def stream_scan_logs(
+    tag,
+    offset,
+    limit,
+    session,
+    cursor = None,
     name = None,
-    tag = None,
-    offset = 0,
-    limit = 100,
 ):
-    stmt = select( Member )
+    """Like search_scan_logs(), but rows come from a server-side cursor
+
+    The rows are only fetched as they're iterated over, so the page can be
+    streamed out without holding it all in memory.
+    """
+    name_tags = scan_log_name_tags( name, session )
+    if name_tags == []:
+        return [], None
+
+    conditions, sql_params = _scan_log_conditions( tag, cursor, name_tags )
+    offset = 0 if cursor else offset
+
+    # The next cursor has to be known before streaming starts, so it can go
+    # in the headers. Find the last row of the page first, along with the
+    # one after it to know if there's a next page, which only needs the
+    # index.
+    last_stmt = _scan_log_text( """
+        SELECT entry_log.entry_time AS entry_time, entry_log.id AS id
+        FROM entry_log
+    """ + ( "WHERE " + " AND ".join( conditions ) if conditions else "" ) +
+    """
+        ORDER BY entry_log.entry_time DESC, entry_log.id DESC
+        LIMIT 2
+        OFFSET :last_offset
+    """ )
+    last_rows = session.execute( last_stmt, {
+        **sql_params,
+        "last_offset": offset + limit - 1,
+    }).all()
+
+    sql_params[ 'offset' ] = offset
+    next_cursor = None
+    if not last_rows:
+        sql_params[ 'limit' ] = limit
+    else:
+        last = last_rows[0]
+        if len( last_rows ) > 1:
+            next_cursor = encode_log_cursor( last.entry_time, last.id )
+
+        # Stop at the last row, so rows added in the meantime can't push a
+        # row out of this page and past the cursor
+        conditions.append(
+            "(entry_log.entry_time, entry_log.id) >= (:last_time, :last_id)"
+        )
+        conditions.append( "entry_log.entry_time >= :last_time" )
+        sql_params[ 'last_time' ] = last.entry_time
+        sql_params[ 'last_id' ] = last.id
+        # No limit, which is spelled differently in SQLite
+        is_sqlite = session.get_bind().dialect.name == "sqlite"
+        sql_params[ 'limit' ] = -1 if is_sqlite else None
+
+    stmt = _scan_log_stmt( conditions, """
+        LIMIT :limit
+        OFFSET :offset
+    """ )
+    logs = session.execute(
+        stmt,
+        sql_params,
+        execution_options = {
+            "stream_results": True,
+            "yield_per": STREAM_BATCH_SIZE,
+        },
+    )
+    return logs, next_cursor
+
+def export_scan_logs( start, end, location_id, session ):
+    """Every entry log row from start up to, but not including, end
+
+    Rows are in the order they were logged, and come from a server-side
+    cursor so any size of range can be streamed out. If location_id is
+    given, only scans at that location are included.
+    """
+    stmt = select(
+        Member.full_name,
+        EntryLog.rfid,
+        Location.name.label( "location" ),
+        EntryLog.entry_time,
+        EntryLog.is_active_tag,
+        EntryLog.is_found_tag,
+        EntryLog.id,
+    ).select_from(
+        EntryLog
+    ).outerjoin(
+        Member,
+        Member.rfid == EntryLog.rfid,
+    ).outerjoin(
+        Location,
+        Location.id == EntryLog.location,
+    ).where(
+        EntryLog.entry_time >= start,
+        EntryLog.entry_time < end,
+    ).order_by(
+        EntryLog.entry_time,
+        EntryLog.id,
+    )
+    if location_id is not None:
+        stmt = stmt.where( EntryLog.location == location_id )
+
+    return session.execute(
+        stmt,
+        execution_options = {
+            "stream_results": True,
+            "yield_per": STREAM_BATCH_SIZE,
+        },
+    )
+
+def parse_range_time( value, session ):
+    """Parse an ISO 8601 date or time for a range in a query
+
+    Times without a timezone are taken as UTC. Raises ValueError if the value
+    can't be parsed.
+    """
+    parsed = datetime.fromisoformat( value )
+    if parsed.tzinfo is None:
+        parsed = parsed.replace( tzinfo = timezone.utc )
+    parsed = parsed.astimezone( timezone.utc )
+
+    # SQLite keeps times as UTC without a timezone
+    if session.get_bind().dialect.name == "sqlite":
+        parsed = parsed.replace( tzinfo = None )
+    return parsed
+
+def _tag_list_stmt( stmt, name, tag, offset, limit, session, fuzzy ):
+    if fuzzy and name:
+        return Doorbot.NameSearch.ranked(
+            stmt,
+            name,
+            tag,
+            offset,
+            limit,
+            session,
+        )
+
     if name:
         stmt = stmt.where(
             Member.full_name.ilike( '%' + name + '%' )
@@ -134,7 +422,7 @@ def search_tag_list(
             Member.rfid == tag,
         )
 
-    stmt = stmt.order_by(
+    return stmt.order_by(
         'join_date'
     ).limit(
         limit
@@ -142,12 +430,326 @@ def search_tag_list(
         offset
     )
 
-    session = get_session()
+def search_tag_list(
+    name = None,
+    tag = None,
+    offset = 0,
+    limit = 100,
+    session = None,
+    fuzzy = False,
+):
+    """Members by name or tag
+
+    A fuzzy search ranks names by how similar they are to the one given
+    (see Doorbot.NameSearch). Otherwise, names containing it are returned in
+    order of join date.
+    """
+    if session is None:
+        session = get_request_session()
+    stmt = _tag_list_stmt(
+        select( Member ),
+        name,
+        tag,
+        offset,
+        limit,
+        session,
+        fuzzy,
+    )
     members = session.scalars( stmt ).all()
-    session.close()
 
     return members
 
+def stream_tag_list(
+    name = None,
+    tag = None,
+    offset = 0,
+    limit = 100,
+    session = None,
+    fuzzy = False,
+):
+    """Like search_tag_list(), but rows come from a server-side cursor
+
+    Only the columns needed for output are fetched, rather than whole Member
+    objects.
+    """
+    if session is None:
+        session = get_request_session()
+    stmt = _tag_list_stmt(
+        select(
+            Member.rfid,
+            Member.full_name,
+            Member.active,
+            Member.mms_id,
+        ),
+        name,
+        tag,
+        offset,
+        limit,
+        session,
+        fuzzy,
+    )
+
+    return session.execute(
+        stmt,
+        execution_options = {
+            "stream_results": True,
+            "yield_per": STREAM_BATCH_SIZE,
+        },
+    )
+
+def search_limit( limit, default ):
+    """Clamp the number of rows asked for in a search
+
+    A limit of zero or less gets the default. The most that can be asked for
+    is 'search.max_limit'.
+    """
+    conf = Doorbot.Config.get( 'search', {} )
+    max_limit = conf.get( 'max_limit', DEFAULT_SEARCH_MAX_LIMIT )
+    if limit <= 0:
+        return default
+    return min( limit, max_limit )
+
+def stream_format( text_mimetype = 'text/plain' ):
+    """Output format asked for with ?format= or the Accept header
+
+    Returns NDJSON_MIMETYPE if asked for, and text_mimetype otherwise.
+    """
+    fmt = flask.request.args.get( 'format' )
+    if fmt:
+        return NDJSON_MIMETYPE if fmt == 'ndjson' else text_mimetype
+
+    return flask.request.accept_mimetypes.best_match(
+        [ text_mimetype, NDJSON_MIMETYPE ],
+        default = text_mimetype,
+    )
+
+def streamed_response( rows, mimetype, to_fields, to_dict, header = None ):
+    """Stream rows out as comma separated lines, CSV, or NDJSON
+
+    Plain text is the fields joined with commas, as the search endpoints
+    have always done. 'text/csv' is properly quoted CSV, starting with the
+    header if one is given. Rows are written in chunks as they come from the
+    database.
+    """
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer( buf, lineterminator = "\n" )
+        if header and mimetype == 'text/csv':
+            writer.writerow( header )
+
+        count = 0
+        for row in rows:
+            if mimetype == NDJSON_MIMETYPE:
+                buf.write( flask.json.dumps( to_dict( row ) ) + "\n" )
+            elif mimetype == 'text/csv':
+                writer.writerow( to_fields( row ) )
+            else:
+                buf.write( ','.join( to_fields( row ) ) + "\n" )
+
+            count += 1
+            if count >= STREAM_BATCH_SIZE:
+                yield buf.getvalue()
+                buf.seek( 0 )
+                buf.truncate()
+                count = 0
+
+        if buf.tell():
+            yield buf.getvalue()
+
+    return flask.Response(
+        flask.stream_with_context( generate() ),
+        status = 200,
+        mimetype = mimetype,
+    )
+
+def stream_tags( stmt, session ):
+    """Run a select of tags with a server-side cursor, yielding each tag"""
+    return session.scalars(
+        stmt,
+        execution_options = {
+            "stream_results": True,
+            "yield_per": STREAM_BATCH_SIZE,
+        },
+    )
+
+def tags_json( tags ):
+    """JSON object of each tag to true
+
+    Written straight from the tags as they come, without building a dict.
+    """
+    return "{" + ",".join(
+        flask.json.dumps( tag ) + ":true" for tag in tags
+    ) + "}"
+
+def format_entry_time( entry_time ):
+    if isinstance( entry_time, datetime ):
+        return entry_time.isoformat()
+    return entry_time
+
+def utc_isoformat( when ):
+    """ISO 8601 string of a time, taking times without a timezone as UTC"""
+    if when.tzinfo is None:
+        when = when.replace( tzinfo = timezone.utc )
+    return when.isoformat()
+
+def entry_log_fields( entry ):
+    return [
+        entry.full_name if entry.full_name else "",
+        entry.rfid,
+        str( entry.entry_time ),
+        "1" if entry.is_active_tag else "0",
+        "1" if entry.is_found_tag else "0",
+        entry.location if entry.location else "",
+    ]
+
+def entry_log_dict( entry ):
+    return {
+        "full_name": entry.full_name,
+        "rfid": entry.rfid,
+        "entry_time": format_entry_time( entry.entry_time ),
+        "was_allowed": bool( entry.is_active_tag ),
+        "was_found": bool( entry.is_found_tag ),
+        "location": entry.location,
+    }
+
+def tag_list_fields( member ):
+    return [
+        member.rfid,
+        member.full_name,
+        "1" if member.active else "0",
+        member.mms_id if member.mms_id else "",
+    ]
+
+def tag_list_dict( member ):
+    return {
+        "rfid": member.rfid,
+        "full_name": member.full_name,
+        "active": bool( member.active ),
+        "mms_id": member.mms_id,
+    }
+
+def acl_etag( acl_version, variant = None ):
+    """ETag for responses built from access control data
+
+    Based on the ACL version, so it changes whenever members, roles, or
+    permissions do. The variant tells apart different formats of the same
+    data.
+    """
+    etag = "acl-" + str( acl_version )
+    if variant:
+        etag += "-" + variant
+    return etag
+
+def is_not_modified( etag ):
+    """Returns true if the client already has the version with this ETag"""
+    return flask.request.if_none_match.contains_weak( etag )
+
+def not_modified_response( etag ):
+    response = flask.make_response()
+    response.status = 304
+    response.set_etag( etag )
+    return response
+
+def cached_response( key, build_response, vary = (), current_etag = None ):
+    """Serve a response from the response cache, building it on a miss
+
+    build_response() returns a Flask response. Only successful ones are
+    cached; anything else is sent as is.
+
+    On a miss, a client sending If-None-Match is checked against
+    current_etag() first, so it can get a 304 without the response being
+    built.
+    """
+    cache = Doorbot.ResponseCache.get_cache()
+    entry = cache.get( key )
+    if entry is not None:
+        return Doorbot.ResponseCache.to_response( entry, vary )
+
+    if current_etag is not None and flask.request.if_none_match:
+        etag = current_etag()
+        if is_not_modified( etag ):
+            response = not_modified_response( etag )
+            for header in vary:
+                response.vary.add( header )
+            return response
+
+    built = {}
+
+    def build():
+        response = build_response()
+        built[ 'response' ] = response
+        if response.status_code != 200:
+            return None
+        return Doorbot.ResponseCache.from_response( response )
+
+    entry = cache.get_or_build( key, build )
+    if entry is None:
+        return built[ 'response' ]
+    return Doorbot.ResponseCache.to_response( entry, vary )
+
+def snapshot_fallback( err ):
+    """The ACL snapshot to decide from when the database can't be reached
+
+    Raises the error again if there's no snapshot. This only covers looking
+    up the tag; authentication and location lookups need the database unless
+    they're already cached.
+    """
+    snapshot = Doorbot.ACLSnapshot.fallback()
+    if snapshot is None:
+        raise err
+    app.logger.warning( "Deciding from ACL snapshot version %d: %s",
+        snapshot.version, err )
+    return snapshot
+
+def lookup_member( tag ):
+    """Find the member with the given tag, for making an access decision
+
+    The result has 'active' and 'full_name' attributes, and is None if the
+    tag isn't found.
+    """
+    snapshot = Doorbot.ACLSnapshot.current( tag )
+    if snapshot is not None:
+        return snapshot.lookup( tag )
+
+    try:
+        index = Doorbot.AccessIndex.get_index()
+        if index is not None:
+            return index.lookup( tag )
+
+        session = get_request_session()
+        member = Member.get_by_tag( tag, session )
+        return member
+    except OperationalError as err:
+        return snapshot_fallback( err ).lookup( tag )
+
+def lookup_permission( tag, permission ):
+    """Find the member with the given tag, and if they have the permission
+
+    Returns the member, as lookup_member() does, and true if the member is
+    active and has the permission.
+    """
+    snapshot = Doorbot.ACLSnapshot.current( tag )
+    if snapshot is None:
+        try:
+            index = Doorbot.AccessIndex.get_index()
+            if index is None:
+                session = get_request_session()
+                member = Member.check_permission_by_tag(
+                    tag, permission, session )
+                return ( member, member.has_permission if member else False )
+
+            return (
+                index.lookup( tag ),
+                index.has_permission( tag, permission ),
+            )
+        except OperationalError as err:
+            snapshot = snapshot_fallback( err )
+
+    return (
+        snapshot.lookup( tag ),
+        snapshot.has_permission( tag, permission ),
+    )
+
 def auth_required( func ):
     def check( *args, **kwargs ):
         #if 'is_testing' in app.config and app.config[ 'is_testing' ]:
@@ -161,16 +763,14 @@ def auth_required( func ):
         if not bearer_str:
             return error_response( "Invalid authorization", 401 )
 
-        session = get_session()
-        stmt = select( Doorbot.SQLAlchemy.OauthToken ).where(
-            Doorbot.SQLAlchemy.OauthToken.token == bearer_str
+        member_id = Doorbot.AuthCache.verify_token(
+            bearer_str,
+            get_request_session(),
         )
-        token = session.scalars( stmt ).one_or_none()
-        session.close()
 
         # TODO store token somewhere so we can check permissions on an 
         # endpoint later
-        if token:
+        if member_id is not None:
             return func( *args, **kwargs )
 
         return error_response( "Invalid authorization", 401 )
@@ -183,12 +783,12 @@ def auth_required( func ):
 
 @auth.verify_password
 def verify_basic_auth( username, password ):
-    session = get_session()
-    member = Member.get_by_username( username, session )
-    session.close()
-
-    if member and member.check_password( password, session ):
-        return member
+    if Doorbot.AuthCache.verify_credentials(
+        username,
+        password,
+        get_request_session(),
+    ):
+        return username
 
     return None
 
@@ -208,9 +808,7 @@ def check_tag( tag ):
         response.status = 400
         return response
 
-    session = get_session()
-    member = Member.get_by_tag( tag, session )
-    session.close()
+    member = lookup_member( tag )
 
     if None == member:
         response.status = 404
@@ -229,9 +827,7 @@ def check_tag_by_permission( tag, permission ):
         response.status = 400
         return response
 
-    session = get_session()
-    member = Member.get_by_tag( tag, session )
-    session.close()
+    member, has_permission = lookup_permission( tag, permission )
 
     is_active = False
     is_found = False
@@ -242,7 +838,7 @@ def check_tag_by_permission( tag, permission ):
         is_active = True
         is_found = True
         full_name = member.full_name
-        if member.has_permission( permission ):
+        if has_permission:
             response.status = 200
         else:
             response.status = 403
@@ -274,16 +870,8 @@ def log_entry( tag, location ):
         response.status = 400
         return response
 
-    session = get_session()
-    member = Member.get_by_tag( tag, session )
-
-    stmt = select( Location ).where(
-        Location.name == location
-    )
-    location_db = session.scalars( stmt ).one_or_none()
-
-    if location_db is None:
-        session.close()
+    location_id = Doorbot.LocationRegistry.get_registry().get_id( location )
+    if location_id is None:
         set_error(
             response = response,
             msg = "Location " + location + " was not found",
@@ -291,42 +879,41 @@ def log_entry( tag, location ):
         )
         return response
 
-    entry = EntryLog(
-        rfid = tag,
-        mapped_location = location_db,
-    )
+    member = lookup_member( tag )
 
     full_name = None
     if None == member:
-        entry.is_active_tag = False
-        entry.is_found_tag = False
+        is_active = False
+        is_found = False
         response.status = 404
     elif member.active:
         full_name = member.full_name
-        entry.is_active_tag = True
-        entry.is_found_tag = True
+        is_active = True
+        is_found = True
         response.status = 200
     else:
         full_name = member.full_name
-        entry.is_active_tag = False
-        entry.is_found_tag = True
+        is_active = False
+        is_found = True
         response.status = 403
 
-    session.add( entry )
-    session.add( location_db )
-    session.commit()
+    Doorbot.EntryLogWriter.get_writer().log(
+        rfid = tag,
+        location_id = location_id,
+        is_active_tag = is_active,
+        is_found_tag = is_found,
+    )
 
     response.content_type = 'application/json'
     json_data = flask.json.dumps({
         "rfid": tag,
         "location": location,
         "full_name": full_name,
-        "active": entry.is_active_tag,
-        "found": entry.is_found_tag,
+        "active": is_active,
+        "found": is_found,
     })
     response.set_data( json_data )
 
-    session.close()
     return response
 
 @app.route( "/v1/new_tag/<tag>/<full_name>", methods = [ "PUT" ] )
@@ -337,14 +924,13 @@ def new_tag( tag, full_name ):
         response.status = 400
         return response
 
-    session = get_session()
+    session = get_request_session()
     member = Doorbot.SQLAlchemy.Member(
         full_name = full_name,
         rfid = tag,
     )
     session.add( member )
     session.commit()
-    session.close()
 
     response.status = 201
     return response
@@ -357,13 +943,12 @@ def deactivate_tag( tag ):
         response.status = 400
         return response
 
-    session = get_session()
+    session = get_request_session()
     member = Member.get_by_tag( tag, session )
 
     member.active = False
     session.add( member )
     session.commit()
-    session.close()
 
     response.status = 200
     return response
@@ -376,13 +961,12 @@ def reactivate_tag( tag ):
         response.status = 400
         return response
 
-    session = get_session()
+    session = get_request_session()
     member = Member.get_by_tag( tag, session )
 
     member.active = True
     session.add( member )
     session.commit()
-    session.close()
 
     response.status = 200
     return response
@@ -398,13 +982,12 @@ def edit_tag( current_tag, new_tag ):
         response.status = 400
         return response
 
-    session = get_session()
+    session = get_request_session()
     member = Member.get_by_tag( current_tag, session )
 
     member.rfid = new_tag
     session.add( member )
     session.commit()
-    session.close()
 
     response.status = 201
     return response
@@ -417,13 +1000,12 @@ def edit_name( tag, new_name ):
         response.status = 400
         return response
 
-    session = get_session()
+    session = get_request_session()
     member = Member.get_by_tag( tag, session )
 
     member.full_name = new_name
     session.add( member )
     session.commit()
-    session.close()
 
     response.status = 201
     return response
@@ -432,12 +1014,12 @@ def edit_name( tag, new_name ):
 @auth_required
 def search_tags():
     args = flask.request.args
-    response = flask.make_response()
 
     name = args.get( 'name' )
     tag = args.get( 'tag' )
     offset = args.get( 'offset' )
     limit = args.get( 'limit' )
+    fuzzy = args.get( 'match' ) == "fuzzy"
 
     offset = int( offset ) if offset else 0
     limit = int( limit ) if limit else 0
@@ -445,36 +1027,26 @@ def search_tags():
     # Clamp offset/limit
     if offset < 0:
         offset = 0
-    if limit < 0:
-        limit = 50
-    elif limit > 100:
-        limit = 100
-
-    members = Doorbot.API.search_tag_list( name, tag, offset, limit )
-
-    out = ''
-    for member in members:
-        out += ','.join([
-            member.rfid,
-            member.full_name,
-            "1" if member.active else "0",
-            member.mms_id if member.mms_id else "",
-        ]) + "\n"
-
-    response.status = 200
-    response.content_type = 'text/plain'
-    response.set_data( out )
-    return response
+    limit = search_limit( limit, 50 )
+
+    members = stream_tag_list( name, tag, offset, limit, fuzzy = fuzzy )
+    return streamed_response(
+        members,
+        stream_format(),
+        tag_list_fields,
+        tag_list_dict,
+    )
 
 @app.route( "/v1/search_entry_log", methods = [ "GET" ] )
 @auth_required
 def search_entry_log():
     args = flask.request.args
-    response = flask.make_response()
 
     tag = args.get( 'tag' )
+    name = args.get( 'name' )
     offset = args.get( 'offset' )
     limit = args.get( 'limit' )
+    cursor = args.get( 'cursor' )
 
     offset = int( offset ) if offset else 0
     limit = int( limit ) if limit else 0
@@ -482,87 +1054,348 @@ def search_entry_log():
     # Clamp offset/limit
     if offset < 0:
         offset = 0
-    if limit <= 0:
-        limit = 50
-    elif limit > 100:
-        limit = 100
-
-    logs = search_scan_logs( tag, offset, limit )
-
-    out = ''
-    for entry in logs:
-        out += ','.join([
-            entry[ 0 ] if entry[ 0 ] else "",
-            entry[ 1 ],
-            entry[ 3 ],
-            "1" if entry[ 4 ] else "0",
-            "1" if entry[ 5 ] else "0",
-            entry[ 2 ] if entry[ 2 ] else "",
-        ]) + "\n"
+    limit = search_limit( limit, 50 )
+
+    try:
+        logs, next_cursor = stream_scan_logs(
+            tag,
+            offset,
+            limit,
+            get_request_session(),
+            cursor = cursor,
+            name = name,
+        )
+    except ValueError:
+        response = flask.make_response()
+        set_error(
+            response = response,
+            msg = "Invalid cursor",
+            status = 400,
+        )
+        return response
 
-    response.status = 200
-    response.content_type = 'text/plain'
-    response.set_data( out )
+    response = streamed_response(
+        logs,
+        stream_format(),
+        entry_log_fields,
+        entry_log_dict,
+    )
+    if next_cursor:
+        response.headers[ 'X-Next-Cursor' ] = next_cursor
+    return response
+
+@app.route( "/v1/export_entry_log", methods = [ "GET" ] )
+@auth_required
+def export_entry_log():
+    args = flask.request.args
+    response = flask.make_response()
+    session = get_request_session()
+
+    try:
+        start = parse_range_time( args.get( 'from', '' ), session )
+        end = parse_range_time( args.get( 'to', '' ), session )
+    except ValueError:
+        set_error(
+            response = response,
+            msg = "'from' and 'to' must be ISO 8601 dates or times",
+            status = 400,
+        )
+        return response
+
+    location_id = None
+    location = args.get( 'location' )
+    if location:
+        location_id = Doorbot.LocationRegistry.get_registry().get_id(
+            location
+        )
+        if location_id is None:
+            set_error(
+                response = response,
+                msg = "Location " + location + " was not found",
+                status = 404,
+            )
+            return response
+
+    mimetype = stream_format( 'text/csv' )
+    logs = export_scan_logs( start, end, location_id, session )
+    response = streamed_response(
+        logs,
+        mimetype,
+        entry_log_fields,
+        entry_log_dict,
+        header = ENTRY_LOG_CSV_HEADER,
+    )
+
+    extension = "ndjson" if mimetype == NDJSON_MIMETYPE else "csv"
+    filename = "entry_log_" + args[ 'from' ] + "_" + args[ 'to' ] \
+        + "." + extension
+    response.headers[ 'Content-Disposition' ] = \
+        'attachment; filename="' + re.sub( r'[^\w.\-]', '_', filename ) + '"'
+    return response
+
+@app.route( "/v1/scan_stats", methods = [ "GET" ] )
+@auth_required
+def scan_stats():
+    args = flask.request.args
+    response = flask.make_response()
+    session = get_request_session()
+
+    try:
+        end = parse_range_time( args[ 'to' ], session ) if 'to' in args \
+            else datetime.now( timezone.utc )
+        start = parse_range_time( args[ 'from' ], session ) if 'from' in args \
+            else end - timedelta( days = 1 )
+    except ValueError:
+        set_error(
+            response = response,
+            msg = "'from' and 'to' must be ISO 8601 dates or times",
+            status = 400,
+        )
+        return response
+
+    location_id = None
+    location = args.get( 'location' )
+    if location:
+        location_id = Doorbot.LocationRegistry.get_registry().get_id(
+            location
+        )
+        if location_id is None:
+            set_error(
+                response = response,
+                msg = "Location " + location + " was not found",
+                status = 404,
+            )
+            return response
+
+    hours = [
+        {
+            "location": row.location,
+            "hour": utc_isoformat( row.hour ),
+            "total_scans": row.total_scans,
+            "active_scans": row.active_scans,
+            "found_scans": row.found_scans,
+            "unique_tags": row.unique_tags,
+        }
+        for row in Doorbot.ScanStats.hourly(
+            session,
+            start,
+            end,
+            location_id,
+        )
+    ]
+
+    response.content_type = 'application/json'
+    response.set_data( flask.json.dumps({
+        "from": utc_isoformat( start ),
+        "to": utc_isoformat( end ),
+        "totals": Doorbot.ScanStats.totals(
+            session,
+            start,
+            end,
+            location_id,
+        ),
+        "hours": hours,
+    }) )
     return response
 
 @app.route( "/v1/dump_active_tags/<permission>", methods = [ "GET" ] )
 @auth_required
 def dump_tags_for_permission( permission ):
-    session = get_session()
-    stmt = select( Doorbot.SQLAlchemy.Permission ).where(
-        Doorbot.SQLAlchemy.Permission.name == permission
+    response = flask.make_response()
+    response.vary.add( 'Accept' )
+
+    mimetype = flask.request.accept_mimetypes.best_match(
+        DUMP_TAGS_MIMETYPES,
+        default = 'application/json',
+    )
+    fp_rate = None
+    etag_variant = None
+    if mimetype == Doorbot.ACLExport.BLOOM_MIMETYPE:
+        fp_rate = flask.request.args.get( 'fp_rate', type = float )
+        if fp_rate is None:
+            fp_rate = Doorbot.ACLExport.default_fp_rate()
+        if not ( Doorbot.ACLExport.MIN_BLOOM_FP_RATE <= fp_rate
+            <= Doorbot.ACLExport.MAX_BLOOM_FP_RATE ):
+            set_error(
+                response = response,
+                msg = "fp_rate must be between "
+                    + str( Doorbot.ACLExport.MIN_BLOOM_FP_RATE ) + " and "
+                    + str( Doorbot.ACLExport.MAX_BLOOM_FP_RATE ),
+                status = 400,
+            )
+            return response
+        etag_variant = "bloom-" + repr( fp_rate )
+    elif mimetype == Doorbot.ACLExport.PACKED_MIMETYPE:
+        etag_variant = "packed"
+
+    return cached_response(
+        ( "dump_active_tags", permission, mimetype, fp_rate ),
+        lambda: _dump_tags_for_permission(
+            permission,
+            mimetype,
+            fp_rate,
+            etag_variant,
+        ),
+        vary = [ 'Accept' ],
+        current_etag = lambda: acl_etag(
+            Doorbot.ACL.current_version( get_request_session() ),
+            etag_variant,
+        ),
     )
-    found_permission = session.scalars( stmt ).one_or_none()
 
+def _dump_tags_for_permission( permission, mimetype, fp_rate, etag_variant ):
     response = flask.make_response()
+    response.vary.add( 'Accept' )
+
+    session = get_request_session()
+    acl_version = Doorbot.ACL.current_version( session )
+    etag = acl_etag( acl_version, etag_variant )
+
+    stmt = select( Permission.id ).where(
+        Permission.name == permission
+    )
+    found_permission = session.scalars( stmt ).one_or_none()
+
     if found_permission is None:
-        session.close()
         set_error(
             response = response,
             msg = "Location " + permission + " was not found",
             status = 404,
         )
     else:
-        members = {}
-        for member in found_permission.all_members_with_permission():
-            rfid = member.rfid
-            members[ rfid ] = True
-
-        session.close()
-        json_data = flask.json.dumps( members )
-        response.content_type = 'application/json'
-        response.set_data( json_data )
+        payload = None
+        if mimetype != 'application/json':
+            try:
+                payload = Doorbot.ACLExport.export_tags(
+                    permission = permission,
+                    mimetype = mimetype,
+                    acl_version = acl_version,
+                    session = session,
+                    fp_rate = fp_rate,
+                )
+            except Doorbot.ACLExport.UnexportableTags as e:
+                # Better a bigger response than a member left out
+                app.logger.warning( "Sending JSON instead of %s: %s",
+                    mimetype, e )
+
+        if payload is not None:
+            response.content_type = mimetype
+            response.set_data( payload )
+            response.set_etag( etag )
+        else:
+            stmt = Permission.tags_with_permission_stmt( permission )
+            response.content_type = 'application/json'
+            response.set_data( tags_json( stream_tags( stmt, session ) ) )
+            response.set_etag( acl_etag( acl_version ) )
 
     return response
 
 @app.route( "/secure/dump_active_tags", methods = [ "GET" ] )
 @auth.login_required
 def dump_tags():
-    session = get_session()
-    stmt = select( Member ).where(
-        Member.active == True
+    return cached_response(
+        ( "secure_dump_active_tags", ),
+        _dump_tags,
+        current_etag = lambda: acl_etag(
+            Doorbot.ACL.current_version( get_request_session() )
+        ),
     )
-    members = session.scalars( stmt ).all()
-    session.close()
 
-    out = {}
-    for member in members:
-        rfid = member.rfid
-        out[ rfid ] = True
+def _dump_tags():
+    session = get_request_session()
+    etag = acl_etag( Doorbot.ACL.current_version( session ) )
+
+    response = flask.make_response(
+        tags_json( stream_tags( Member.active_tags_stmt(), session ) )
+    )
+    response.content_type = 'application/json'
+    response.set_etag( etag )
+    return response
+
 
-    return out
+@app.route( "/v1/acl_changes", methods = [ "GET" ] )
+@auth_required
+def acl_changes():
+    """Long poll for changes to access control data
+
+    Waits until the ACL version moves past 'since', then lists the current
+    access for each tag that changed. If the changes can't be narrowed down
+    to tags, 'everything' is true and the client should fetch a full dump.
+    """
+    args = flask.request.args
+    response = flask.make_response()
+
+    since = args.get( 'since', type = int )
+    conf = Doorbot.ACLFeed.get_conf()
+    timeout = args.get( 'timeout', type = float )
+    if timeout is None:
+        timeout = conf.get(
+            'timeout_seconds',
+            Doorbot.ACLFeed.DEFAULT_TIMEOUT_SECONDS,
+        )
+    max_timeout = conf.get(
+        'max_timeout_seconds',
+        Doorbot.ACLFeed.DEFAULT_MAX_TIMEOUT_SECONDS,
+    )
+    timeout = min( max( timeout, 0 ), max_timeout )
+
+    # Don't hold on to a database connection while waiting
+    get_request_session().close()
+
+    feed = Doorbot.ACLFeed.get_feed()
+    if since is not None:
+        try:
+            feed.wait_for_change( since, timeout )
+        except Doorbot.ACLFeed.TooManyWaiters:
+            set_error(
+                response = response,
+                msg = "Too many clients waiting, try again later",
+                status = 503,
+            )
+            response.headers[ 'Retry-After' ] = str( int( timeout ) or 1 )
+            return response
+
+    session = get_request_session()
+    if since is None:
+        change = Doorbot.ACL.ACLChange(
+            version = Doorbot.ACL.current_version( session ),
+            tags = frozenset(),
+            everything = True,
+        )
+    else:
+        change = Doorbot.ACL.changes_since( session, since )
+
+    entries = Doorbot.AccessIndex.fetch_entries( change.tags, session )
+    tags = {}
+    for tag in sorted( change.tags ):
+        entry = entries.get( tag )
+        if entry is None:
+            # Tag was changed or removed
+            tags[ tag ] = None
+        else:
+            tags[ tag ] = {
+                "active": entry.active,
+                "permissions": sorted( entry.permissions ),
+            }
+
+    response.content_type = 'application/json'
+    response.set_data( flask.json.dumps({
+        "version": change.version,
+        "everything": change.everything,
+        "tags": tags,
+    }) )
+    return response
 
 
 @app.route( "/v1/change_passwd/<tag>", methods = [ "PUT" ] )
 @auth_required
 def change_password( tag ):
-    session = get_session()
+    session = get_request_session()
     member = Member.get_by_tag( tag, session )
 
     response = flask.make_response()
 
     if member is None:
-        session.close()
         set_error(
             response = response,
             msg = "Member with RFID " + rfid + " was not found",
@@ -573,7 +1406,6 @@ def change_password( tag ):
         pass2 = flask.request.form[ 'new_pass2' ]
 
         if pass1 != pass2:
-            session.close()
             set_error(
                 response = response,
                 msg = "Passwords do not match",
@@ -584,7 +1416,6 @@ def change_password( tag ):
             member.set_password( pass1, password_config )
             session.add( member )
             session.commit()
-            session.close()
 
             response.status = 200
 
@@ -593,14 +1424,13 @@ def change_password( tag ):
 @app.route( "/v1/permission/<permission>/<role>", methods = [ "PUT" ] )
 @auth_required
 def add_permission( permission, role ):
-    session = get_session()
+    session = get_request_session()
     role_obj = get_or_create( session, Role, name = role )
     permission_obj = get_or_create( session, Permission, name = permission )
 
     role_obj.permissions.append( permission_obj )
     session.add_all([ role_obj, permission_obj ])
     session.commit()
-    session.close()
 
     response = flask.make_response()
     response.status = 201
@@ -609,20 +1439,18 @@ def add_permission( permission, role ):
 @app.route( "/v1/permission/<permission>/<role>", methods = [ "DELETE" ] )
 @auth_required
 def delete_permission( permission, role ):
-    session = get_session()
+    session = get_request_session()
     role_obj = get( session, Role, name = role )
     permission_obj = get( session, Permission, name = permission )
 
     response = flask.make_response()
     if not role_obj:
-        session.close()
         set_error(
             response = response,
             msg = "Role " + role + " was not found",
             status = 404,
         )
     elif not permission_obj:
-        session.close()
         set_error(
             response = response,
             msg = "Location " + permission + " was not found",
@@ -634,14 +1462,13 @@ def delete_permission( permission, role ):
         role_obj.permissions.remove( permission_obj )
         session.add_all([ role_obj, permission_obj ])
         session.commit()
-        session.close()
 
     return response
 
 @app.route( "/v1/role/<role>/<tag>", methods = [ "PUT" ] )
 @auth_required
 def add_role_to_member( role, tag ):
-    session = get_session()
+    session = get_request_session()
     member = Member.get_by_tag( tag, session )
 
     response = flask.make_response()
@@ -655,26 +1482,23 @@ def add_role_to_member( role, tag ):
 
         response.status = 201
 
-    session.close()
     return response
 
 @app.route( "/v1/role/<role>/<tag>", methods = [ "DELETE" ] )
 @auth_required
 def delete_role_from_member( role, tag ):
-    session = get_session()
+    session = get_request_session()
     role_obj = get( session, Role, name = role )
     member_obj = get( session, Member, rfid = tag )
 
     response = flask.make_response()
     if not member_obj:
-        session.close()
         set_error(
             response = response,
             msg = "Member for RFID " + tag + " was not found",
             status = 404,
         )
     elif not role_obj:
-        session.close()
         set_error(
             response = response,
             msg = "Role " + role + " was not found",
@@ -686,22 +1510,19 @@ def delete_role_from_member( role, tag ):
         member_obj.roles.remove( role_obj )
         session.add_all([ member_obj, role_obj ])
         session.commit()
-        session.close()
 
     return response
 
 @app.route( "/v1/dump_locations", methods = [ "GET" ] )
 @auth_required
 def dump_locations():
-  
-    session = get_session()
-    stmt = select( Location )
-    
-    locations = session.scalars( stmt ).all()
-    session.close()
-
-    out = [location.name for location in locations]
-    return out
+    registry = Doorbot.LocationRegistry.get_registry()
+    # A new generation means the locations were reloaded, so the key changes
+    # along with them
+    return cached_response(
+        ( "dump_locations", registry.generation() ),
+        lambda: flask.make_response( registry.names() ),
+    )
 
 @app.route( "/v1/new_location/<newLocation>/<hostname>", methods = [ "PUT" ] )
 @auth_required
@@ -711,14 +1532,13 @@ def new_location(newLocation, hostname):
         response.status = 400
         return response
     
-    session = get_session()
+    session = get_request_session()
     stmt = select( Location ).where(
         Location.name == newLocation
     )
     location_db = session.scalars( stmt ).one_or_none()
 
     if not location_db is None:
-        session.close()
         set_error(
             response = response,
             msg = "Location " + newLocation + " already exists",
@@ -732,7 +1552,6 @@ def new_location(newLocation, hostname):
     )
     session.add( location )
     session.commit()
-    session.close()
 
     response.status = 201
     return response
@@ -746,14 +1565,13 @@ def edit_location(location, newHostname):
         return response
     
     stmt = select( Location ).where (
-        Location.c.name == location
+        Location.name == location
         )
-    session = get_session()
+    session = get_request_session()
     
     location_db = session.scalars( stmt ).one_or_none()
     
     if location_db == None:
-        session.close()
         set_error(
             response = response,
             msg = "Location " + location + " not found",
@@ -764,36 +1582,32 @@ def edit_location(location, newHostname):
     location_db.hostname = newHostname
     session.add( location_db )
     session.commit()
-    session.close()
 
     response.status = 201
     return response
 
-@app.route("/v1/delete_location/<location>", methods = [ 'DELETE '])
+@app.route("/v1/delete_location/<location>", methods = [ 'DELETE' ])
 @auth_required
 def delete_location(location):
+    response = flask.make_response()
     if not MATCH_NAME.match( location ):
         response.status = 400
         return response
     
-    session = get_session()
+    session = get_request_session()
     location_obj = get( session, Location, name = location )
     
-    response = flask.make_response()
     if not location_obj:
-        session.close()
         set_error(
             response = response,
             msg = "Location " + location + " was not found",
             status = 404,
         )
-    else:
-        response.status = 200
+        return response
 
     stmt  = delete( Location ).where( Location.name == location)
     session.execute(stmt)
     session.commit()
-    session.close()
   
     response.status = 204
   
@@ -0,0 +1,230 @@
+"""In-memory index of access decisions, keyed by RFID tag
+
+The index is built with a single bulk query and then kept current by
+listening for ACL changes (see Doorbot.ACL). Changes to a member only reload
+that member's tags. Changes to roles or permissions rebuild the whole index
+on the next lookup.
+
+Changes made by other processes arrive the same way, through
+Doorbot.InvalidationBus. In case one is missed, the index is also rebuilt once
+it gets older than 'access_index.max_age_seconds'.
+"""
+import threading
+import time
+import Doorbot.ACL
+import Doorbot.Config
+from collections import namedtuple
+from Doorbot.SQLAlchemy import Member
+from Doorbot.SQLAlchemy import Permission
+from Doorbot.SQLAlchemy import member_role_association
+from Doorbot.SQLAlchemy import role_permission_association
+from Doorbot.SQLAlchemy import get_engine
+from Doorbot.SQLAlchemy import get_session
+from sqlalchemy import select
+
+
+DEFAULT_MAX_AGE_SECONDS = 300
+
+AccessEntry = namedtuple( 'AccessEntry', [
+    'active',
+    'full_name',
+    'permissions',
+])
+"""Access details for a single tag"""
+
+__INDEX = None
+
+
+class AccessIndex:
+    """Maps RFID tag to an AccessEntry"""
+
+    def __init__(
+        self,
+        max_age_seconds = DEFAULT_MAX_AGE_SECONDS,
+    ):
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self._engine = None
+        self._entries = None
+        self._permission_names = None
+        self._built_at = 0
+        self._stale_tags = set()
+        # Moves with every invalidation, so a tag reloaded while one came in
+        # isn't stored from before the change
+        self._generation = 0
+
+    def lookup( self, tag ):
+        """Returns the AccessEntry for the tag, or None if it isn't found"""
+        entries, permission_names = self._current()
+
+        if tag in self._stale_tags:
+            return self._refresh_tag( tag )
+
+        return entries.get( tag )
+
+    def is_known_permission( self, permission ):
+        """Returns true if a permission by that name exists"""
+        entries, permission_names = self._current()
+        return permission in permission_names
+
+    def has_permission( self, tag, permission ):
+        """Returns true if the tag is active and has the named permission"""
+        if not self.is_known_permission( permission ):
+            return False
+
+        entry = self.lookup( tag )
+        if entry is None or not entry.active:
+            return False
+        return permission in entry.permissions
+
+    def invalidate( self ):
+        """Throw out the whole index. It's rebuilt on the next lookup."""
+        with self._lock:
+            self._entries = None
+            self._generation += 1
+
+    def invalidate_tags( self, tags ):
+        """Reload the given tags on their next lookup"""
+        with self._lock:
+            self._stale_tags.update( tags )
+            self._generation += 1
+
+    def _is_current( self, engine ):
+        age = time.monotonic() - self._built_at
+        return self._entries is not None \
+            and self._engine is engine \
+            and age < self.max_age_seconds
+
+    def _current( self ):
+        engine = get_engine()
+        entries = self._entries
+        permission_names = self._permission_names
+        if entries is not None and self._is_current( engine ):
+            return ( entries, permission_names )
+
+        with self._lock:
+            # Another thread may have rebuilt it while we waited on the lock
+            if not self._is_current( engine ):
+                session = get_session()
+                self._entries = _fetch_entries( session )
+                self._permission_names = frozenset(
+                    session.scalars( select( Permission.name ) ).all()
+                )
+                session.close()
+
+                self._stale_tags = set()
+                self._engine = engine
+                self._built_at = time.monotonic()
+
+            return ( self._entries, self._permission_names )
+
+    def _refresh_tag( self, tag ):
+        generation = self._generation
+        session = get_session()
+        found = _fetch_entries( session, [ tag ] )
+        session.close()
+
+        with self._lock:
+            if generation != self._generation:
+                # What we read may be from before the change, so leave the
+                # tag to be reloaded again next time
+                return found.get( tag )
+
+            if self._entries is not None:
+                entries = dict( self._entries )
+                entries.pop( tag, None )
+                entries.update( found )
+                self._entries = entries
+            self._stale_tags.discard( tag )
+
+        return found.get( tag )
+
+
+def fetch_entries( tags, session ):
+    """Look up the AccessEntry for each of the tags in the database
+
+    Returns a dict of tag to AccessEntry. Tags that aren't found are left out.
+    """
+    tags = list( tags )
+    if not tags:
+        return {}
+    return _fetch_entries( session, tags )
+
+def fetch_all_entries( session ):
+    """Look up the AccessEntry for every tag in the database"""
+    return _fetch_entries( session )
+
+def _fetch_entries(
+    session,
+    tags = None,
+):
+    stmt = select(
+        Member.rfid,
+        Member.active,
+        Member.full_name,
+        Permission.name,
+    ).outerjoin(
+        member_role_association,
+        member_role_association.c.member_id == Member.id,
+    ).outerjoin(
+        role_permission_association,
+        role_permission_association.c.role_id ==
+            member_role_association.c.role_id,
+    ).outerjoin(
+        Permission,
+        Permission.id == role_permission_association.c.permission_id,
+    ).where(
+        Member.rfid != None
+    )
+    if tags is not None:
+        stmt = stmt.where( Member.rfid.in_( tags ) )
+
+    permissions = {}
+    details = {}
+    for rfid, active, full_name, permission in session.execute( stmt ):
+        details[ rfid ] = ( active, full_name )
+        tag_permissions = permissions.setdefault( rfid, set() )
+        if permission is not None:
+            tag_permissions.add( permission )
+
+    return {
+        rfid: AccessEntry(
+            active = active,
+            full_name = full_name,
+            permissions = frozenset( permissions[ rfid ] ),
+        )
+        for rfid, ( active, full_name ) in details.items()
+    }
+
+
+def get_index():
+    """Get the access index for this process
+
+    Returns None if the index is turned off with 'access_index.enabled', in
+    which case callers should query the database directly.
+    """
+    global __INDEX
+
+    if __INDEX is None:
+        conf = Doorbot.Config.get( 'access_index', {} )
+        if not conf.get( 'enabled', True ):
+            return None
+        __INDEX = AccessIndex(
+            max_age_seconds = conf.get(
+                'max_age_seconds',
+                DEFAULT_MAX_AGE_SECONDS,
+            ),
+        )
+
+    return __INDEX
+
+
+@Doorbot.ACL.add_listener
+def _apply_changes( change ):
+    if __INDEX is None:
+        return
+
+    if change.everything:
+        __INDEX.invalidate()
+    elif change.tags:
+        __INDEX.invalidate_tags( change.tags )
@@ -0,0 +1,353 @@
+"""Caches for authentication checks
+
+Valid bearer tokens are cached by a digest of the token string, so the
+plaintext token is never kept around as a dict key. Each entry lives no longer
+than the token's expiration date. Tokens that fail are also cached for a short
+time, so a client repeatedly sending a bad token doesn't hit the database
+every time.
+
+Successful HTTP Basic logins are cached as an HMAC of the username and
+password, using a key that only lives in this process. A repeat login with
+the same credentials can then skip the bcrypt check.
+
+Any ORM commit that touches an OauthToken evicts that token, and any commit
+that touches a Member evicts that member's cached login. Other processes
+are told through Doorbot.InvalidationBus, by token digest rather than the
+token itself.
+"""
+import collections
+import hashlib
+import hmac
+import itertools
+import secrets
+import threading
+import time
+import Doorbot.Config
+import Doorbot.InvalidationBus
+from datetime import datetime, timezone
+from Doorbot.SQLAlchemy import Member
+from Doorbot.SQLAlchemy import OauthToken
+from Doorbot.SQLAlchemy import get_engine
+from Doorbot.SQLAlchemy import get_session
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+
+DEFAULT_MAX_SIZE = 1024
+DEFAULT_TTL_SECONDS = 300
+DEFAULT_NEGATIVE_TTL_SECONDS = 10
+DEFAULT_BASIC_AUTH_TTL_SECONDS = 300
+BUS_TOPIC = "auth"
+
+__TOKEN_CACHE = None
+__CACHE_ENGINE = None
+__CREDENTIAL_CACHE = None
+__CREDENTIAL_KEY = secrets.token_bytes( 32 )
+
+
+class TTLCache:
+    """Bounded LRU cache where each entry has its own time to live"""
+
+    def __init__(
+        self,
+        max_size = DEFAULT_MAX_SIZE,
+    ):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._generation = 0
+
+    def generation( self ):
+        """Counter that moves whenever anything is evicted"""
+        return self._generation
+
+    def get( self, key ):
+        """Returns the cached value, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get( key )
+            if entry is None:
+                return None
+
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[ key ]
+                return None
+
+            self._entries.move_to_end( key )
+            return value
+
+    def set( self, key, value, ttl_seconds, generation = None ):
+        """Cache the value for at most ttl_seconds
+
+        Pass the generation() from before the value was looked up, and it
+        won't be cached if something was evicted in the meantime, since the
+        value may be from before that change.
+        """
+        if ttl_seconds <= 0:
+            return
+
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[ key ] = ( value, time.monotonic() + ttl_seconds )
+            self._entries.move_to_end( key )
+            while len( self._entries ) > self.max_size:
+                self._entries.popitem( last = False )
+
+    def discard( self, key ):
+        with self._lock:
+            self._entries.pop( key, None )
+            self._generation += 1
+
+    def clear( self ):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def __len__( self ):
+        return len( self._entries )
+
+
+def token_digest( token_str ):
+    """Key used to cache a bearer token"""
+    return hashlib.sha256( token_str.encode( 'utf-8' ) ).digest()
+
+def seconds_until( expiration_date ):
+    """Seconds left before the given datetime, which may be naive or aware"""
+    if expiration_date.tzinfo is None:
+        now = datetime.now()
+    else:
+        now = datetime.now( timezone.utc )
+    return ( expiration_date - now ).total_seconds()
+
+def _token_conf():
+    oauth_conf = Doorbot.Config.get( 'oauth', {} )
+    return oauth_conf.get( 'cache' ) or {}
+
+def _clear_on_new_engine():
+    # Cached results from one database mean nothing in another
+    global __CACHE_ENGINE
+
+    engine = get_engine()
+    if __CACHE_ENGINE is not engine:
+        if __TOKEN_CACHE is not None:
+            __TOKEN_CACHE.clear()
+        if __CREDENTIAL_CACHE is not None:
+            __CREDENTIAL_CACHE.clear()
+        __CACHE_ENGINE = engine
+
+def get_token_cache():
+    """Get the bearer token cache for this process"""
+    global __TOKEN_CACHE
+
+    if __TOKEN_CACHE is None:
+        __TOKEN_CACHE = TTLCache(
+            max_size = _token_conf().get( 'max_size', DEFAULT_MAX_SIZE ),
+        )
+
+    _clear_on_new_engine()
+    return __TOKEN_CACHE
+
+def verify_token( token_str, session = None ):
+    """Check a bearer token
+
+    Returns the id of the member who owns the token, or None if the token
+    doesn't exist or has expired. If a session is passed, it's used for any
+    query that needs to be made.
+    """
+    cache = get_token_cache()
+    key = token_digest( token_str )
+
+    cached = cache.get( key )
+    if cached is not None:
+        # Negative entries are cached as False
+        return cached if cached is not False else None
+
+    # A token revoked while we look it up must not be cached afterwards
+    generation = cache.generation()
+    is_own_session = session is None
+    if is_own_session:
+        session = get_session()
+    stmt = select(
+        OauthToken.member_id,
+        OauthToken.expiration_date,
+    ).where(
+        OauthToken.token == token_str
+    )
+    token = session.execute( stmt ).one_or_none()
+    if is_own_session:
+        session.close()
+
+    conf = _token_conf()
+    ttl_seconds = conf.get( 'ttl_seconds', DEFAULT_TTL_SECONDS )
+    negative_ttl_seconds = conf.get(
+        'negative_ttl_seconds',
+        DEFAULT_NEGATIVE_TTL_SECONDS,
+    )
+
+    remaining = seconds_until( token.expiration_date ) if token else 0
+    if remaining <= 0:
+        cache.set( key, False, negative_ttl_seconds, generation )
+        return None
+
+    cache.set( key, token.member_id, min( ttl_seconds, remaining ),
+        generation )
+    return token.member_id
+
+def invalidate_token( token_str ):
+    """Drop any cached result for the token"""
+    if __TOKEN_CACHE is not None:
+        __TOKEN_CACHE.discard( token_digest( token_str ) )
+
+
+def _basic_auth_conf():
+    basic_auth_conf = Doorbot.Config.get( 'basic_auth', {} )
+    return basic_auth_conf.get( 'cache' ) or {}
+
+def credential_digest( username, password ):
+    """Keyed digest of a username and password"""
+    msg = username.encode( 'utf-8' ) + b'\0' + password.encode( 'utf-8' )
+    return hmac.new( __CREDENTIAL_KEY, msg, hashlib.sha256 ).digest()
+
+def get_credential_cache():
+    """Get the cache of verified HTTP Basic logins for this process"""
+    global __CREDENTIAL_CACHE
+
+    if __CREDENTIAL_CACHE is None:
+        __CREDENTIAL_CACHE = TTLCache(
+            max_size = _basic_auth_conf().get( 'max_size', DEFAULT_MAX_SIZE ),
+        )
+
+    _clear_on_new_engine()
+    return __CREDENTIAL_CACHE
+
+def verify_credentials( username, password, session = None ):
+    """Check a username and password
+
+    Returns true if the password is correct for that username. Passwords
+    that have been verified recently are checked against the cache instead
+    of the stored password. If a session is passed, it's used for any query
+    that needs to be made.
+    """
+    cache = get_credential_cache()
+    digest = credential_digest( username, password )
+
+    cached = cache.get( username )
+    if cached is not None and hmac.compare_digest( cached, digest ):
+        return True
+
+    # Nor a password changed while we check it
+    generation = cache.generation()
+    is_own_session = session is None
+    if is_own_session:
+        session = get_session()
+    member = Member.get_by_username( username, session )
+    is_valid = member is not None \
+        and member.check_password( password, session )
+    if is_own_session:
+        session.close()
+
+    if is_valid:
+        cache.set(
+            username,
+            digest,
+            _basic_auth_conf().get(
+                'ttl_seconds',
+                DEFAULT_BASIC_AUTH_TTL_SECONDS,
+            ),
+            generation,
+        )
+
+    return is_valid
+
+def invalidate_credentials( username = None ):
+    """Drop the cached login for a username, or every login if not given"""
+    if __CREDENTIAL_CACHE is None:
+        return
+
+    if username is None:
+        __CREDENTIAL_CACHE.clear()
+    else:
+        __CREDENTIAL_CACHE.discard( username )
+
+
+#
+# Evict tokens and logins when they're created, changed, or revoked
+#
+def _changed_values( obj, attr ):
+    """All values an attribute held during a flush, or None if not loaded"""
+    history = getattr( inspect( obj ).attrs, attr ).history
+    values = [ value for value in history.sum() if value is not None ]
+    return values if values else None
+
+@event.listens_for( Session, "after_flush" )
+def _track_flush( session, flush_context ):
+    for obj in itertools.chain( session.new, session.dirty, session.deleted ):
+        if isinstance( obj, OauthToken ):
+            tokens = session.info.setdefault( 'auth_cache_tokens', set() )
+            # None means we can't tell which token it was, so evict all
+            tokens.update( _changed_values( obj, 'token' ) or [ None ] )
+        elif isinstance( obj, Member ):
+            if obj in session.new:
+                continue
+            usernames = session.info.setdefault( 'auth_cache_usernames', set() )
+            usernames.update( _changed_values( obj, 'username' ) or [ None ] )
+
+@event.listens_for( Session, "before_commit" )
+def _publish_changes( session ):
+    # Changes still waiting to be flushed need to be seen now
+    session.flush()
+
+    tokens = session.info.get( 'auth_cache_tokens', () )
+    usernames = session.info.get( 'auth_cache_usernames', () )
+    if tokens or usernames:
+        Doorbot.InvalidationBus.publish( session, BUS_TOPIC, {
+            "tokens": [
+                token_digest( token_str ).hex() if token_str else None
+                for token_str in tokens
+            ],
+            "usernames": list( usernames ),
+        })
+
+@event.listens_for( Session, "after_commit" )
+def _apply_changes( session ):
+    for token_str in session.info.pop( 'auth_cache_tokens', () ):
+        if token_str is None:
+            if __TOKEN_CACHE is not None:
+                __TOKEN_CACHE.clear()
+        else:
+            invalidate_token( token_str )
+
+    for username in session.info.pop( 'auth_cache_usernames', () ):
+        invalidate_credentials( username )
+
+@event.listens_for( Session, "after_rollback" )
+def _discard_changes( session ):
+    session.info.pop( 'auth_cache_tokens', None )
+    session.info.pop( 'auth_cache_usernames', None )
+
+
+#
+# Hear about commits made by other processes
+#
+def _apply_remote_changes( data ):
+    if data is None:
+        if __TOKEN_CACHE is not None:
+            __TOKEN_CACHE.clear()
+        invalidate_credentials()
+        return
+
+    for digest in data.get( "tokens", () ):
+        if __TOKEN_CACHE is None:
+            break
+        if digest is None:
+            __TOKEN_CACHE.clear()
+        else:
+            __TOKEN_CACHE.discard( bytes.fromhex( digest ) )
+
+    for username in data.get( "usernames", () ):
+        invalidate_credentials( username )
+
+Doorbot.InvalidationBus.add_listener( BUS_TOPIC, _apply_remote_changes )
@@ -5,6 +5,7 @@ import pathlib
 CONF_FILE = "config.yml"
 CONF = {}
 INIT = False
+_REQUIRED = object()
 
 
 def init(
@@ -19,14 +20,23 @@ def init(
 
     yaml_input = pathlib.Path( full_conf_path ).read_text()
     global CONF
+    global INIT
     CONF = load( yaml_input, Loader = Loader )
 
     INIT = True
 
 
 def get(
-    name: str
+    name: str,
+    default = _REQUIRED,
 ):
+    """Fetch a top level config section
+
+    If a default is passed, it's returned when the section is missing.
+    Otherwise, a missing section is an error.
+    """
     if not INIT:
         init()
+    if default is not _REQUIRED:
+        return CONF.get( name ) or default
     return CONF[ name ]
@@ -0,0 +1,153 @@
+"""Monthly partitions for the entry log on PostgreSQL
+
+The entry_log table is partitioned by range on entry_time, one partition per
+month, named like 'entry_log_y2024m03'. maintain() makes sure partitions
+exist for the current month and 'entry_log.partitions.months_ahead' months
+after it, and applies the retention setting to old ones.
+
+Partitions that end more than 'entry_log.partitions.retention_months' ago are
+handled according to 'entry_log.partitions.retention_action':
+
+    archive   Detach and move to the entry_log_archive schema (the default)
+    drop      Detach and drop
+    keep      Leave them alone
+
+Rows that come in for a month with no partition yet go to entry_log_default.
+Creating that month's partition moves them over.
+
+Other databases don't support partitioning, so this does nothing for them.
+"""
+import logging
+import re
+import Doorbot.Config
+from datetime import date, datetime, timezone
+from Doorbot.SQLAlchemy import get_engine
+from sqlalchemy import text
+
+
+DEFAULT_MONTHS_AHEAD = 3
+DEFAULT_RETENTION_MONTHS = 24
+DEFAULT_RETENTION_ACTION = "archive"
+RETENTION_ACTIONS = ( "archive", "drop", "keep" )
+ARCHIVE_SCHEMA = "entry_log_archive"
+
+MATCH_PARTITION = re.compile( r'^entry_log_y(\d{4})m(\d{2})$' )
+
+LOGGER = logging.getLogger( __name__ )
+
+
+def month_start( when ):
+    """First day of the month the date or datetime falls in"""
+    return date( when.year, when.month, 1 )
+
+def add_months( month, count ):
+    """First day of the month 'count' months after the given one"""
+    index = month.year * 12 + month.month - 1 + count
+    return date( index // 12, index % 12 + 1, 1 )
+
+def partition_name( month ):
+    return "entry_log_y%04dm%02d" % ( month.year, month.month )
+
+def partition_month( name ):
+    """Month a partition is for, or None if it's not a monthly partition"""
+    match = MATCH_PARTITION.match( name )
+    if not match:
+        return None
+    return date( int( match.group( 1 ) ), int( match.group( 2 ) ), 1 )
+
+def list_partitions( conn ):
+    """Names of the monthly partitions currently attached to entry_log"""
+    rows = conn.execute( text( """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+        JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+        WHERE parent.relname = 'entry_log'
+    """ ) ).scalars()
+    return sorted( name for name in rows if partition_month( name ) )
+
+def create_partition( conn, month ):
+    """Create and attach the partition for a month
+
+    Rows for that month that ended up in the default partition are moved
+    into it first, since attaching would fail otherwise.
+    """
+    name = partition_name( month )
+    lower = month.isoformat()
+    upper = add_months( month, 1 ).isoformat()
+
+    conn.execute( text(
+        f"CREATE TABLE {name} "
+        "( LIKE entry_log INCLUDING DEFAULTS INCLUDING CONSTRAINTS )"
+    ) )
+    conn.execute( text( f"""
+        WITH moved AS (
+            DELETE FROM entry_log_default
+            WHERE entry_time >= :lower AND entry_time < :upper
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """ ), {
+        "lower": lower,
+        "upper": upper,
+    })
+    conn.execute( text(
+        f"ALTER TABLE entry_log ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ('{lower}') TO ('{upper}')"
+    ) )
+    LOGGER.info( "Created entry log partition %s", name )
+
+def retire_partition( conn, name, action ):
+    """Detach an old partition, and then archive or drop it"""
+    conn.execute( text( f"ALTER TABLE entry_log DETACH PARTITION {name}" ) )
+    if action == "drop":
+        conn.execute( text( f"DROP TABLE {name}" ) )
+    else:
+        conn.execute( text( f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}" ) )
+        conn.execute( text( f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}" ) )
+    LOGGER.info( "Retired entry log partition %s (%s)", name, action )
+
+def _conf():
+    entry_log_conf = Doorbot.Config.get( 'entry_log', {} )
+    return entry_log_conf.get( 'partitions' ) or {}
+
+def maintain( now = None, engine = None ):
+    """Create upcoming partitions and retire old ones
+
+    Returns a tuple of the names of partitions created and retired. Safe to
+    run any number of times, from any process.
+    """
+    engine = engine or get_engine()
+    if engine.dialect.name != "postgresql":
+        return ( [], [] )
+
+    conf = _conf()
+    months_ahead = conf.get( 'months_ahead', DEFAULT_MONTHS_AHEAD )
+    retention_months = conf.get( 'retention_months', DEFAULT_RETENTION_MONTHS )
+    action = conf.get( 'retention_action', DEFAULT_RETENTION_ACTION )
+    if action not in RETENTION_ACTIONS:
+        raise ValueError( "Unknown retention_action: " + str( action ) )
+
+    this_month = month_start( now or datetime.now( timezone.utc ) )
+    created = []
+    retired = []
+    with engine.begin() as conn:
+        # Only one process does maintenance at a time
+        conn.execute( text( "LOCK TABLE entry_log_default IN EXCLUSIVE MODE" ) )
+        existing = set( list_partitions( conn ) )
+
+        for count in range( 0, months_ahead + 1 ):
+            month = add_months( this_month, count )
+            if partition_name( month ) not in existing:
+                create_partition( conn, month )
+                created.append( partition_name( month ) )
+
+        if action != "keep":
+            cutoff = add_months( this_month, -retention_months )
+            for name in sorted( existing ):
+                # A partition ends at the start of the next month
+                if add_months( partition_month( name ), 1 ) <= cutoff:
+                    retire_partition( conn, name, action )
+                    retired.append( name )
+
+    return ( created, retired )
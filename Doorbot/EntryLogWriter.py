@@ -0,0 +1,226 @@
+"""Write-behind queue for the entry log
+
+Scans are put on a bounded in-process queue and a background thread inserts
+them in batches, so a doorbot gets its answer without waiting on the insert.
+A batch is written once it reaches 'batch_size' rows, or once its oldest row
+has waited 'flush_interval_seconds'.
+
+When the queue is full, callers wait up to 'enqueue_timeout_seconds' for
+room, and then write their row directly. Anything left in the queue is
+written out at exit.
+
+Each batch also updates the scan statistics rollups (see Doorbot.ScanStats)
+in the same transaction, unless 'scan_stats.enabled' is off.
+
+In-memory SQLite databases only exist on the connection that made them, so
+a background thread can't see them. For those, rows are written right away.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+import Doorbot.Config
+import Doorbot.ScanStats
+from datetime import datetime, timezone
+from Doorbot.SQLAlchemy import EntryLog
+from Doorbot.SQLAlchemy import get_engine
+from sqlalchemy import insert
+
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL_SECONDS = 1.0
+DEFAULT_MAX_QUEUE_SIZE = 10000
+DEFAULT_ENQUEUE_TIMEOUT_SECONDS = 0.5
+MAX_WRITE_ATTEMPTS = 3
+
+LOGGER = logging.getLogger( __name__ )
+
+__WRITER = None
+
+
+class EntryLogWriter:
+    """Batches entry log rows and inserts them from a background thread"""
+
+    def __init__(
+        self,
+        batch_size = DEFAULT_BATCH_SIZE,
+        flush_interval_seconds = DEFAULT_FLUSH_INTERVAL_SECONDS,
+        max_queue_size = DEFAULT_MAX_QUEUE_SIZE,
+        enqueue_timeout_seconds = DEFAULT_ENQUEUE_TIMEOUT_SECONDS,
+        write_behind = True,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.enqueue_timeout_seconds = enqueue_timeout_seconds
+        self.write_behind = write_behind
+        self._queue = queue.Queue( maxsize = max_queue_size )
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def log(
+        self,
+        rfid,
+        location_id,
+        is_active_tag,
+        is_found_tag,
+        entry_time = None,
+    ):
+        """Queue up a scan to be written to the entry log"""
+        row = {
+            "rfid": rfid,
+            "location": location_id,
+            "is_active_tag": is_active_tag,
+            "is_found_tag": is_found_tag,
+            # Set the time now, rather than when the batch gets written
+            "entry_time": entry_time or datetime.now( timezone.utc ),
+        }
+
+        if not self._use_background_thread():
+            self._write([ row ])
+            return
+
+        self._ensure_started()
+        try:
+            self._queue.put( row, timeout = self.enqueue_timeout_seconds )
+        except queue.Full:
+            LOGGER.warning( "Entry log queue is full, writing directly" )
+            self._write([ row ])
+
+    def flush( self ):
+        """Write out everything in the queue from the calling thread"""
+        while True:
+            batch = self._take_batch( block = False )
+            if not batch:
+                return
+            self._write( batch )
+
+    def stop( self ):
+        """Stop the background thread and write out anything left"""
+        self._stopping.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join()
+        self._thread = None
+        self.flush()
+
+    def pending( self ):
+        """Number of rows waiting to be written"""
+        return self._queue.qsize()
+
+    def _use_background_thread( self ):
+        if not self.write_behind:
+            return False
+        url = get_engine().url
+        is_memory_db = url.get_backend_name() == "sqlite" \
+            and url.database in ( None, "", ":memory:" )
+        return not is_memory_db
+
+    def _ensure_started( self ):
+        # Threads don't survive a fork, so a forked worker needs its own
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid:
+            return
+
+        with self._lock:
+            if self._thread is not None and self._pid == pid:
+                return
+
+            self._stopping.clear()
+            self._pid = pid
+            self._thread = threading.Thread(
+                target = self._run,
+                name = "entry-log-writer",
+                daemon = True,
+            )
+            self._thread.start()
+
+    def _run( self ):
+        while not self._stopping.is_set():
+            batch = self._take_batch( block = True )
+            if batch:
+                self._write( batch )
+
+    def _take_batch( self, block ):
+        batch = []
+        deadline = None
+        while len( batch ) < self.batch_size:
+            try:
+                if not block:
+                    row = self._queue.get_nowait()
+                elif deadline is None:
+                    # Wake up now and then to see if we're stopping
+                    row = self._queue.get(
+                        timeout = self.flush_interval_seconds
+                    )
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    row = self._queue.get( timeout = remaining )
+            except queue.Empty:
+                break
+
+            batch.append( row )
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval_seconds
+
+        return batch
+
+    def _write( self, batch ):
+        for attempt in range( 1, MAX_WRITE_ATTEMPTS + 1 ):
+            try:
+                with get_engine().begin() as conn:
+                    conn.execute( insert( EntryLog ), batch )
+                    if Doorbot.ScanStats.is_enabled():
+                        self._record_stats( conn, batch )
+                return
+            except Exception:
+                LOGGER.exception(
+                    "Failed to write %d entry log rows (attempt %d of %d)",
+                    len( batch ),
+                    attempt,
+                    MAX_WRITE_ATTEMPTS,
+                )
+                time.sleep( 0.1 * attempt )
+
+        LOGGER.error( "Dropped %d entry log rows", len( batch ) )
+
+    def _record_stats( self, conn, batch ):
+        # In a savepoint, so the scans are still written if the rollups fail
+        try:
+            with conn.begin_nested():
+                Doorbot.ScanStats.record( conn, batch )
+        except Exception:
+            LOGGER.exception( "Failed to update scan stats for %d entry log"
+                " rows; fix them with rebuild_scan_stats.py", len( batch ) )
+
+
+def get_writer():
+    """Get the entry log writer for this process"""
+    global __WRITER
+
+    if __WRITER is None:
+        conf = Doorbot.Config.get( 'entry_log', {} )
+        __WRITER = EntryLogWriter(
+            batch_size = conf.get( 'batch_size', DEFAULT_BATCH_SIZE ),
+            flush_interval_seconds = conf.get(
+                'flush_interval_seconds',
+                DEFAULT_FLUSH_INTERVAL_SECONDS,
+            ),
+            max_queue_size = conf.get(
+                'max_queue_size',
+                DEFAULT_MAX_QUEUE_SIZE,
+            ),
+            enqueue_timeout_seconds = conf.get(
+                'enqueue_timeout_seconds',
+                DEFAULT_ENQUEUE_TIMEOUT_SECONDS,
+            ),
+            write_behind = conf.get( 'write_behind', True ),
+        )
+        atexit.register( __WRITER.stop )
+
+    return __WRITER
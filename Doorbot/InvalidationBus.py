@@ -0,0 +1,329 @@
+"""Tells other processes when cached data has changed
+
+Caches like Doorbot.AccessIndex and Doorbot.AuthCache hear about commits made
+by their own process right away, but uwsgi runs several worker processes,
+possibly on several hosts. Code that changes cached data calls publish()
+before its commit, naming a topic and saying which keys changed. Every
+process runs a listener thread that passes the message on to the functions
+registered for that topic with add_listener().
+
+On PostgreSQL, publish() sends a NOTIFY in the same transaction, so it's only
+delivered if the commit goes through. The listener thread keeps its own
+connection open with LISTEN. Messages are limited to about 8000 bytes, so a
+bigger one is sent with its data left out, which listeners take to mean
+everything changed.
+
+SQLite has no NOTIFY. There, publish() bumps the counter in the
+'cache_generation' table, and the listener thread checks it every
+'invalidation_bus.poll_interval_seconds'. When someone else bumps it,
+listeners are told everything changed, since there's no saying what.
+
+Listeners are also told everything changed after the PostgreSQL connection
+is lost and made again, since messages may have been missed in between.
+Messages sent by a process aren't passed back to its own listeners, which
+already heard about the commit from the ORM.
+
+Turn it off with 'invalidation_bus.enabled'.
+"""
+import json
+import logging
+import os
+import select
+import threading
+import uuid
+import Doorbot.Config
+from Doorbot.SQLAlchemy import cache_generation_table
+from Doorbot.SQLAlchemy import get_engine
+from sqlalchemy import event
+from sqlalchemy import insert
+from sqlalchemy import select as sql_select
+from sqlalchemy import text
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+
+DEFAULT_POLL_INTERVAL_SECONDS = 1.0
+CHANNEL = "doorbot_invalidate"
+# PostgreSQL refuses NOTIFY payloads of 8000 bytes or more
+MAX_PAYLOAD_BYTES = 7900
+RECONNECT_SECONDS = 5
+
+LISTENERS = {}
+
+LOGGER = logging.getLogger( __name__ )
+
+__BUS = None
+# Set once per host. The process id tells apart workers forked from the same
+# master, which uwsgi does from C without running Python's at-fork hooks.
+__HOST_ID = uuid.uuid4().hex
+
+
+def sender_id():
+    """Identifies messages sent by this process"""
+    return __HOST_ID + "-" + str( os.getpid() )
+
+
+def add_listener( topic, func ):
+    """Call func with the data of each message on the topic from elsewhere
+
+    The data is None when everything should be considered changed.
+    """
+    LISTENERS.setdefault( topic, [] ).append( func )
+    return func
+
+def dispatch( topic, data ):
+    """Pass a message to the listeners for its topic"""
+    for func in LISTENERS.get( topic, () ):
+        try:
+            func( data )
+        except Exception:
+            LOGGER.exception( "Listener for %s failed", topic )
+
+def reset_all():
+    """Tell every listener that everything changed"""
+    for topic in list( LISTENERS ):
+        dispatch( topic, None )
+
+def is_enabled():
+    conf = Doorbot.Config.get( 'invalidation_bus', {} )
+    return conf.get( 'enabled', True )
+
+def encode_message( topic, data ):
+    """JSON payload for a message, leaving out data that won't fit"""
+    payload = json.dumps({
+        "sender": sender_id(),
+        "topic": topic,
+        "data": data,
+    })
+    if len( payload.encode( 'utf-8' ) ) > MAX_PAYLOAD_BYTES:
+        payload = json.dumps({
+            "sender": sender_id(),
+            "topic": topic,
+            "data": None,
+        })
+    return payload
+
+def bump_generation( session ):
+    """Increment the cache generation in the session's transaction
+
+    Returns the new generation.
+    """
+    result = session.execute(
+        update( cache_generation_table ).where(
+            cache_generation_table.c.id == 1
+        ).values(
+            generation = cache_generation_table.c.generation + 1
+        )
+    )
+    if result.rowcount == 0:
+        session.execute(
+            insert( cache_generation_table ).values( id = 1, generation = 1 )
+        )
+    return current_generation( session )
+
+def current_generation( conn ):
+    generation = conn.scalar(
+        sql_select( cache_generation_table.c.generation ).where(
+            cache_generation_table.c.id == 1
+        )
+    )
+    return generation if generation is not None else 0
+
+def publish( session, topic, data = None ):
+    """Tell other processes about a change, once the session commits
+
+    Call this before the commit, such as from a 'before_commit' event.
+    """
+    if not is_enabled():
+        return
+
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(
+            text( "SELECT pg_notify( :channel, :payload )" ),
+            {
+                "channel": CHANNEL,
+                "payload": encode_message( topic, data ),
+            },
+        )
+    else:
+        generations = session.info.setdefault( 'invalidation_bus', [] )
+        generations.append( bump_generation( session ) )
+
+
+class InvalidationBus:
+    """Listens for messages from other processes"""
+
+    def __init__(
+        self,
+        poll_interval_seconds = DEFAULT_POLL_INTERVAL_SECONDS,
+    ):
+        self.poll_interval_seconds = poll_interval_seconds
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._engine = None
+        self._generation = None
+        self._own_generations = set()
+
+    def handle( self, payload ):
+        """Pass on a message received from PostgreSQL"""
+        try:
+            message = json.loads( payload )
+        except ValueError:
+            LOGGER.warning( "Ignoring bad message: %s", payload )
+            return
+
+        if message.get( "sender" ) == sender_id():
+            return
+        dispatch( message.get( "topic" ), message.get( "data" ) )
+
+    def add_own_generations( self, generations ):
+        """Note generations bumped by this process, so they're not resets"""
+        with self._lock:
+            self._own_generations.update( generations )
+
+    def poll_once( self ):
+        """Check the cache generation, for databases without NOTIFY
+
+        Returns true if someone else changed it, and listeners were told.
+        """
+        engine = get_engine()
+        with engine.connect() as conn:
+            generation = current_generation( conn )
+
+        with self._lock:
+            if self._engine is not engine:
+                # Start counting from wherever the new database is at
+                self._engine = engine
+                self._generation = generation
+                self._own_generations.clear()
+                return False
+
+            last = self._generation
+            if generation == last:
+                return False
+
+            self._generation = generation
+            is_own = all(
+                bumped in self._own_generations
+                for bumped in range( last + 1, generation + 1 )
+            )
+            self._own_generations = {
+                bumped for bumped in self._own_generations
+                if bumped > generation
+            }
+
+        if is_own:
+            return False
+        reset_all()
+        return True
+
+    def start( self ):
+        """Start the listener thread, if it isn't running in this process"""
+        url = get_engine().url
+        is_memory_db = url.get_backend_name() == "sqlite" \
+            and url.database in ( None, "", ":memory:" )
+        if not is_enabled() or is_memory_db:
+            # Nothing else can see an in-memory database
+            return
+
+        # Threads don't survive a fork, so a forked worker needs its own
+        pid = os.getpid()
+        with self._lock:
+            if self._thread is not None and self._pid == pid:
+                return
+
+            self._stopping.clear()
+            self._pid = pid
+            self._thread = threading.Thread(
+                target = self._run,
+                name = "invalidation-bus",
+                daemon = True,
+            )
+            self._thread.start()
+
+    def stop( self ):
+        """Stop the listener thread"""
+        self._stopping.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join()
+        self._thread = None
+
+    def _run( self ):
+        if get_engine().dialect.name == "postgresql":
+            run = self._listen
+        else:
+            run = self._poll
+
+        while not self._stopping.is_set():
+            try:
+                run()
+            except Exception:
+                LOGGER.exception( "Invalidation bus listener failed" )
+                self._stopping.wait( RECONNECT_SECONDS )
+
+    def _poll( self ):
+        self.poll_once()
+        self._stopping.wait( self.poll_interval_seconds )
+
+    def _listen( self ):
+        # A connection of our own, kept out of the pool, since it sits in
+        # LISTEN for as long as the process runs
+        raw = get_engine().raw_connection()
+        raw.detach()
+        conn = raw.driver_connection
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute( "LISTEN " + CHANNEL )
+
+            # Anything sent before now was missed
+            reset_all()
+
+            while not self._stopping.is_set():
+                readable, _, _ = select.select(
+                    [ conn ], [], [], self.poll_interval_seconds )
+                if not readable:
+                    continue
+
+                conn.poll()
+                while conn.notifies:
+                    self.handle( conn.notifies.pop( 0 ).payload )
+        finally:
+            raw.close()
+
+
+def get_bus():
+    """Get the invalidation bus for this process"""
+    global __BUS
+
+    if __BUS is None:
+        conf = Doorbot.Config.get( 'invalidation_bus', {} )
+        __BUS = InvalidationBus(
+            poll_interval_seconds = conf.get(
+                'poll_interval_seconds',
+                DEFAULT_POLL_INTERVAL_SECONDS,
+            ),
+        )
+
+    return __BUS
+
+def start():
+    """Start listening for messages from other processes"""
+    get_bus().start()
+
+
+#
+# Generations bumped by our own commits aren't news to us
+#
+@event.listens_for( Session, "after_commit" )
+def _note_own_generations( session ):
+    generations = session.info.pop( 'invalidation_bus', None )
+    if generations:
+        get_bus().add_own_generations( generations )
+
+@event.listens_for( Session, "after_rollback" )
+def _discard_generations( session ):
+    session.info.pop( 'invalidation_bus', None )
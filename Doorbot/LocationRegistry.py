@@ -0,0 +1,181 @@
+"""In-memory registry of locations
+
+Locations rarely change, so they're loaded once and kept in memory. Any ORM
+commit that touches a location, including bulk deletes, reloads the registry
+on the next lookup. It's also reloaded once it gets older than
+'locations.max_age_seconds', or when a name isn't found and the last reload
+was over 'locations.miss_reload_seconds' ago, so locations added by other
+processes show up even if their message on Doorbot.InvalidationBus is lost.
+"""
+import threading
+import time
+import Doorbot.Config
+import Doorbot.InvalidationBus
+from collections import namedtuple
+from Doorbot.SQLAlchemy import Location
+from Doorbot.SQLAlchemy import get_engine
+from Doorbot.SQLAlchemy import get_session
+from sqlalchemy import event
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+
+DEFAULT_MAX_AGE_SECONDS = 300
+DEFAULT_MISS_RELOAD_SECONDS = 5
+BUS_TOPIC = "locations"
+
+LocationInfo = namedtuple( 'LocationInfo', [
+    'id',
+    'name',
+    'hostname',
+])
+"""Details of a single location"""
+
+__REGISTRY = None
+
+
+class LocationRegistry:
+    """Maps location names to their LocationInfo"""
+
+    def __init__(
+        self,
+        max_age_seconds = DEFAULT_MAX_AGE_SECONDS,
+        miss_reload_seconds = DEFAULT_MISS_RELOAD_SECONDS,
+    ):
+        self.max_age_seconds = max_age_seconds
+        self.miss_reload_seconds = miss_reload_seconds
+        self._lock = threading.Lock()
+        self._engine = None
+        self._by_name = None
+        self._loaded_at = 0
+        self._generation = 0
+
+    def lookup( self, name ):
+        """Returns the LocationInfo for the name, or None if not found"""
+        location = self._current().get( name )
+        if location is None \
+            and time.monotonic() - self._loaded_at > self.miss_reload_seconds:
+            self.invalidate()
+            location = self._current().get( name )
+
+        return location
+
+    def get_id( self, name ):
+        """Returns the id of the named location, or None if not found"""
+        location = self.lookup( name )
+        return location.id if location else None
+
+    def names( self ):
+        """Names of all locations, in the order they were added"""
+        return [ location.name for location in self._current().values() ]
+
+    def generation( self ):
+        """Number that goes up each time the locations are reloaded"""
+        self._current()
+        return self._generation
+
+    def invalidate( self ):
+        """Reload on the next lookup"""
+        with self._lock:
+            self._by_name = None
+
+    def _is_current( self, engine ):
+        age = time.monotonic() - self._loaded_at
+        return self._by_name is not None \
+            and self._engine is engine \
+            and age < self.max_age_seconds
+
+    def _current( self ):
+        engine = get_engine()
+        by_name = self._by_name
+        if by_name is not None and self._is_current( engine ):
+            return by_name
+
+        with self._lock:
+            if not self._is_current( engine ):
+                stmt = select(
+                    Location.id,
+                    Location.name,
+                    Location.hostname,
+                ).order_by( Location.id )
+
+                session = get_session()
+                self._by_name = {
+                    row.name: LocationInfo( *row )
+                    for row in session.execute( stmt )
+                }
+                session.close()
+
+                self._engine = engine
+                self._loaded_at = time.monotonic()
+                self._generation += 1
+
+            return self._by_name
+
+
+def get_registry():
+    """Get the location registry for this process"""
+    global __REGISTRY
+
+    if __REGISTRY is None:
+        conf = Doorbot.Config.get( 'locations', {} )
+        __REGISTRY = LocationRegistry(
+            max_age_seconds = conf.get(
+                'max_age_seconds',
+                DEFAULT_MAX_AGE_SECONDS,
+            ),
+            miss_reload_seconds = conf.get(
+                'miss_reload_seconds',
+                DEFAULT_MISS_RELOAD_SECONDS,
+            ),
+        )
+
+    return __REGISTRY
+
+
+#
+# Watch ORM changes so the registry can be kept current
+#
+@event.listens_for( Session, "after_flush" )
+def _track_flush( session, flush_context ):
+    for obj in [ *session.new, *session.dirty, *session.deleted ]:
+        if isinstance( obj, Location ):
+            session.info[ 'location_registry_changed' ] = True
+            return
+
+@event.listens_for( Session, "do_orm_execute" )
+def _track_bulk_execute( orm_execute_state ):
+    if not ( orm_execute_state.is_update or orm_execute_state.is_delete ):
+        return
+
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None and mapper.class_ is Location:
+        orm_execute_state.session.info[ 'location_registry_changed' ] = True
+
+@event.listens_for( Session, "before_commit" )
+def _publish_changes( session ):
+    # Changes still waiting to be flushed need to be seen now
+    session.flush()
+
+    if session.info.get( 'location_registry_changed' ):
+        Doorbot.InvalidationBus.publish( session, BUS_TOPIC )
+
+@event.listens_for( Session, "after_commit" )
+def _apply_changes( session ):
+    is_changed = session.info.pop( 'location_registry_changed', False )
+    if is_changed and __REGISTRY is not None:
+        __REGISTRY.invalidate()
+
+@event.listens_for( Session, "after_rollback" )
+def _discard_changes( session ):
+    session.info.pop( 'location_registry_changed', None )
+
+
+#
+# Hear about commits made by other processes
+#
+def _apply_remote_changes( data ):
+    if __REGISTRY is not None:
+        __REGISTRY.invalidate()
+
+Doorbot.InvalidationBus.add_listener( BUS_TOPIC, _apply_remote_changes )
@@ -0,0 +1,192 @@
+"""Client for the MemberPress members API
+
+Used by the scripts that compare MemberPress with the members table. All
+requests go through one requests.Session, so connections are kept alive
+between pages.
+
+The first page is fetched on its own. If the response says how many pages
+there are, the rest are fetched at once, up to 'memberpress.max_workers' at
+a time. Otherwise, pages are fetched 'max_workers' at a time until one comes
+back short, since a short page is the only sign of the end of the list.
+WordPress answers pages past the end with a 400, which is taken as an empty
+page there.
+
+Connection errors, timeouts, and 429 and 5xx responses are retried up to
+'memberpress.max_retries' times, waiting 'memberpress.backoff_seconds'
+before the first retry and twice as long before each one after.
+"""
+import itertools
+import logging
+import threading
+import time
+import requests
+import Doorbot.Config
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+
+DEFAULT_PER_PAGE = 100
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_SECONDS = 1.0
+DEFAULT_TIMEOUT_SECONDS = 30
+
+MEMBERS_PATH = '/wp-json/mp/v1/members'
+RETRY_STATUSES = ( 429, 500, 502, 503, 504 )
+# What WordPress sends for a page past the end of the list
+PAST_END_STATUS = 400
+
+LOGGER = logging.getLogger( __name__ )
+
+__CLIENT = None
+
+
+class MemberPressError( Exception ):
+    """Raised when a page can't be fetched"""
+    pass
+
+
+class MemberPressClient:
+    """Fetches members from MemberPress"""
+
+    def __init__(
+        self,
+        base_url,
+        user,
+        passwd,
+        per_page = DEFAULT_PER_PAGE,
+        max_workers = DEFAULT_MAX_WORKERS,
+        max_retries = DEFAULT_MAX_RETRIES,
+        backoff_seconds = DEFAULT_BACKOFF_SECONDS,
+        timeout_seconds = DEFAULT_TIMEOUT_SECONDS,
+    ):
+        self.members_url = base_url + MEMBERS_PATH
+        self.per_page = per_page
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.timeout_seconds = timeout_seconds
+
+        self.session = requests.Session()
+        self.session.auth = ( user, passwd )
+        # Room in the pool for a connection per worker
+        adapter = HTTPAdapter( pool_maxsize = max( max_workers, 1 ) )
+        self.session.mount( 'http://', adapter )
+        self.session.mount( 'https://', adapter )
+
+    def _get( self, page, is_past_end_ok = False ):
+        params = {
+            'page': page,
+            'per_page': self.per_page,
+        }
+        for attempt in range( self.max_retries + 1 ):
+            if attempt:
+                time.sleep( self.backoff_seconds * 2 ** ( attempt - 1 ) )
+
+            try:
+                response = self.session.get(
+                    self.members_url,
+                    params = params,
+                    timeout = self.timeout_seconds,
+                )
+            except ( requests.ConnectionError, requests.Timeout ) as e:
+                error = str( e )
+            else:
+                if response.status_code == 200:
+                    return response
+                if is_past_end_ok \
+                    and response.status_code == PAST_END_STATUS:
+                    return None
+                error = f"status {response.status_code}"
+                if response.status_code not in RETRY_STATUSES:
+                    break
+
+            LOGGER.warning( "Fetching page %d failed (attempt %d of %d): %s",
+                page, attempt + 1, self.max_retries + 1, error )
+
+        raise MemberPressError( f"Could not fetch page {page}: {error}" )
+
+    def fetch_page( self, page ):
+        """List of members on a page, starting from page 1"""
+        return self._get( page ).json()
+
+    def fetch_all_members( self, progress = None ):
+        """List of all members, in page order
+
+        If given, progress is called with each page number once it's fetched.
+        """
+        lock = threading.Lock()
+
+        def fetch( page, is_past_end_ok = False ):
+            response = self._get( page, is_past_end_ok )
+            members = response.json() if response is not None else []
+            if progress is not None:
+                with lock:
+                    progress( page )
+            return members
+
+        response = self._get( 1 )
+        first = response.json()
+        if progress is not None:
+            progress( 1 )
+        pages = [ first ]
+        if len( first ) != self.per_page:
+            return first
+
+        total_pages = response.headers.get( 'X-WP-TotalPages' )
+        with ThreadPoolExecutor( max_workers = self.max_workers ) as pool:
+            if total_pages is not None and total_pages.isdigit():
+                pages.extend( pool.map(
+                    fetch,
+                    range( 2, int( total_pages ) + 1 ),
+                ) )
+            else:
+                next_page = 2
+                is_still_more = True
+                while is_still_more:
+                    batch = range( next_page, next_page + self.max_workers )
+                    # Some of these may be past the end
+                    for members in pool.map(
+                        lambda page: fetch( page, is_past_end_ok = True ),
+                        batch,
+                    ):
+                        pages.append( members )
+                        if len( members ) != self.per_page:
+                            # If we didn't get as many members as expected,
+                            # assume we've reached the end of the list.
+                            # Unfortunately, the MemberPress API doesn't have
+                            # any other way for us to know this.
+                            is_still_more = False
+                            break
+                    next_page += self.max_workers
+
+        return list( itertools.chain.from_iterable( pages ) )
+
+    def close( self ):
+        self.session.close()
+
+
+def get_client():
+    """Get the MemberPress client, set up from 'memberpress' in the config"""
+    global __CLIENT
+
+    if __CLIENT is None:
+        conf = Doorbot.Config.get( 'memberpress' )
+        __CLIENT = MemberPressClient(
+            base_url = conf[ 'base_url' ],
+            user = conf[ 'user' ],
+            passwd = conf[ 'passwd' ],
+            per_page = conf.get( 'per_page', DEFAULT_PER_PAGE ),
+            max_workers = conf.get( 'max_workers', DEFAULT_MAX_WORKERS ),
+            max_retries = conf.get( 'max_retries', DEFAULT_MAX_RETRIES ),
+            backoff_seconds = conf.get(
+                'backoff_seconds',
+                DEFAULT_BACKOFF_SECONDS,
+            ),
+            timeout_seconds = conf.get(
+                'timeout_seconds',
+                DEFAULT_TIMEOUT_SECONDS,
+            ),
+        )
+
+    return __CLIENT
@@ -0,0 +1,212 @@
+"""Versioned schema changes
+
+Each migration has a version number, a name, and a function that takes a
+connection and makes the change. The 'schema_migrations' table records which
+versions have been applied, so upgrade() only runs the ones that haven't.
+Each migration runs in its own transaction along with its record, so a
+failure leaves the database at the last version that worked.
+
+On PostgreSQL, a migration made with 'in_transaction = False' runs outside
+of any transaction instead, so it can use CREATE INDEX CONCURRENTLY and
+scans keep being written while indexes are built on the live tables. Those
+have to be written so a failure part way through can simply be run again.
+
+Migrations run on both PostgreSQL and SQLite, and can check
+'conn.dialect.name' for the odd statement that differs between them. Write
+them so they still work on a database that already has the change, since
+older databases may have had it applied by hand.
+
+Schema changes from before this existed are in sql/changes_pg.sql. New ones
+go at the end of MIGRATIONS.
+"""
+import logging
+from collections import namedtuple
+from datetime import datetime, timezone
+from Doorbot.SQLAlchemy import get_engine
+from Doorbot.SQLAlchemy import schema_migrations_table
+from sqlalchemy import insert
+from sqlalchemy import select
+from sqlalchemy import text
+
+
+Migration = namedtuple( 'Migration', [
+    'version',
+    'name',
+    'upgrade',
+    'in_transaction',
+], defaults = [ True ] )
+"""A single schema change"""
+
+# Any constant works, as long as nothing else takes the same advisory lock
+PG_LOCK_ID = 0x446f6f72
+
+LOGGER = logging.getLogger( __name__ )
+
+
+def _drop_invalid_index( conn, name ):
+    # A concurrent build that failed leaves an invalid index behind, which
+    # IF NOT EXISTS would otherwise skip over
+    is_invalid = conn.scalar(
+        text( "SELECT NOT indisvalid FROM pg_index"
+            " WHERE indexrelid = to_regclass( :name )" ),
+        { "name": name },
+    )
+    if is_invalid:
+        conn.execute( text( "DROP INDEX CONCURRENTLY IF EXISTS " + name ) )
+
+def create_index( conn, name, table, columns ):
+    """Create an index, without blocking writes on PostgreSQL
+
+    On PostgreSQL, the connection must not be in a transaction. Partitioned
+    tables get the index on each partition, built concurrently, and then
+    attached to an index on the parent.
+    """
+    if conn.dialect.name != "postgresql":
+        conn.execute( text(
+            f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})" ) )
+        return
+
+    partitions = conn.scalars(
+        text( "SELECT inhrelid::regclass::text FROM pg_inherits"
+            " WHERE inhparent = to_regclass( :table )" ),
+        { "table": table },
+    ).all()
+    if not partitions:
+        _drop_invalid_index( conn, name )
+        conn.execute( text( f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name}"
+            f" ON {table} ({columns})" ) )
+        return
+
+    # Only the parent, which holds no rows, so this is quick. It stays
+    # invalid until every partition's index is attached.
+    conn.execute( text(
+        f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} ({columns})" ) )
+    for partition in partitions:
+        partition_index = partition.split( "." )[-1] + "_" + name
+        _drop_invalid_index( conn, partition_index )
+        conn.execute( text(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {partition_index}"
+            f" ON {partition} ({columns})" ) )
+        conn.execute( text(
+            f"ALTER INDEX {name} ATTACH PARTITION {partition_index}" ) )
+
+def _hot_path_indexes( conn ):
+    indexes = [
+        # Tag searches on the entry log, and the join to members
+        ( "entry_log_rfid_time_id_idx", "entry_log", "rfid, entry_time, id" ),
+        # Exports and searches by location over a range of time
+        ( "entry_log_location_time_idx", "entry_log", "location, entry_time" ),
+        # Finding and clearing out expired tokens
+        ( "oauth_tokens_expiration_date_idx", "oauth_tokens",
+            "expiration_date" ),
+        # Dumping active tags reads the rfids right out of the index
+        ( "members_active_rfid_idx", "members", "active, rfid" ),
+        # Unique tag counts over a range of hours
+        ( "scan_stats_hourly_tags_hour_idx", "scan_stats_hourly_tags",
+            "hour" ),
+    ]
+    if conn.dialect.name != "postgresql":
+        # PostgreSQL already has these from the unique constraints in
+        # sql/pg.sql
+        indexes += [
+            ( "members_rfid_idx", "members", "rfid" ),
+            ( "members_username_idx", "members", "username" ),
+            ( "oauth_tokens_token_idx", "oauth_tokens", "token" ),
+        ]
+
+    for name, table, columns in indexes:
+        create_index( conn, name, table, columns )
+
+
+MIGRATIONS = [
+    Migration( 1, "hot path indexes", _hot_path_indexes,
+        in_transaction = False ),
+]
+
+
+def applied_versions( conn ):
+    """Set of versions that have been applied"""
+    schema_migrations_table.create( conn, checkfirst = True )
+    return set( conn.execute(
+        select( schema_migrations_table.c.version )
+    ).scalars() )
+
+def pending( engine = None, migrations = MIGRATIONS ):
+    """Migrations that haven't been applied yet, in order"""
+    engine = engine or get_engine()
+    with engine.begin() as conn:
+        applied = applied_versions( conn )
+    return [
+        migration
+        for migration in sorted( migrations, key = lambda m: m.version )
+        if migration.version not in applied
+    ]
+
+def _record( conn, migration ):
+    conn.execute(
+        insert( schema_migrations_table ).values(
+            version = migration.version,
+            name = migration.name,
+            applied_at = datetime.now( timezone.utc ),
+        )
+    )
+
+def _upgrade_in_transaction( engine, migration ):
+    with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.execute(
+                text( "SELECT pg_advisory_xact_lock( :id )" ),
+                { "id": PG_LOCK_ID },
+            )
+        # Someone else may have gotten to it while we waited on the lock
+        if migration.version in applied_versions( conn ):
+            return False
+
+        LOGGER.info( "Applying migration %d, %s",
+            migration.version, migration.name )
+        migration.upgrade( conn )
+        _record( conn, migration )
+    return True
+
+def _upgrade_without_transaction( engine, migration ):
+    with engine.connect().execution_options(
+        isolation_level = "AUTOCOMMIT"
+    ) as conn:
+        conn.execute(
+            text( "SELECT pg_advisory_lock( :id )" ),
+            { "id": PG_LOCK_ID },
+        )
+        try:
+            if migration.version in applied_versions( conn ):
+                return False
+
+            LOGGER.info( "Applying migration %d, %s, outside a transaction",
+                migration.version, migration.name )
+            migration.upgrade( conn )
+            _record( conn, migration )
+        finally:
+            conn.execute(
+                text( "SELECT pg_advisory_unlock( :id )" ),
+                { "id": PG_LOCK_ID },
+            )
+    return True
+
+def upgrade( engine = None, migrations = MIGRATIONS ):
+    """Apply every migration that hasn't been applied yet
+
+    Returns the list of migrations that were applied by this call. Safe to
+    run from several processes at once.
+    """
+    engine = engine or get_engine()
+    done = []
+    for migration in pending( engine, migrations ):
+        if engine.dialect.name == "postgresql" \
+            and not migration.in_transaction:
+            is_applied = _upgrade_without_transaction( engine, migration )
+        else:
+            is_applied = _upgrade_in_transaction( engine, migration )
+
+        if is_applied:
+            done.append( migration )
+
+    return done
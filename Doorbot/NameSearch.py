@@ -0,0 +1,279 @@
+"""Fuzzy member name search, ranked by trigram similarity
+
+Names match when they're similar enough to what was typed, or contain it.
+Results come back most similar first. Similarity is the share of trigrams
+the two names have in common, worked out the same way as PostgreSQL's
+pg_trgm: each word is lowercased and padded with two spaces in front and one
+behind, and similarity is the number of shared trigrams divided by the number
+of distinct trigrams in both.
+
+On PostgreSQL, this is done by the database with the '%' operator and
+similarity(), both of which use the members_full_name_trgm_idx index. Other
+databases get an in-process inverted index from trigram to members, built
+with one query and thrown out after any ACL change or once it gets older
+than 'name_search.max_age_seconds'.
+
+Names need a similarity of at least 'name_search.similarity_threshold' to
+match, unless they contain the search text.
+
+tags_for_name() finds the tags of members whose names contain the search
+text, through the same indexes, so other tables can be searched by tag.
+"""
+import re
+import threading
+import time
+import Doorbot.ACL
+import Doorbot.Config
+from collections import Counter
+from Doorbot.SQLAlchemy import Member
+from Doorbot.SQLAlchemy import get_engine
+from Doorbot.SQLAlchemy import get_session
+from sqlalchemy import case
+from sqlalchemy import false
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import text
+
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.3
+DEFAULT_MAX_AGE_SECONDS = 300
+
+MATCH_WORD = re.compile( r'[^\W_]+' )
+
+__INDEX = None
+
+
+def trigrams( name ):
+    """Set of trigrams in a name, the way pg_trgm makes them"""
+    found = set()
+    for word in MATCH_WORD.findall( name.lower() ):
+        padded = "  " + word + " "
+        found.update(
+            padded[ i : i + 3 ] for i in range( 0, len( padded ) - 2 )
+        )
+    return found
+
+def similarity( a, b ):
+    """Similarity of two names, from 0 to 1"""
+    a = trigrams( a )
+    b = trigrams( b )
+    if not a or not b:
+        return 0.0
+    shared = len( a & b )
+    return shared / ( len( a ) + len( b ) - shared )
+
+
+class TrigramIndex:
+    """Maps trigrams to the members whose names have them"""
+
+    def __init__(
+        self,
+        max_age_seconds = DEFAULT_MAX_AGE_SECONDS,
+    ):
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self._engine = None
+        self._index = None
+        self._built_at = 0
+
+    def search( self, name, threshold = DEFAULT_SIMILARITY_THRESHOLD ):
+        """Ids of members with names like this one, most similar first"""
+        names, postings = self._current()
+        wanted = trigrams( name )
+        needle = name.lower()
+
+        shared = Counter()
+        for trigram in wanted:
+            shared.update( postings.get( trigram, () ) )
+        if len( needle ) < 3:
+            # Too short to have trigrams inside a word, so look at them all
+            candidates = names.keys()
+        else:
+            candidates = shared.keys()
+
+        ranked = []
+        for member_id in candidates:
+            full_name, name_trigrams = names[ member_id ]
+            count = shared[ member_id ]
+            score = count / ( len( wanted ) + len( name_trigrams ) - count ) \
+                if wanted and name_trigrams else 0.0
+            if score >= threshold or needle in full_name.lower():
+                ranked.append( ( -score, member_id ) )
+
+        ranked.sort()
+        return [ member_id for _, member_id in ranked ]
+
+    def containing( self, name ):
+        """Ids of members whose names contain this one"""
+        names, postings = self._current()
+        needle = name.lower()
+
+        if len( needle ) < 3:
+            candidates = names.keys()
+        else:
+            # Any name containing it has all of its trigrams that aren't at
+            # the edge of a word, so start with the rarest of those
+            inner = [
+                trigram for trigram in trigrams( name )
+                if not trigram.startswith( " " ) and not trigram.endswith( " " )
+            ]
+            if inner:
+                candidates = min(
+                    ( postings.get( trigram, () ) for trigram in inner ),
+                    key = len,
+                )
+            else:
+                candidates = names.keys()
+
+        return sorted(
+            member_id for member_id in set( candidates )
+            if needle in names[ member_id ][0].lower()
+        )
+
+    def invalidate( self ):
+        """Throw out the whole index. It's rebuilt on the next search."""
+        with self._lock:
+            self._index = None
+
+    def _is_current( self, engine ):
+        age = time.monotonic() - self._built_at
+        return self._index is not None \
+            and self._engine is engine \
+            and age < self.max_age_seconds
+
+    def _current( self ):
+        engine = get_engine()
+        index = self._index
+        if index is not None and self._is_current( engine ):
+            return index
+
+        with self._lock:
+            # Another thread may have rebuilt it while we waited on the lock
+            if not self._is_current( engine ):
+                session = get_session()
+                rows = session.execute(
+                    select( Member.id, Member.full_name )
+                ).all()
+                session.close()
+
+                names = {}
+                postings = {}
+                for member_id, full_name in rows:
+                    name_trigrams = trigrams( full_name or "" )
+                    names[ member_id ] = ( full_name or "", name_trigrams )
+                    for trigram in name_trigrams:
+                        postings.setdefault( trigram, [] ).append( member_id )
+
+                self._index = ( names, postings )
+                self._engine = engine
+                self._built_at = time.monotonic()
+
+            return self._index
+
+
+def get_conf():
+    return Doorbot.Config.get( 'name_search', {} )
+
+def similarity_threshold():
+    return get_conf().get(
+        'similarity_threshold',
+        DEFAULT_SIMILARITY_THRESHOLD,
+    )
+
+def get_index():
+    """Get the trigram index for this process"""
+    global __INDEX
+
+    if __INDEX is None:
+        __INDEX = TrigramIndex(
+            max_age_seconds = get_conf().get(
+                'max_age_seconds',
+                DEFAULT_MAX_AGE_SECONDS,
+            ),
+        )
+
+    return __INDEX
+
+def ranked( stmt, name, tag, offset, limit, session ):
+    """Narrow a select on members down to a page of fuzzy name matches
+
+    The statement comes back filtered, ordered by similarity, and limited to
+    the page.
+    """
+    threshold = similarity_threshold()
+    if tag:
+        stmt = stmt.where( Member.rfid == tag )
+
+    if session.get_bind().dialect.name == "postgresql":
+        # Only for this transaction
+        session.execute(
+            text( "SELECT set_config( 'pg_trgm.similarity_threshold',"
+                " :threshold, true )" ),
+            { "threshold": str( threshold ) },
+        )
+        return stmt.where(
+            or_(
+                Member.full_name.op( '%' )( name ),
+                Member.full_name.ilike( '%' + name + '%' ),
+            )
+        ).order_by(
+            func.similarity( Member.full_name, name ).desc(),
+            Member.join_date,
+        ).limit(
+            limit
+        ).offset(
+            offset
+        )
+
+    member_ids = get_index().search( name, threshold )
+    if tag:
+        with_tag = set( session.scalars(
+            select( Member.id ).where( Member.rfid == tag )
+        ) )
+        member_ids = [ i for i in member_ids if i in with_tag ]
+
+    page = member_ids[ offset : offset + limit ]
+    if not page:
+        return stmt.where( false() )
+    return stmt.where(
+        Member.id.in_( page )
+    ).order_by(
+        case(
+            { member_id: rank for rank, member_id in enumerate( page ) },
+            value = Member.id,
+        )
+    )
+
+def tags_for_name( name, session, max_tags ):
+    """Tags of members whose names contain the given one
+
+    At most max_tags are returned.
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        stmt = select( Member.rfid ).where(
+            Member.full_name.ilike( '%' + name + '%' ),
+        )
+    else:
+        member_ids = get_index().containing( name )
+        if not member_ids:
+            return []
+        stmt = select( Member.rfid ).where(
+            Member.id.in_( member_ids ),
+        )
+
+    return session.scalars(
+        stmt.where(
+            Member.rfid.is_not( None ),
+        ).order_by(
+            Member.id,
+        ).limit(
+            max_tags
+        )
+    ).all()
+
+
+@Doorbot.ACL.add_listener
+def _invalidate_index( change ):
+    if __INDEX is not None:
+        __INDEX.invalidate()
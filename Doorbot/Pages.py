@@ -1,13 +1,14 @@
 import Doorbot.Config
+import Doorbot.LocationRegistry
+import Doorbot.ScanStats
 import flask
 from Doorbot.API import app
+from Doorbot.API import get_request_session
 from Doorbot.SQLAlchemy import Location
 from Doorbot.SQLAlchemy import EntryLog
 from Doorbot.SQLAlchemy import Member
 from Doorbot.SQLAlchemy import Permission
 from Doorbot.SQLAlchemy import Role
-from Doorbot.SQLAlchemy import get_engine
-from Doorbot.SQLAlchemy import get_session
 from datetime import datetime, timedelta, timezone
 from flask_stache import render_template
 from sqlalchemy import select
@@ -106,12 +107,11 @@ def login():
     username = request.form[ 'username' ]
     password = request.form[ 'password' ]
 
-    session = get_session()
+    session = get_request_session()
     member = Member.get_by_username( username, session )
 
     response = flask.make_response()
     if not member:
-        session.close()
         return error_page(
             response,
             msgs = [ "Incorrect Login" ],
@@ -120,7 +120,6 @@ def login():
             status = 404,
         )
     elif not member.check_password( password, session ):
-        session.close()
         return error_page(
             response,
             msgs = [ "Incorrect Login" ],
@@ -129,7 +128,6 @@ def login():
             status = 404,
         )
     else:
-        session.close()
         flask.session[ 'username' ] = username
         return home_page()
 
@@ -158,7 +156,7 @@ def add_tag():
     rfid = request.form[ 'rfid' ]
     name = request.form[ 'name' ]
 
-    session = get_session()
+    session = get_request_session()
 
     errors = []
     if not Doorbot.API.MATCH_INT.match( rfid ):
@@ -173,7 +171,6 @@ def add_tag():
 
     response = flask.make_response()
     if errors:
-        session.close()
         return error_page(
             response,
             msgs = errors,
@@ -189,7 +186,6 @@ def add_tag():
         )
         session.add( member )
         session.commit()
-        session.close()
 
         return render_tmpl(
             'add_tag',
@@ -199,14 +195,16 @@ def add_tag():
         )
 
 def controller_list_main(**args): # List of Controller Groups and Controllers
-    session = get_session()
-    groups = session.query(Role)
-    formatted_groups = list(map(lambda z: {
-        "controller_group": z.name,
-        "controllers": ', '.join(list(map(lambda x: x.name, z.permissions))),
-        "user_count": len(z.members) if len(z.members) != 0 else None,
-    }, groups ))
-    session.close()
+    session = get_request_session()
+    groups = Role.summaries( session )
+    formatted_groups = [
+        {
+            "controller_group": name,
+            "controllers": ', '.join( permission_names ),
+            "user_count": member_count if member_count != 0 else None,
+        }
+        for name, permission_names, member_count in groups
+    ]
 
     username = flask.session.get( 'username' )
     return render_tmpl(
@@ -228,7 +226,7 @@ def controller_list():
 def controller_group_add():
     add_controller_group = flask.request.form[ 'add_controller_group' ]
 
-    session = get_session()
+    session = get_request_session()
 
     errors = []
     if not Doorbot.API.MATCH_NAME.match( add_controller_group ):
@@ -242,7 +240,6 @@ def controller_group_add():
                 'New Controller Group "' + add_controller_group + '" already exists')
 
     if errors:
-        session.close()
         return controller_list_main(
             has_errors = True,
             errors = errors,
@@ -251,7 +248,6 @@ def controller_group_add():
     else:
         session.add( Role(name = add_controller_group) )
         session.commit()
-        session.close()
         return controller_list_main(
             has_errors = True,
             errors = [ 'New Controller Group "' + add_controller_group + '" added' ],
@@ -263,11 +259,10 @@ def controller_group_add():
 def controller_group_delete():
     del_controller_group = flask.request.form[ 'del_controller_group' ]
 
-    session = get_session()
+    session = get_request_session()
 
     ddg = session.query(Role).filter_by(name=del_controller_group).one_or_none()
     if ddg is None:
-        session.close()
         return controller_list_main(
             has_errors = True,
             errors = [ 'Cannot delete "' + del_controller_group + '", not found' ],
@@ -276,7 +271,6 @@ def controller_group_delete():
     else:
         session.delete(ddg)
         session.commit()
-        session.close()
         return controller_list_main(
             has_errors = True,
             errors = [ 'Controller Group "' + del_controller_group + '" deleted' ],
@@ -292,13 +286,12 @@ def edit_controllers_main(**args): # List of Controllers with add & delete actio
     else:
         controller_group = flask.request.args.get( 'controller_group' )
 
-    session = get_session()
-    controllers = session.query(Permission).join(
-        Role, Permission.roles).where((Role.name==controller_group))
-    formatted_controllers = list(map(lambda z: {
-        "controller_name": z.name
-    }, controllers ))
-    session.close()
+    session = get_request_session()
+    controllers = Role.permission_names( controller_group, session )
+    formatted_controllers = [
+        { "controller_name": name }
+        for name in controllers
+    ]
 
     return render_tmpl(
         'edit_controllers',
@@ -322,7 +315,7 @@ def controller_add():
     add_controller = request.form[ 'add_controller' ]
     controller_group = request.form[ 'controller_group' ]
 
-    session = get_session()
+    session = get_request_session()
     controller_group_obj = session.query(Role).filter_by(name=controller_group).one_or_none()
 
     errors = []
@@ -338,7 +331,6 @@ def controller_add():
             errors.append('New Controller "' + add_controller + '" already exists')
 
     if errors:
-        session.close()
         return edit_controllers_main(
             has_errors = True,
             errors = errors,
@@ -350,7 +342,6 @@ def controller_add():
         controller_group_obj.permissions.append( controller_obj )
         session.add_all([ controller_group_obj, controller_obj ])
         session.commit()
-        session.close()
         return edit_controllers_main(
             has_errors = True,
             errors = [ 'New Controller "' + add_controller + '" added' ],
@@ -365,7 +356,7 @@ def controller_delete():
     del_controller = request.form[ 'del_controller' ]
     controller_group = request.form[ 'controller_group' ]
 
-    session = get_session()
+    session = get_request_session()
     controller_group_obj = session.query(Role).filter_by(name=controller_group).one_or_none()
 
     errors = []
@@ -375,7 +366,6 @@ def controller_delete():
     if dev is None:
         errors.append('Cannot delete "' + del_controller + '", not found')
     if errors:
-        session.close()
         return edit_controllers_main(
             has_errors = True,
             errors = errors,
@@ -385,7 +375,6 @@ def controller_delete():
     else:
         session.delete(dev)
         session.commit()
-        session.close()
         return edit_controllers_main(
             has_errors = True,
             errors = [ 'Controller "' + del_controller + '" deleted' ],
@@ -402,11 +391,12 @@ def edit_group_users_main(**args): # List of Controller Group Users with add & d
     else:
         controller_group = flask.request.args.get( 'controller_group' )
 
-    session = get_session()
-    users = session.query(Role).filter_by(name=controller_group).one_or_none().members
-    formatted_users = list(map(lambda z: {
-        "group_user_name": z.full_name
-    }, users ))
+    session = get_request_session()
+    users = Role.member_names( controller_group, session )
+    formatted_users = [
+        { "group_user_name": full_name }
+        for full_name in users
+    ]
 
     return render_tmpl(
         'edit_group_users',
@@ -430,7 +420,7 @@ def group_users_add():
     add_group_user = request.form[ 'add_group_user' ]
     controller_group = request.form[ 'controller_group' ]
 
-    session = get_session()
+    session = get_request_session()
     controller_group_obj = session.query(Role).filter_by(name=controller_group).one_or_none()
 
     errors = []
@@ -449,7 +439,6 @@ def group_users_add():
             '" already exists in "' + controller_group + ' "')
 
     if errors:
-        session.close()
         return edit_group_users_main(
             has_errors = True,
             errors = errors,
@@ -460,7 +449,6 @@ def group_users_add():
         group_users_obj.roles.append( controller_group_obj )
         session.add_all([ controller_group_obj, group_users_obj ])
         session.commit()
-        session.close()
         return edit_group_users_main(
             has_errors = True,
             errors = [ 'New User "' + add_group_user + '" added' ],
@@ -475,7 +463,7 @@ def group_users_delete():
     del_group_user = request.form[ 'del_group_user' ]
     controller_group = request.form[ 'controller_group' ]
 
-    session = get_session()
+    session = get_request_session()
     controller_group_obj = session.query(Role).filter_by(name=controller_group).one_or_none()
 
     errors = []
@@ -485,7 +473,6 @@ def group_users_delete():
     if usr is None:
         errors.append('Cannot delete "' + del_group_user + '", not found')
     if errors:
-        session.close()
         return edit_group_users_main(
             has_errors = True,
             errors = errors,
@@ -496,7 +483,6 @@ def group_users_delete():
         usr.roles.remove( controller_group_obj )
         session.add_all([ usr, controller_group_obj ])
         session.commit()
-        session.close()
         return edit_group_users_main(
             has_errors = True,
             errors = [ 'User "' + del_group_user + '" deleted' ],
@@ -508,11 +494,14 @@ def group_users_delete():
 @require_logged_in
 def search_scan_logs():
     args = flask.request.args
+    name = args.get( 'search_name' )
     rfid = args.get( 'search_rfid' )
     offset = args.get( 'offset' )
     limit = args.get( 'limit' )
+    cursor = args.get( 'cursor' )
 
     # Normalize the data
+    name = "" if name is None else name.strip()
     rfid = "" if rfid is None else rfid
     rfid = rfid.strip()
 
@@ -527,9 +516,24 @@ def search_scan_logs():
     elif limit > 100:
         limit = 100
 
-    logs = Doorbot.API.search_scan_logs( rfid, offset, limit )
-
-    next_offset = offset + limit
+    try:
+        logs, next_cursor = Doorbot.API.search_scan_logs(
+            rfid,
+            offset,
+            limit,
+            get_request_session(),
+            cursor = cursor,
+            name = name,
+        )
+    except ValueError:
+        # Bad cursor, so start from the top
+        logs, next_cursor = Doorbot.API.search_scan_logs(
+            rfid,
+            0,
+            limit,
+            get_request_session(),
+            name = name,
+        )
 
     username = flask.session.get( 'username' )
     return render_tmpl(
@@ -537,11 +541,72 @@ def search_scan_logs():
         page_name = "Search Scan Logs",
         tags = logs,
         username = username,
+        search_name = name,
         search_rfid = rfid,
-        next_offset = next_offset,
+        next_cursor = next_cursor,
         limit = limit,
     )
 
+@app.route( "/scan-stats", methods = [ "GET" ] )
+@require_logged_in
+def scan_stats_page():
+    args = flask.request.args
+    location = args.get( 'location' )
+    days = args.get( 'days' )
+
+    # Normalize the data
+    location = "" if location is None else location.strip()
+    days = int( days ) if days and days.isdigit() else 7
+    if days <= 0:
+        days = 7
+    elif days > 366:
+        days = 366
+
+    registry = Doorbot.LocationRegistry.get_registry()
+    location_id = registry.get_id( location ) if location else None
+
+    end = datetime.now( timezone.utc )
+    start = end - timedelta( days = days )
+    session = get_request_session()
+
+    totals = Doorbot.ScanStats.totals( session, start, end, location_id )
+    total_rows = [
+        { "location": name, **counts }
+        for name, counts in sorted( totals.items() )
+    ]
+
+    # Add up the hours into days, newest first
+    by_day = {}
+    for row in Doorbot.ScanStats.hourly( session, start, end, location_id ):
+        key = ( row.hour.date().isoformat(), row.location )
+        day = by_day.setdefault( key, {
+            "day": key[0],
+            "location": key[1],
+            "total_scans": 0,
+            "active_scans": 0,
+            "found_scans": 0,
+        })
+        day[ "total_scans" ] += row.total_scans
+        day[ "active_scans" ] += row.active_scans
+        day[ "found_scans" ] += row.found_scans
+    day_rows = sorted( by_day.values(), key = lambda day: day[ "location" ] )
+    day_rows.sort( key = lambda day: day[ "day" ], reverse = True )
+
+    username = flask.session.get( 'username' )
+    return render_tmpl(
+        'scan_stats',
+        page_name = "Scan Statistics",
+        username = username,
+        days = days,
+        location = location,
+        locations = [
+            { "name": name, "selected": name == location }
+            for name in registry.names()
+        ],
+        totals = total_rows,
+        day_rows = day_rows,
+    )
+
 @app.route( "/view-tag-list", methods = [ "GET" ] )
 @require_logged_in
 def view_tag_list():
@@ -570,7 +635,13 @@ def view_tag_list():
 
     next_offset = offset + limit
 
-    members = Doorbot.API.search_tag_list( name, rfid, offset, limit )
+    members = Doorbot.API.search_tag_list(
+        name,
+        rfid,
+        offset,
+        limit,
+        fuzzy = True,
+    )
     formatted_members = list( map(
         lambda member: {
             "full_name": member.full_name,
@@ -633,11 +704,10 @@ def edit_tag_submit():
             username = username,
         )
 
-    session = get_session()
+    session = get_request_session()
     member = Member.get_by_tag( current_tag, session )
 
     if not member:
-        session.close()
         return error_page(
             response,
             tmpl = 'edit_tag',
@@ -650,7 +720,6 @@ def edit_tag_submit():
     member.rfid = new_tag
     session.add( member )
     session.commit()
-    session.close()
 
     return render_tmpl(
         'edit_tag',
@@ -701,11 +770,10 @@ def edit_name_submit():
             username = username,
         )
 
-    session = get_session()
+    session = get_request_session()
     member = Member.get_by_tag( current_tag, session )
 
     if not member:
-        session.close()
         return error_page(
             response,
             tmpl = 'edit_name',
@@ -718,7 +786,6 @@ def edit_name_submit():
     member.full_name = new_name
     session.add( member )
     session.commit()
-    session.close()
 
     return render_tmpl(
         'edit_name',
@@ -754,11 +821,10 @@ def activate_tag_submit():
             username = username,
         )
 
-    session = get_session()
+    session = get_request_session()
     member = Member.get_by_tag( tag, session )
 
     if not member:
-        session.close()
         return error_page(
             response,
             tmpl = 'activate_tag',
@@ -775,7 +841,6 @@ def activate_tag_submit():
     action = "Activated tag" if activate else "Deactivated tag"
     action = action + " " + tag + " for " + member.full_name
 
-    session.close()
     return render_tmpl(
         'activate_tag',
         page_name = page_name,
@@ -822,7 +887,7 @@ def create_oauth():
     request = flask.request
     name = request.form[ 'name' ]
 
-    session = get_session()
+    session = get_request_session()
 
     errors = []
     if not Doorbot.API.MATCH_NAME.match( name ):
@@ -830,7 +895,6 @@ def create_oauth():
 
     response = flask.make_response()
     if errors:
-        session.close()
         return error_page(
             response,
             msgs = errors,
@@ -856,7 +920,6 @@ def create_oauth():
 
         session.add( token )
         session.commit()
-        session.close()
 
         return render_tmpl(
             'create_oauth_submit',
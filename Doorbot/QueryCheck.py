@@ -0,0 +1,184 @@
+"""Reports queries that read a whole table when they shouldn't need to
+
+When enabled, each distinct SELECT, UPDATE, or DELETE the app runs is
+explained first. A full scan of a table in 'query_check.tables' that the
+WHERE clause filters on is logged as a warning and kept in findings(), as is
+SQLite building a temporary index for a join. Reading a whole table with no
+filter on it isn't reported, since no index would help.
+
+On PostgreSQL, the planner prefers a sequential scan of a small table even
+when there's an index, so scans estimated at fewer than
+'query_check.min_rows' rows are ignored there. SQLite plans don't depend on
+table size, so a test database is enough to find missing indexes.
+
+This runs an extra query for each new statement, so it's meant for
+development and tests. Turn it on with 'query_check.enabled'.
+"""
+import json
+import logging
+import re
+import threading
+import Doorbot.Config
+from collections import namedtuple
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+Finding = namedtuple( 'Finding', [
+    'table',
+    'statement',
+])
+"""A full table scan in a statement"""
+
+DEFAULT_TABLES = [
+    "entry_log",
+    "members",
+    "oauth_tokens",
+    "acl_changes",
+    "scan_stats_hourly",
+    "scan_stats_hourly_tags",
+]
+DEFAULT_MIN_ROWS = 1000
+
+CHECKED_STATEMENTS = ( "SELECT", "WITH", "UPDATE", "DELETE" )
+# SQLite names a scan after the alias, like "SCAN members_1"
+MATCH_SQLITE_SCAN = re.compile( r'^SCAN (\w+?)(_\d+)?$' )
+MATCH_SQLITE_AUTOMATIC = re.compile(
+    r'^SEARCH (\w+?)(_\d+)? USING AUTOMATIC' )
+# Partitions of the entry log
+MATCH_PG_PARTITION = re.compile( r'^entry_log_(y\d{4}m\d{2}|default|legacy)$' )
+
+LOGGER = logging.getLogger( __name__ )
+
+__LOCK = threading.Lock()
+__SEEN = set()
+__FINDINGS = []
+__TABLES = None
+__MIN_ROWS = DEFAULT_MIN_ROWS
+
+
+def _sqlite_scans( cursor, statement, parameters ):
+    cursor.execute( "EXPLAIN QUERY PLAN " + statement, parameters )
+    for row in cursor.fetchall():
+        match = MATCH_SQLITE_SCAN.match( row[-1] )
+        if match:
+            yield ( match.group( 1 ), False )
+            continue
+        match = MATCH_SQLITE_AUTOMATIC.match( row[-1] )
+        if match:
+            yield ( match.group( 1 ), True )
+
+def _pg_nodes( plan ):
+    yield plan
+    for child in plan.get( "Plans", [] ):
+        yield from _pg_nodes( child )
+
+def _pg_scans( cursor, statement, parameters ):
+    cursor.execute( "EXPLAIN (FORMAT JSON) " + statement, parameters )
+    plan = cursor.fetchone()[0]
+    if isinstance( plan, str ):
+        plan = json.loads( plan )
+
+    for node in _pg_nodes( plan[0][ "Plan" ] ):
+        if node.get( "Node Type" ) != "Seq Scan" \
+            or node.get( "Plan Rows", 0 ) < __MIN_ROWS:
+            continue
+        table = node.get( "Relation Name" )
+        if MATCH_PG_PARTITION.match( table ):
+            table = "entry_log"
+        yield ( table, False )
+
+def _is_filtered( statement, table ):
+    """Whether the WHERE clause filters on a column of the table
+
+    'IS NOT NULL' doesn't count, since it usually keeps most of the rows.
+    """
+    where = statement.upper().find( "WHERE" )
+    if where < 0:
+        return False
+    column = r'\b' + table + r'(_\d+)?\.\w+'
+    conditions = re.sub( column + r' IS NOT NULL', '', statement[ where: ] )
+    return re.search( column, conditions ) is not None
+
+def check( conn, statement, parameters ):
+    """Explain a statement and return Findings for any full scans"""
+    if conn.dialect.name == "postgresql":
+        scans = _pg_scans
+    elif conn.dialect.name == "sqlite":
+        scans = _sqlite_scans
+    else:
+        return []
+
+    # Use a plain DBAPI cursor, so this doesn't set off the event again
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        tables = sorted({
+            table
+            for table, is_join in scans( cursor, statement, parameters )
+            if table in __TABLES
+                and ( is_join or _is_filtered( statement, table ) )
+        })
+    finally:
+        cursor.close()
+
+    return [
+        Finding( table = table, statement = statement )
+        for table in tables
+    ]
+
+def _before_cursor_execute(
+    conn, cursor, statement, parameters, context, executemany
+):
+    if executemany \
+        or not statement.lstrip().upper().startswith( CHECKED_STATEMENTS ):
+        return
+
+    with __LOCK:
+        if statement in __SEEN:
+            return
+        __SEEN.add( statement )
+
+    try:
+        found = check( conn, statement, parameters )
+    except Exception as e:
+        LOGGER.debug( "Could not explain statement: %s", e )
+        return
+
+    for finding in found:
+        LOGGER.warning( "Full scan of %s, which may need an index: %s",
+            finding.table, finding.statement )
+    with __LOCK:
+        __FINDINGS.extend( found )
+
+def enable( tables = None, min_rows = None ):
+    """Start checking statements on all engines"""
+    global __TABLES, __MIN_ROWS
+
+    conf = Doorbot.Config.get( 'query_check', {} )
+    __TABLES = set( tables or conf.get( 'tables' ) or DEFAULT_TABLES )
+    __MIN_ROWS = min_rows if min_rows is not None \
+        else conf.get( 'min_rows', DEFAULT_MIN_ROWS )
+    if not event.contains( Engine, "before_cursor_execute",
+        _before_cursor_execute ):
+        event.listen( Engine, "before_cursor_execute", _before_cursor_execute )
+
+def disable():
+    """Stop checking statements"""
+    if event.contains( Engine, "before_cursor_execute",
+        _before_cursor_execute ):
+        event.remove( Engine, "before_cursor_execute", _before_cursor_execute )
+
+def is_enabled():
+    conf = Doorbot.Config.get( 'query_check', {} )
+    return conf.get( 'enabled', False )
+
+def findings():
+    """Everything found since the last clear()"""
+    with __LOCK:
+        return list( __FINDINGS )
+
+def clear():
+    """Forget findings, and check every statement again"""
+    with __LOCK:
+        __SEEN.clear()
+        __FINDINGS.clear()
@@ -0,0 +1,180 @@
+"""Cache of finished responses for the dump endpoints
+
+Doorbots fetch the same lists of tags and locations over and over, and the
+answer rarely changes. Entries hold the encoded body, a gzipped copy of it,
+and its ETag, so a hit is answered without a query or any encoding.
+
+Everything is thrown out after any ACL change (see Doorbot.ACL), including
+ones other processes send over Doorbot.InvalidationBus. In case one of those
+is missed, entries also expire after 'response_cache.max_age_seconds'.
+
+When many requests miss on the same key at once, like every doorbot
+resyncing after a restart, only one of them builds the response. The rest
+wait for it and use what it built.
+"""
+import collections
+import gzip
+import threading
+import time
+import Doorbot.ACL
+import Doorbot.Config
+import flask
+from collections import namedtuple
+from Doorbot.SQLAlchemy import get_engine
+
+
+DEFAULT_MAX_SIZE = 256
+DEFAULT_MAX_AGE_SECONDS = 10
+
+CachedResponse = namedtuple( 'CachedResponse', [
+    'body',
+    'gzip_body',
+    'content_type',
+    'etag',
+])
+"""A finished response, ready to send"""
+
+__CACHE = None
+
+
+def from_response( response ):
+    """CachedResponse holding the body and headers of a Flask response"""
+    body = response.get_data()
+    etag, _ = response.get_etag()
+    return CachedResponse(
+        body = body,
+        gzip_body = gzip.compress( body ),
+        content_type = response.content_type,
+        etag = etag,
+    )
+
+def to_response( entry, vary = () ):
+    """Flask response for a cached entry
+
+    Answers with 304 if the client already has it, and sends the gzipped
+    body if the client takes gzip.
+    """
+    if entry.etag and flask.request.if_none_match.contains_weak( entry.etag ):
+        response = flask.make_response()
+        response.status = 304
+    elif flask.request.accept_encodings[ 'gzip' ]:
+        response = flask.make_response( entry.gzip_body )
+        response.content_type = entry.content_type
+        response.content_encoding = 'gzip'
+    else:
+        response = flask.make_response( entry.body )
+        response.content_type = entry.content_type
+
+    if entry.etag:
+        response.set_etag( entry.etag )
+    response.vary.add( 'Accept-Encoding' )
+    for header in vary:
+        response.vary.add( header )
+    return response
+
+
+class ResponseCache:
+    """Bounded LRU cache of CachedResponses, with a maximum age"""
+
+    def __init__(
+        self,
+        max_size = DEFAULT_MAX_SIZE,
+        max_age_seconds = DEFAULT_MAX_AGE_SECONDS,
+    ):
+        self.max_size = max_size
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self._engine = None
+        self._entries = collections.OrderedDict()
+        self._building = {}
+        self._generation = 0
+
+    def get( self, key ):
+        """Returns the cached response, or None if missing or too old"""
+        engine = get_engine()
+        with self._lock:
+            if self._engine is not engine:
+                # Responses from one database mean nothing in another
+                self._entries.clear()
+                self._engine = engine
+
+            entry = self._entries.get( key )
+            if entry is None:
+                return None
+
+            stored_at, response = entry
+            if time.monotonic() - stored_at >= self.max_age_seconds:
+                del self._entries[ key ]
+                return None
+
+            self._entries.move_to_end( key )
+            return response
+
+    def get_or_build( self, key, build ):
+        """Returns the cached response, building it if needed
+
+        build() returns a CachedResponse, or None if the result shouldn't be
+        cached. Only one caller builds a given key at a time.
+        """
+        response = self.get( key )
+        if response is not None:
+            return response
+
+        with self._lock:
+            building = self._building.setdefault( key, threading.Lock() )
+
+        with building:
+            # Whoever held the lock may have just built it
+            response = self.get( key )
+            if response is not None:
+                return response
+
+            generation = self._generation
+            try:
+                response = build()
+            finally:
+                with self._lock:
+                    if self._building.get( key ) is building:
+                        del self._building[ key ]
+
+            # Don't keep it if something changed while it was being built
+            with self._lock:
+                if response is not None and generation == self._generation:
+                    self._entries[ key ] = ( time.monotonic(), response )
+                    self._entries.move_to_end( key )
+                    while len( self._entries ) > self.max_size:
+                        self._entries.popitem( last = False )
+
+            return response
+
+    def invalidate( self ):
+        """Throw out every entry, including any being built right now"""
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def __len__( self ):
+        return len( self._entries )
+
+
+def get_cache():
+    """Get the response cache for this process"""
+    global __CACHE
+
+    if __CACHE is None:
+        conf = Doorbot.Config.get( 'response_cache', {} )
+        __CACHE = ResponseCache(
+            max_size = conf.get( 'max_size', DEFAULT_MAX_SIZE ),
+            max_age_seconds = conf.get(
+                'max_age_seconds',
+                DEFAULT_MAX_AGE_SECONDS,
+            ),
+        )
+
+    return __CACHE
+
+
+@Doorbot.ACL.add_listener
+def _invalidate_cache( change ):
+    if __CACHE is not None:
+        __CACHE.invalidate()
@@ -1,6 +1,7 @@
 import base64
 import bcrypt
 import hashlib
+import os
 import re
 import subprocess
 import urllib
@@ -10,8 +11,10 @@ from typing import Optional
 from sqlalchemy import Column
 from sqlalchemy import Table
 from sqlalchemy import ForeignKey
-from sqlalchemy import Boolean, Date, DateTime, String
+from sqlalchemy import Index
+from sqlalchemy import BigInteger, Boolean, Date, DateTime, Integer, String
 from sqlalchemy import create_engine
+from sqlalchemy import exists
 from sqlalchemy import select
 from sqlalchemy.sql import func
 from sqlalchemy.orm import DeclarativeBase
@@ -25,6 +28,11 @@ PASSWORD_TYPE_PLAINTEXT = "plaintext"
 PASSWORD_TYPE_BCRYPT = "bcrypt"
 PASSWORD_TYPE_APACHE_MD5 = "apache_md5"
 
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_PRE_PING = True
+DEFAULT_POOL_RECYCLE_SECONDS = 1800
+
 __ENGINE = None
 
 def __connect_pg():
@@ -43,16 +51,34 @@ def __connect_pg():
         "@" + host + ":" + str( port ) + \
         "/" + database
 
-    engine = create_engine( conn_str )
+    # Each worker process gets its own pool. The pool should be at least as
+    # big as the number of threads in a worker.
+    engine = create_engine(
+        conn_str,
+        pool_size = pg_conf.get( 'pool_size', DEFAULT_POOL_SIZE ),
+        max_overflow = pg_conf.get( 'max_overflow', DEFAULT_MAX_OVERFLOW ),
+        pool_pre_ping = pg_conf.get( 'pool_pre_ping', DEFAULT_POOL_PRE_PING ),
+        pool_recycle = pg_conf.get(
+            'pool_recycle_seconds',
+            DEFAULT_POOL_RECYCLE_SECONDS,
+        ),
+    )
     return engine
 
-def set_engine_sqlite():
-    """Set the engine to use SQLite instead of Pg"""
+def set_engine_sqlite( path = None ):
+    """Set the engine to use SQLite instead of Pg
+
+    Uses an in-memory database unless given a file path.
+    """
 
     global __ENGINE
-    __ENGINE = create_engine( "sqlite://" )
+    __ENGINE = create_engine( "sqlite://" + ( "/" + path if path else "" ) )
     Base.metadata.create_all( __ENGINE )
 
+    # Indexes are added by migrations, not the models
+    import Doorbot.Migrations
+    Doorbot.Migrations.upgrade( __ENGINE )
+
 def get_engine():
     """Get the SQLAlchemy engine"""
 
@@ -63,6 +89,20 @@ def get_engine():
 
     return __ENGINE
 
+def dispose_engine():
+    """Drop pooled connections inherited from a parent process
+
+    Call this in a child right after a fork. The connections are left open
+    for the parent to keep using, but the child will make its own. Nothing
+    calls it on its own in a uwsgi worker; see app.py.
+    """
+    if __ENGINE is not None:
+        __ENGINE.dispose( close = False )
+
+# Only covers os.fork() called from Python. uwsgi forks its workers from C,
+# so app.py also registers dispose_engine() with uwsgi's postfork.
+os.register_at_fork( after_in_child = dispose_engine )
+
 def get_session():
     """Convenience function for getting an SQLAlchmey session"""
 
@@ -71,6 +111,20 @@ def get_session():
     return session
 
 
+def _session_for( obj, session = None ):
+    """Pick a session to run a query for the given object
+
+    Prefers the session passed in, then the session the object is attached to.
+    Falls back to a new session, in which case the second return value is True
+    and the caller should close it.
+    """
+    if session is None:
+        session = Session.object_session( obj )
+    if session is None:
+        return ( get_session(), True )
+    return ( session, False )
+
+
 class Base( DeclarativeBase ):
     pass
 
@@ -90,6 +144,62 @@ role_permission_association = Table(
 )
 """ Link table for a many-to-many association between roles and permissions"""
 
+acl_version_table = Table(
+    "acl_version",
+    Base.metadata,
+    Column( "id", Integer, primary_key = True ),
+    Column( "version", BigInteger, nullable = False ),
+)
+"""Single row counter, bumped whenever members, roles, or permissions change"""
+
+acl_changes_table = Table(
+    "acl_changes",
+    Base.metadata,
+    Column( "id", Integer, primary_key = True ),
+    Column( "version", BigInteger, nullable = False, index = True ),
+    Column( "rfid", String, nullable = True ),
+)
+"""Tags changed by each ACL version. A null rfid means everything changed."""
+
+cache_generation_table = Table(
+    "cache_generation",
+    Base.metadata,
+    Column( "id", Integer, primary_key = True ),
+    Column( "generation", BigInteger, nullable = False ),
+)
+"""Single row counter, bumped by Doorbot.InvalidationBus on SQLite"""
+
+schema_migrations_table = Table(
+    "schema_migrations",
+    Base.metadata,
+    Column( "version", Integer, primary_key = True, autoincrement = False ),
+    Column( "name", String, nullable = False ),
+    Column( "applied_at", DateTime( timezone = True ), nullable = False ),
+)
+"""Versions applied by Doorbot.Migrations"""
+
+scan_stats_hourly_table = Table(
+    "scan_stats_hourly",
+    Base.metadata,
+    Column( "location", Integer, primary_key = True ),
+    Column( "hour", DateTime( timezone = True ), primary_key = True ),
+    Column( "total_scans", Integer, nullable = False, default = 0 ),
+    Column( "active_scans", Integer, nullable = False, default = 0 ),
+    Column( "found_scans", Integer, nullable = False, default = 0 ),
+    Column( "unique_tags", Integer, nullable = False, default = 0 ),
+    Index( "scan_stats_hourly_hour_idx", "hour" ),
+)
+"""Scan counts per location per hour, kept up to date by Doorbot.ScanStats"""
+
+scan_stats_hourly_tags_table = Table(
+    "scan_stats_hourly_tags",
+    Base.metadata,
+    Column( "location", Integer, primary_key = True ),
+    Column( "hour", DateTime( timezone = True ), primary_key = True ),
+    Column( "rfid", String, primary_key = True ),
+)
+"""Each tag scanned at a location in an hour, for counting unique tags"""
+
 class Member( Base ):
     """ Represents a member in the database"""
 
@@ -170,6 +280,17 @@ class Member( Base ):
         member = session.scalars( stmt ).one_or_none()
         return member
 
+    def active_tags_stmt():
+        """Select statement for the RFID tags of all active members
+
+        Only the tag column is selected, which the index on (active, rfid)
+        covers.
+        """
+        return select( Member.rfid ).where(
+            Member.active == True,
+            Member.rfid.is_not( None ),
+        )
+
     def get_by_username( username, session ):
         """Fetch a single member by username"""
         stmt = select( Member ).where(
@@ -178,66 +299,77 @@ class Member( Base ):
         member = session.scalars( stmt ).one_or_none()
         return member
 
-    def has_permission( self, permission ):
-        """Returns true if this member has access to the named permission"""
+    def check_permission_by_tag( tag, permission, session ):
+        """Resolve a tag's access to a permission in a single query
 
-        session = get_session()
+        Returns a row of (active, full_name, has_permission), or None if
+        no member has that tag.
+        """
+        if isinstance( permission, Permission ):
+            permission = permission.name
+
+        stmt = select(
+            Member.active,
+            Member.full_name,
+            _member_permission_exists( Member.id, permission ).label(
+                'has_permission'
+            ),
+        ).where(
+            Member.rfid == tag
+        )
+        return session.execute( stmt ).one_or_none()
 
+    def has_permission( self, permission, session = None ):
+        """Returns true if this member has access to the named permission"""
         if isinstance( permission, Permission ):
             permission = permission.name
-            stmt = select( Permission ).where(
-                Permission.name == permission
-            )
-            permission = session.scalars( stmt ).one()
 
-        result = session.query(
-                Permission.name
-            ).filter(
-                member_role_association.c.member_id == self.id
-            ).filter(
-                member_role_association.c.role_id == Role.id
-            ).filter(
-                role_permission_association.c.role_id == Role.id
-            ).filter(
-                role_permission_association.c.permission_id == Permission.id
-            ).filter(
-                Permission.name == permission
-            ).first()
-        session.close()
-
-        return result is not None
-
-    def all_permissions( self ):
+        session, is_own_session = _session_for( self, session )
+        result = session.scalar(
+            select( _member_permission_exists( self.id, permission ) )
+        )
+        if is_own_session:
+            session.close()
+
+        return bool( result )
+
+    def all_permissions( self, session = None ):
         """Fetch a list of all permissions for this member"""
-        session = get_session()
+        session, is_own_session = _session_for( self, session )
 
-        result = session.query(
+        stmt = select(
                 Permission
-            ).filter(
+            ).join(
+                role_permission_association,
+                role_permission_association.c.permission_id == Permission.id,
+            ).join(
+                member_role_association,
+                member_role_association.c.role_id ==
+                    role_permission_association.c.role_id,
+            ).where(
                 member_role_association.c.member_id == self.id
-            ).filter(
-                member_role_association.c.role_id == Role.id
-            ).filter(
-                role_permission_association.c.role_id == Role.id
-            ).filter(
-                role_permission_association.c.permission_id == Permission.id
-            ).all()
-        session.close()
+            ).distinct()
+        result = session.scalars( stmt ).all()
+        if is_own_session:
+            session.close()
 
         return result
 
-    def all_roles( self ):
+    def all_roles( self, session = None ):
         """Fetch a list of all roles for this member"""
-        session = get_session()
+        session, is_own_session = _session_for( self, session )
 
-        result = session.query(
+        stmt = select(
                 Role
-            ).filter(
+            ).join(
+                member_role_association,
+                member_role_association.c.role_id == Role.id,
+            ).where(
                 member_role_association.c.member_id == self.id
-            ).filter(
-                member_role_association.c.role_id == Role.id
-            ).all()
-        session.close()
+            )
+        result = session.scalars( stmt ).all()
+        if is_own_session:
+            session.close()
 
         return result
 
@@ -458,6 +590,11 @@ class Location( Base ):
 class EntryLog( Base ):
     """A log of all scans"""
     __tablename__ = "entry_log"
+    __table_args__ = (
+        # Match the keyset pagination in Doorbot.API.search_scan_logs()
+        Index( "entry_log_time_id_idx", "entry_time", "id" ),
+        Index( "entry_log_rfid_time_id_idx", "rfid", "entry_time", "id" ),
+    )
 
     id: Mapped[ int ] = mapped_column( primary_key = True )
     rfid: Mapped[ str ] = mapped_column(
@@ -508,42 +645,120 @@ class Role( Base ):
         back_populates = "roles",
     )
 
-    def has_permission( self, permission ):
-        session = get_session()
-
+    def has_permission( self, permission, session = None ):
+        """Returns true if this role has the named permission"""
         if isinstance( permission, Permission ):
             permission = permission.name
-            stmt = select( Permission ).where(
-                Permission.name == permission
-            )
-            permission = session.scalars( stmt ).one()
 
-        query = session.query( Permission ).join(
-                Role,
-                Permission.roles,
-            ).where(
-                (Permission.name == permission) &
-                (Role.id == self.id)
+        session, is_own_session = _session_for( self, session )
+        stmt = select(
+            exists().where(
+                role_permission_association.c.role_id == self.id,
+                role_permission_association.c.permission_id == Permission.id,
+                Permission.name == permission,
             )
-        result = query.first()
+        )
+        result = session.scalar( stmt )
+        if is_own_session:
+            session.close()
 
-        session.close()
-        return result is not None
+        return bool( result )
 
-    def all_permissions( self ):
-        session = get_session()
+    def all_permissions( self, session = None ):
+        """Fetch a list of all permissions for this role"""
+        session, is_own_session = _session_for( self, session )
 
-        result = session.query(
+        stmt = select(
                 Permission
-            ).filter(
+            ).join(
+                role_permission_association,
+                role_permission_association.c.permission_id == Permission.id,
+            ).where(
                 role_permission_association.c.role_id == self.id
-            ).filter(
-                role_permission_association.c.permission_id == Permission.id
-            ).all()
+            )
+        result = session.scalars( stmt ).all()
+        if is_own_session:
+            session.close()
 
-        session.close()
         return result
 
+    def summaries( session ):
+        """Every role with its permission names and number of members
+
+        Returns a list of ( name, permission_names, member_count ) tuples in
+        order of role id. Takes two queries no matter how many roles there
+        are, and never loads the members themselves.
+        """
+        counts = session.execute(
+            select(
+                Role.id,
+                Role.name,
+                func.count( member_role_association.c.member_id ),
+            ).outerjoin(
+                member_role_association,
+                member_role_association.c.role_id == Role.id,
+            ).group_by(
+                Role.id,
+                Role.name,
+            ).order_by(
+                Role.id
+            )
+        ).all()
+
+        permission_names = {}
+        for role_id, name in session.execute(
+            select(
+                role_permission_association.c.role_id,
+                Permission.name,
+            ).join(
+                Permission,
+                Permission.id == role_permission_association.c.permission_id,
+            ).order_by(
+                role_permission_association.c.role_id,
+                Permission.id,
+            )
+        ):
+            permission_names.setdefault( role_id, [] ).append( name )
+
+        return [
+            ( name, permission_names.get( role_id, [] ), member_count )
+            for role_id, name, member_count in counts
+        ]
+
+    def member_names( name, session ):
+        """Full names of the members of the named role"""
+        stmt = select(
+            Member.full_name
+        ).join(
+            member_role_association,
+            member_role_association.c.member_id == Member.id,
+        ).join(
+            Role,
+            Role.id == member_role_association.c.role_id,
+        ).where(
+            Role.name == name
+        ).order_by(
+            Member.id
+        )
+        return session.scalars( stmt ).all()
+
+    def permission_names( name, session ):
+        """Names of the permissions of the named role"""
+        stmt = select(
+            Permission.name
+        ).join(
+            role_permission_association,
+            role_permission_association.c.permission_id == Permission.id,
+        ).join(
+            Role,
+            Role.id == role_permission_association.c.role_id,
+        ).where(
+            Role.name == name
+        ).order_by(
+            Permission.id
+        )
+        return session.scalars( stmt ).all()
+
 class Permission( Base ):
     """Permissions which can be attached to a member"""
     __tablename__ = "permissions"
@@ -563,27 +778,69 @@ class Permission( Base ):
     def all_members_with_permission(
         self,
         do_allow_inactive = False,
+        session = None,
     ):
-        session = get_session()
-
-        query = session.query(
-                Member
-            ).filter(
-                role_permission_association.c.permission_id == self.id
-            ).filter(
-                role_permission_association.c.role_id == Role.id
-            ).filter(
-                member_role_association.c.role_id == Role.id
-            ).filter(
-                member_role_association.c.member_id == Member.id
-            )
+        """Fetch a list of all members who have this permission"""
+        session, is_own_session = _session_for( self, session )
+
+        stmt = select( Member ).where(
+            _member_permission_exists( Member.id, self.name )
+        )
         if not do_allow_inactive:
-            query = query.filter( Member.active == True )
+            stmt = stmt.where( Member.active == True )
 
-        result = query.all()
-        session.close()
+        result = session.scalars( stmt ).all()
+        if is_own_session:
+            session.close()
         return result
 
+    def tags_with_permission(
+        permission,
+        session,
+        do_allow_inactive = False,
+    ):
+        """Fetch the RFID tags of all members with the named permission
+
+        Only the tag column is fetched, so no Member objects are built.
+        """
+        stmt = Permission.tags_with_permission_stmt(
+            permission,
+            do_allow_inactive,
+        )
+        return session.scalars( stmt ).all()
+
+    def tags_with_permission_stmt(
+        permission,
+        do_allow_inactive = False,
+    ):
+        """Select statement for tags_with_permission(), for streaming"""
+        if isinstance( permission, Permission ):
+            permission = permission.name
+
+        stmt = select( Member.rfid ).where(
+            _member_permission_exists( Member.id, permission ),
+            Member.rfid.is_not( None ),
+        )
+        if not do_allow_inactive:
+            stmt = stmt.where( Member.active == True )
+
+        return stmt
+
+
+def _member_permission_exists( member_id, permission_name ):
+    """EXISTS clause for a member having a permission through any of its roles
+
+    The lookup goes through the indexes on role_members (member_id),
+    role_permissions (role_id), and permissions (name).
+    """
+    return exists().where(
+        member_role_association.c.member_id == member_id,
+        role_permission_association.c.role_id ==
+            member_role_association.c.role_id,
+        Permission.id == role_permission_association.c.permission_id,
+        Permission.name == permission_name,
+    )
+
 class OauthToken( Base ):
     """Represents an OAuth2 bearer token"""
     __tablename__ = "oauth_tokens"
@@ -0,0 +1,247 @@
+"""Hourly rollups of the entry log
+
+For each location and hour, 'scan_stats_hourly' keeps the number of scans,
+how many were of active tags, how many were of known tags, and how many
+different tags were scanned. 'scan_stats_hourly_tags' keeps the tags
+themselves, so unique tags can be counted over any range of hours without
+going back to the entry log.
+
+The entry log writer calls record() with each batch it writes, in a
+savepoint within the same transaction, so the rollups match the log. If
+record() fails, the scans are still written and the error is logged.
+rebuild() fills the rollups in from the log, for rows written before they
+existed or while they were failing.
+
+Hours are in UTC. Scans without a location aren't counted.
+"""
+import Doorbot.Config
+from datetime import timezone
+from Doorbot.SQLAlchemy import EntryLog
+from Doorbot.SQLAlchemy import Location
+from Doorbot.SQLAlchemy import get_engine
+from Doorbot.SQLAlchemy import scan_stats_hourly_table
+from Doorbot.SQLAlchemy import scan_stats_hourly_tags_table
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects import sqlite
+
+
+REBUILD_BATCH_SIZE = 1000
+
+
+def is_enabled():
+    conf = Doorbot.Config.get( 'scan_stats', {} )
+    return conf.get( 'enabled', True )
+
+def hour_start( entry_time ):
+    """Start of the UTC hour the time falls in
+
+    Times without a timezone are taken as UTC.
+    """
+    if entry_time.tzinfo is None:
+        entry_time = entry_time.replace( tzinfo = timezone.utc )
+    return entry_time.astimezone( timezone.utc ).replace(
+        minute = 0,
+        second = 0,
+        microsecond = 0,
+    )
+
+def _insert( conn, table ):
+    # Both have ON CONFLICT, but SQLAlchemy keeps it with each dialect
+    if conn.dialect.name == "postgresql":
+        return postgresql.insert( table )
+    return sqlite.insert( table )
+
+def record( conn, rows ):
+    """Add entry log rows to the rollups
+
+    Takes the same dicts that are inserted into the entry log, and should be
+    run in the same transaction, within a savepoint.
+    """
+    counts = {}
+    tags = set()
+    for row in rows:
+        if row[ "location" ] is None:
+            continue
+
+        key = ( row[ "location" ], hour_start( row[ "entry_time" ] ) )
+        count = counts.setdefault( key, [ 0, 0, 0 ] )
+        count[0] += 1
+        count[1] += 1 if row[ "is_active_tag" ] else 0
+        count[2] += 1 if row[ "is_found_tag" ] else 0
+        tags.add( ( *key, row[ "rfid" ] ) )
+
+    if not counts:
+        return
+
+    # Rows are always locked in the same order, so two batches with some of
+    # the same keys can't deadlock each other
+    table = scan_stats_hourly_table
+    stmt = _insert( conn, table ).values([
+        {
+            "location": location,
+            "hour": hour,
+            "total_scans": total,
+            "active_scans": active,
+            "found_scans": found,
+            "unique_tags": 0,
+        }
+        for ( location, hour ), ( total, active, found )
+            in sorted( counts.items() )
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements = [ table.c.location, table.c.hour ],
+        set_ = {
+            "total_scans": table.c.total_scans + stmt.excluded.total_scans,
+            "active_scans": table.c.active_scans + stmt.excluded.active_scans,
+            "found_scans": table.c.found_scans + stmt.excluded.found_scans,
+        },
+    )
+    conn.execute( stmt )
+
+    tags_table = scan_stats_hourly_tags_table
+    conn.execute(
+        _insert( conn, tags_table ).values([
+            { "location": location, "hour": hour, "rfid": rfid }
+            for location, hour, rfid in sorted( tags )
+        ]).on_conflict_do_nothing()
+    )
+
+    # Recount rather than add, since some of the tags may have been seen
+    # earlier in the hour
+    for location, hour in sorted( counts ):
+        conn.execute(
+            update( table ).where(
+                table.c.location == location,
+                table.c.hour == hour,
+            ).values(
+                unique_tags = select(
+                    func.count()
+                ).select_from(
+                    tags_table
+                ).where(
+                    tags_table.c.location == location,
+                    tags_table.c.hour == hour,
+                ).scalar_subquery()
+            )
+        )
+
+def rebuild( start, end, engine = None ):
+    """Recompute the rollups from the entry log
+
+    Covers the hours from the one 'start' falls in, up to the one 'end' falls
+    in. Entry log rows are read in batches, so any range can be rebuilt.
+    """
+    engine = engine or get_engine()
+    start = hour_start( start )
+    end = hour_start( end )
+
+    with engine.begin() as conn:
+        for table in ( scan_stats_hourly_table, scan_stats_hourly_tags_table ):
+            conn.execute(
+                delete( table ).where(
+                    table.c.hour >= start,
+                    table.c.hour < end,
+                )
+            )
+
+        stmt = select(
+            EntryLog.rfid,
+            EntryLog.location,
+            EntryLog.entry_time,
+            EntryLog.is_active_tag,
+            EntryLog.is_found_tag,
+        ).where(
+            EntryLog.entry_time >= start,
+            EntryLog.entry_time < end,
+        )
+        result = conn.execution_options(
+            stream_results = True,
+            yield_per = REBUILD_BATCH_SIZE,
+        ).execute( stmt )
+        for batch in result.mappings().partitions():
+            record( conn, batch )
+
+def hourly( session, start, end, location_id = None ):
+    """Rollup rows for each location and hour from start up to end
+
+    Each row has the location name, hour, total_scans, active_scans,
+    found_scans, and unique_tags, in order of hour and then location.
+    """
+    table = scan_stats_hourly_table
+    stmt = select(
+        Location.name.label( "location" ),
+        table.c.hour,
+        table.c.total_scans,
+        table.c.active_scans,
+        table.c.found_scans,
+        table.c.unique_tags,
+    ).join(
+        Location,
+        Location.id == table.c.location,
+    ).where(
+        table.c.hour >= hour_start( start ),
+        table.c.hour < end,
+    ).order_by(
+        table.c.hour,
+        Location.name,
+    )
+    if location_id is not None:
+        stmt = stmt.where( table.c.location == location_id )
+
+    return session.execute( stmt ).all()
+
+def totals( session, start, end, location_id = None ):
+    """Totals for each location from start up to end
+
+    Returns a dict of location name to a dict of total_scans, active_scans,
+    found_scans, and unique_tags. Unique tags are counted over the whole
+    range, not added up from each hour.
+    """
+    table = scan_stats_hourly_table
+    tags_table = scan_stats_hourly_tags_table
+    start = hour_start( start )
+
+    stmt = select(
+        Location.name,
+        func.sum( table.c.total_scans ),
+        func.sum( table.c.active_scans ),
+        func.sum( table.c.found_scans ),
+    ).join(
+        Location,
+        Location.id == table.c.location,
+    ).where(
+        table.c.hour >= start,
+        table.c.hour < end,
+    ).group_by(
+        Location.name,
+    )
+    tags_stmt = select(
+        Location.name,
+        func.count( func.distinct( tags_table.c.rfid ) ),
+    ).join(
+        Location,
+        Location.id == tags_table.c.location,
+    ).where(
+        tags_table.c.hour >= start,
+        tags_table.c.hour < end,
+    ).group_by(
+        Location.name,
+    )
+    if location_id is not None:
+        stmt = stmt.where( table.c.location == location_id )
+        tags_stmt = tags_stmt.where( tags_table.c.location == location_id )
+
+    unique_tags = dict( session.execute( tags_stmt ).all() )
+    return {
+        name: {
+            "total_scans": total or 0,
+            "active_scans": active or 0,
+            "found_scans": found or 0,
+            "unique_tags": unique_tags.get( name, 0 ),
+        }
+        for name, total, active, found in session.execute( stmt )
+    }
@@ -1,15 +1,59 @@
 #!/usr/bin/python3
 import flask
 import psycopg2
+import Doorbot.ACLSnapshot
 import Doorbot.Config
+import Doorbot.EntryLogPartitions
+import Doorbot.InvalidationBus
 import Doorbot.Pages
+import Doorbot.QueryCheck
 import Doorbot.SQLAlchemy
 from Doorbot.API import app
 from datetime import timedelta
 
+try:
+    import uwsgi
+    from uwsgidecorators import cron
+    from uwsgidecorators import postfork
+except ImportError:
+    # Not running under uwsgi
+    uwsgi = None
+    cron = None
+    postfork = None
+
+
+if uwsgi is not None and uwsgi.opt.get( 'gevent' ):
+    # psycopg2 blocks the whole process while it waits on the database, so
+    # have it yield to other greenlets instead. This has to happen before
+    # any connections are made.
+    import psycogreen.gevent
+    psycogreen.gevent.patch_psycopg()
 
 session_conf = Doorbot.Config.get( 'session' )
 app.secret_key = session_conf[ 'key' ]
 app.config[ 'PERMANENT_SESSION_LIFETIME' ] = timedelta(
     minutes = session_conf[ 'life_minutes' ]
 )
+
+if Doorbot.QueryCheck.is_enabled():
+    Doorbot.QueryCheck.enable()
+
+if postfork is not None:
+    # uwsgi forks workers from C, so make sure they don't share the master's
+    # database connections
+    postfork( Doorbot.SQLAlchemy.dispose_engine )
+    # Each worker listens for changes made by the others
+    postfork( Doorbot.InvalidationBus.start )
+else:
+    Doorbot.InvalidationBus.start()
+
+if cron is not None:
+    # Keep entry log partitions ahead of the calendar, every day at 03:15
+    @cron( 15, 3, -1, -1, -1 )
+    def maintain_entry_log_partitions( signum ):
+        Doorbot.EntryLogPartitions.maintain()
+
+    # Keep the ACL snapshot up to date for all the workers, every minute
+    @cron( -1, -1, -1, -1, -1 )
+    def refresh_acl_snapshot( signum ):
+        Doorbot.ACLSnapshot.refresh()
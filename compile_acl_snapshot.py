@@ -0,0 +1,12 @@
+#!/usr/bin/python3
+# Write the ACL snapshot file that workers check tags against. Run this from
+# cron when not running under uwsgi, which does it by itself. Pass --force to
+# write it even if the ACL hasn't changed.
+import sys
+import Doorbot.ACLSnapshot
+
+if "--force" in sys.argv[1:]:
+    version = Doorbot.ACLSnapshot.compile_snapshot()
+    print( f"Wrote ACL snapshot version {version}" )
+elif Doorbot.ACLSnapshot.refresh():
+    print( "Wrote new ACL snapshot" )
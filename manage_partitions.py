@@ -0,0 +1,11 @@
+#!/usr/bin/python3
+# Create upcoming entry log partitions and retire old ones, per the
+# entry_log.partitions settings in config.yml. uwsgi does this daily; run
+# this after setting up a new database, or to do it right away.
+import Doorbot.EntryLogPartitions
+
+created, retired = Doorbot.EntryLogPartitions.maintain()
+for name in created:
+    print( f"Created {name}" )
+for name in retired:
+    print( f"Retired {name}" )
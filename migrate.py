@@ -0,0 +1,12 @@
+#!/usr/bin/python3
+# Apply schema migrations that haven't been applied yet. Run this after
+# creating the database from sql/pg.sql, and after each upgrade.
+#
+# On PostgreSQL, indexes on the live tables are built with CREATE INDEX
+# CONCURRENTLY, so scans keep being logged while this runs. It takes longer
+# than a plain build, and if it's stopped part way through, run it again to
+# finish.
+import Doorbot.Migrations
+
+for migration in Doorbot.Migrations.upgrade():
+    print( f"Applied {migration.version}: {migration.name}" )
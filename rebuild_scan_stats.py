@@ -0,0 +1,18 @@
+#!/usr/bin/python3
+# Fill in the scan statistics rollups from the entry log, such as for scans
+# logged before the rollups existed. Rebuilds the given number of days back
+# from now, one day at a time.
+#
+#     ./rebuild_scan_stats.py 365
+import sys
+import Doorbot.ScanStats
+from datetime import datetime, timedelta, timezone
+
+days = int( sys.argv[1] ) if len( sys.argv ) > 1 else 30
+end = Doorbot.ScanStats.hour_start( datetime.now( timezone.utc ) ) \
+    + timedelta( hours = 1 )
+
+for day in range( days, 0, -1 ):
+    start = end - timedelta( days = day )
+    Doorbot.ScanStats.rebuild( start, start + timedelta( days = 1 ) )
+    print( f"Rebuilt {start.date()}" )
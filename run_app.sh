@@ -1,4 +1,4 @@
 #!/bin/bash
 uwsgi \
-    --http-socket :5002 \
-    --module app:app
+    --ini uwsgi.ini \
+    --http11-socket :5002
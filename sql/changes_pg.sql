@@ -1 +1,81 @@
 ALTER TABLE locations ADD hostname TEXT;
+CREATE TABLE acl_version (
+    id INT PRIMARY KEY NOT NULL,
+    version BIGINT NOT NULL
+);
+INSERT INTO acl_version (id, version) VALUES (1, 1);
+CREATE TABLE acl_changes (
+    id SERIAL PRIMARY KEY NOT NULL,
+    version BIGINT NOT NULL,
+    rfid TEXT
+);
+CREATE INDEX ON acl_changes (version);
+CREATE INDEX entry_log_time_id_idx ON entry_log (entry_time DESC, id DESC);
+CREATE INDEX entry_log_rfid_time_id_idx
+    ON entry_log (rfid, entry_time DESC, id DESC);
+DROP INDEX IF EXISTS entry_log_entry_time_idx;
+-- Switch entry_log to monthly partitions. The existing table becomes the
+-- partition for everything before this month, and new months are created
+-- by the app. The legacy partition isn't covered by the retention setting;
+-- detach it by hand once it's no longer needed.
+BEGIN;
+ALTER TABLE entry_log RENAME TO entry_log_legacy;
+ALTER TABLE entry_log_legacy DROP CONSTRAINT entry_log_pkey;
+ALTER TABLE entry_log_legacy ADD PRIMARY KEY (id, entry_time);
+ALTER INDEX entry_log_time_id_idx RENAME TO entry_log_legacy_time_id_idx;
+ALTER INDEX entry_log_rfid_time_id_idx
+    RENAME TO entry_log_legacy_rfid_time_id_idx;
+CREATE TABLE entry_log (
+    id              INT NOT NULL DEFAULT nextval('entry_log_id_seq'),
+    rfid            TEXT NOT NULL,
+    entry_time      TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    is_active_tag   BOOLEAN NOT NULL,
+    is_found_tag    BOOLEAN NOT NULL,
+    location        INT REFERENCES locations (id),
+    PRIMARY KEY (id, entry_time)
+) PARTITION BY RANGE (entry_time);
+ALTER SEQUENCE entry_log_id_seq OWNED BY entry_log.id;
+CREATE INDEX entry_log_time_id_idx ON entry_log (entry_time DESC, id DESC);
+CREATE INDEX entry_log_rfid_time_id_idx
+    ON entry_log (rfid, entry_time DESC, id DESC);
+CREATE TABLE entry_log_default PARTITION OF entry_log DEFAULT;
+DO $$
+DECLARE
+    month_start TIMESTAMP WITH TIME ZONE := date_trunc( 'month', now() );
+BEGIN
+    -- This month's scans don't fit the legacy partition's range. They go to
+    -- the default partition, and move to this month's partition once the app
+    -- creates it.
+    INSERT INTO entry_log
+        (id, rfid, entry_time, is_active_tag, is_found_tag, location)
+    SELECT id, rfid, entry_time, is_active_tag, is_found_tag, location
+    FROM entry_log_legacy
+    WHERE entry_time >= month_start;
+    DELETE FROM entry_log_legacy WHERE entry_time >= month_start;
+
+    EXECUTE format(
+        'ALTER TABLE entry_log ATTACH PARTITION entry_log_legacy'
+        ' FOR VALUES FROM (MINVALUE) TO (%L)',
+        month_start
+    );
+END $$;
+CREATE SCHEMA entry_log_archive;
+COMMIT;
+CREATE TABLE scan_stats_hourly (
+    location        INT NOT NULL,
+    hour            TIMESTAMP WITH TIME ZONE NOT NULL,
+    total_scans     INT NOT NULL DEFAULT 0,
+    active_scans    INT NOT NULL DEFAULT 0,
+    found_scans     INT NOT NULL DEFAULT 0,
+    unique_tags     INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (location, hour)
+);
+CREATE INDEX scan_stats_hourly_hour_idx ON scan_stats_hourly (hour);
+CREATE TABLE scan_stats_hourly_tags (
+    location        INT NOT NULL,
+    hour            TIMESTAMP WITH TIME ZONE NOT NULL,
+    rfid            TEXT NOT NULL,
+    PRIMARY KEY (location, hour, rfid)
+);
+-- Later schema changes are migrations in Doorbot/Migrations.py. Run
+-- ./migrate.py after applying everything above.
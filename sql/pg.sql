@@ -31,17 +31,26 @@ INSERT INTO locations (name) VALUES
     ,( 'woodshop.door' )
     ,( 'dummy' );
 
+-- Partitioned by month. Doorbot.EntryLogPartitions creates partitions ahead
+-- of time and archives old ones. Anything outside the monthly partitions
+-- lands in entry_log_default until its month is created.
 CREATE TABLE entry_log (
-    id              SERIAL PRIMARY KEY NOT NULL,
+    id              SERIAL NOT NULL,
     -- This could be some random RFID tag, which we may not have in our 
     -- database.  So don't reference tags in bodgery_rfid directly.
     rfid            TEXT NOT NULL,
     entry_time      TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
     is_active_tag   BOOLEAN NOT NULL,
     is_found_tag    BOOLEAN NOT NULL,
-    location        INT REFERENCES locations (id)
-);
-CREATE INDEX ON entry_log (entry_time DESC);
+    location        INT REFERENCES locations (id),
+    PRIMARY KEY (id, entry_time)
+) PARTITION BY RANGE (entry_time);
+CREATE TABLE entry_log_default PARTITION OF entry_log DEFAULT;
+-- Match the keyset pagination in Doorbot.API.search_scan_logs()
+CREATE INDEX entry_log_time_id_idx ON entry_log (entry_time DESC, id DESC);
+CREATE INDEX entry_log_rfid_time_id_idx
+    ON entry_log (rfid, entry_time DESC, id DESC);
+CREATE SCHEMA entry_log_archive;
 
 CREATE TABLE roles (
     id SERIAL PRIMARY KEY NOT NULL,
@@ -78,3 +87,43 @@ CREATE TABLE oauth_tokens (
     member_id INT NOT NULL REFERENCES members (id)
 );
 CREATE INDEX ON oauth_tokens (member_id);
+
+-- Bumped by the app whenever members, roles, or permissions change
+CREATE TABLE acl_version (
+    id INT PRIMARY KEY NOT NULL,
+    version BIGINT NOT NULL
+);
+INSERT INTO acl_version (id, version) VALUES (1, 1);
+
+-- Tags changed by each ACL version; a NULL rfid means everything changed
+CREATE TABLE acl_changes (
+    id SERIAL PRIMARY KEY NOT NULL,
+    version BIGINT NOT NULL,
+    rfid TEXT
+);
+CREATE INDEX ON acl_changes (version);
+
+-- Versions applied by Doorbot.Migrations; run ./migrate.py after this file
+CREATE TABLE schema_migrations (
+    version     INT PRIMARY KEY NOT NULL,
+    name        TEXT NOT NULL,
+    applied_at  TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+-- Rollups of entry_log, kept up to date by Doorbot.ScanStats
+CREATE TABLE scan_stats_hourly (
+    location        INT NOT NULL,
+    hour            TIMESTAMP WITH TIME ZONE NOT NULL,
+    total_scans     INT NOT NULL DEFAULT 0,
+    active_scans    INT NOT NULL DEFAULT 0,
+    found_scans     INT NOT NULL DEFAULT 0,
+    unique_tags     INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (location, hour)
+);
+CREATE INDEX scan_stats_hourly_hour_idx ON scan_stats_hourly (hour);
+CREATE TABLE scan_stats_hourly_tags (
+    location        INT NOT NULL,
+    hour            TIMESTAMP WITH TIME ZONE NOT NULL,
+    rfid            TEXT NOT NULL,
+    PRIMARY KEY (location, hour, rfid)
+);
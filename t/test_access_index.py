@@ -0,0 +1,165 @@
+import unittest
+import os
+import Doorbot.Config
+import Doorbot.AccessIndex
+import Doorbot.SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+RFID_FOO = "1234"
+RFID_BAR = "2345"
+RFID_BAZ = "3456"
+
+
+class TestAccessIndex( unittest.TestCase ):
+    @classmethod
+    def setUpClass( cls ):
+        if 'PG' != os.environ.get( 'DB' ):
+            Doorbot.SQLAlchemy.set_engine_sqlite()
+
+        global engine
+        engine = Doorbot.SQLAlchemy.get_engine()
+
+        permission_front_door = Doorbot.SQLAlchemy.Permission(
+            name = "front.door",
+        )
+        permission_wood_bandsaw = Doorbot.SQLAlchemy.Permission(
+            name = "woodshop.bandsaw",
+        )
+
+        role_doors = Doorbot.SQLAlchemy.Role(
+            name = "doors",
+        )
+        role_doors.permissions.append( permission_front_door )
+        role_wood = Doorbot.SQLAlchemy.Role(
+            name = "woodshop",
+        )
+        role_wood.permissions.append( permission_wood_bandsaw )
+
+        member_foo = Doorbot.SQLAlchemy.Member(
+            full_name = "foo",
+            rfid = RFID_FOO,
+        )
+        member_foo.roles.append( role_doors )
+        member_bar = Doorbot.SQLAlchemy.Member(
+            full_name = "bar",
+            rfid = RFID_BAR,
+        )
+        member_bar.roles.append( role_doors )
+        member_bar.roles.append( role_wood )
+
+        session = Session( engine )
+        session.add_all([
+            permission_front_door,
+            permission_wood_bandsaw,
+            role_doors,
+            role_wood,
+            member_foo,
+            member_bar,
+        ])
+        session.commit()
+        session.close()
+
+    def test_lookup( self ):
+        index = Doorbot.AccessIndex.get_index()
+
+        entry = index.lookup( RFID_BAR )
+        self.assertEqual( entry.full_name, "bar", "Found member by tag" )
+        self.assertTrue( entry.active, "Member is active" )
+        self.assertEqual( entry.permissions, {
+            "front.door",
+            "woodshop.bandsaw",
+        }, "Permissions gathered across roles" )
+
+        self.assertIsNone( index.lookup( "9999" ), "Unknown tag not found" )
+
+        self.assertTrue( index.has_permission( RFID_FOO, "front.door" ),
+            "Member has permission through role" )
+        self.assertFalse( index.has_permission( RFID_FOO, "woodshop.bandsaw" ),
+            "Member does not have permission of other role" )
+
+    def test_unknown_permission_skips_db( self ):
+        index = Doorbot.AccessIndex.get_index()
+        index.lookup( RFID_FOO )
+
+        queries = []
+        def count_query( *args ):
+            queries.append( args )
+        event.listen( engine, "before_cursor_execute", count_query )
+        try:
+            self.assertFalse( index.has_permission( RFID_FOO, "no.such" ),
+                "Unknown permission is rejected" )
+        finally:
+            event.remove( engine, "before_cursor_execute", count_query )
+
+        self.assertEqual( len( queries ), 0, "No queries were run" )
+
+    def test_member_change_updates_index( self ):
+        index = Doorbot.AccessIndex.get_index()
+        member = Doorbot.SQLAlchemy.Member(
+            full_name = "baz",
+            rfid = RFID_BAZ,
+        )
+        session = Session( engine )
+        session.add( member )
+        session.commit()
+
+        self.assertTrue( index.lookup( RFID_BAZ ).active,
+            "New member is in index" )
+
+        member.active = False
+        session.add( member )
+        session.commit()
+        session.close()
+
+        self.assertFalse( index.lookup( RFID_BAZ ).active,
+            "Deactivated member is updated in index" )
+
+    def test_role_change_updates_index( self ):
+        index = Doorbot.AccessIndex.get_index()
+        self.assertFalse( index.has_permission( RFID_FOO, "woodshop.tablesaw" ),
+            "Member does not yet have permission" )
+
+        session = Session( engine )
+        role = session.query( Doorbot.SQLAlchemy.Role ).filter_by(
+            name = "doors"
+        ).one()
+        role.permissions.append( Doorbot.SQLAlchemy.Permission(
+            name = "woodshop.tablesaw",
+        ))
+        session.add( role )
+        session.commit()
+        session.close()
+
+        self.assertTrue( index.has_permission( RFID_FOO, "woodshop.tablesaw" ),
+            "Member has new permission added to role" )
+
+    def test_change_during_refresh( self ):
+        index = Doorbot.AccessIndex.AccessIndex()
+        index.lookup( RFID_FOO )
+        index.invalidate_tags([ RFID_FOO ])
+
+        # The tag changes again while it's being reloaded
+        changes = [ RFID_FOO ]
+        def change_tag( *args ):
+            if changes:
+                index.invalidate_tags([ changes.pop() ])
+        event.listen( engine, "before_cursor_execute", change_tag )
+        try:
+            self.assertEqual( index.lookup( RFID_FOO ).full_name, "foo" )
+        finally:
+            event.remove( engine, "before_cursor_execute", change_tag )
+
+        queries = []
+        def count_query( *args ):
+            queries.append( args )
+        event.listen( engine, "before_cursor_execute", count_query )
+        try:
+            index.lookup( RFID_FOO )
+            index.lookup( RFID_FOO )
+        finally:
+            event.remove( engine, "before_cursor_execute", count_query )
+
+        self.assertEqual( len( queries ), 1,
+            "Reloaded again, and only kept once nothing changed" )
@@ -0,0 +1,57 @@
+import unittest
+import Doorbot.ACLExport
+
+
+TAGS = [ "0001234", "2345", "2345", "98765432101", "not_a_tag" ]
+
+
+class TestACLExport( unittest.TestCase ):
+    def test_packed_round_trip( self ):
+        payload = Doorbot.ACLExport.encode_packed( TAGS, 42 )
+        self.assertEqual( len( payload ),
+            Doorbot.ACLExport.PACKED_HEADER.size + 4 * 11,
+            "Header plus one key as wide as the longest per unique tag" )
+
+        version, tags = Doorbot.ACLExport.decode_packed( payload )
+        self.assertEqual( version, 42, "ACL version in header" )
+        self.assertEqual( tags, [ "0001234", "2345", "98765432101",
+            "not_a_tag" ], "Tags are sorted and unique" )
+
+    def test_leading_zeros( self ):
+        payload = Doorbot.ACLExport.encode_packed( [ "0009876", "9876" ], 1 )
+        version, tags = Doorbot.ACLExport.decode_packed( payload )
+        self.assertEqual( tags, [ "0009876", "9876" ],
+            "Leading zeros make a different tag" )
+
+        payload = Doorbot.ACLExport.encode_bloom( [ "0009876" ], 1, 0.000001 )
+        self.assertTrue(
+            Doorbot.ACLExport.bloom_contains( payload, "0009876" ) )
+        self.assertFalse( Doorbot.ACLExport.bloom_contains( payload, "9876" ),
+            "Same number, different tag" )
+
+    def test_unexportable( self ):
+        for tag in ( "1" * ( Doorbot.ACLExport.MAX_TAG_WIDTH + 1 ), "12\x00" ):
+            with self.assertRaises( Doorbot.ACLExport.UnexportableTags ):
+                Doorbot.ACLExport.encode_packed( [ "1234", tag ], 1 )
+            with self.assertRaises( Doorbot.ACLExport.UnexportableTags ):
+                Doorbot.ACLExport.encode_bloom( [ "1234", tag ], 1 )
+
+    def test_bloom_filter( self ):
+        tags = [ str( tag ) for tag in range( 1000, 2000 ) ]
+        payload = Doorbot.ACLExport.encode_bloom( tags, 7, 0.01 )
+
+        for tag in tags:
+            self.assertTrue( Doorbot.ACLExport.bloom_contains( payload, tag ),
+                "No false negatives" )
+
+        false_positives = sum(
+            1 for tag in range( 100000, 110000 )
+            if Doorbot.ACLExport.bloom_contains( payload, str( tag ) )
+        )
+        self.assertLess( false_positives, 300,
+            "False positive rate is near what was asked for" )
+
+    def test_empty_bloom_filter( self ):
+        payload = Doorbot.ACLExport.encode_bloom( [], 1 )
+        self.assertFalse( Doorbot.ACLExport.bloom_contains( payload, "1234" ),
+            "Nothing in an empty filter" )
@@ -0,0 +1,184 @@
+import unittest
+import os
+import tempfile
+import Doorbot.ACL
+import Doorbot.ACLSnapshot
+import Doorbot.SQLAlchemy
+from Doorbot.AccessIndex import AccessEntry
+from sqlalchemy.orm import Session
+
+
+RFID_FOO = "1234"
+RFID_BAR = "23456"
+RFID_BAZ = "3456"
+
+
+class TestACLSnapshot( unittest.TestCase ):
+    @classmethod
+    def setUpClass( cls ):
+        if 'PG' != os.environ.get( 'DB' ):
+            Doorbot.SQLAlchemy.set_engine_sqlite()
+
+        global engine
+        engine = Doorbot.SQLAlchemy.get_engine()
+
+        permission_front_door = Doorbot.SQLAlchemy.Permission(
+            name = "snapshot.front.door",
+        )
+        role_doors = Doorbot.SQLAlchemy.Role(
+            name = "snapshot.doors",
+        )
+        role_doors.permissions.append( permission_front_door )
+        member_foo = Doorbot.SQLAlchemy.Member(
+            full_name = "Snapshot Foo",
+            rfid = RFID_FOO,
+        )
+        member_foo.roles.append( role_doors )
+        member_bar = Doorbot.SQLAlchemy.Member(
+            full_name = "Snapshot Bär",
+            rfid = RFID_BAR,
+            active = False,
+        )
+        member_bar.roles.append( role_doors )
+
+        session = Session( engine )
+        session.add_all([
+            permission_front_door,
+            role_doors,
+            member_foo,
+            member_bar,
+        ])
+        session.commit()
+        session.close()
+
+    def setUp( self ):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join( self.dir.name, "acl.snapshot" )
+
+    def tearDown( self ):
+        self.dir.cleanup()
+
+    def test_write_and_read( self ):
+        Doorbot.ACLSnapshot.write( self.path, 7, {
+            "10": AccessEntry( active = True, full_name = "Ten",
+                permissions = frozenset([ "a", "c" ]) ),
+            "9": AccessEntry( active = False, full_name = None,
+                permissions = frozenset([ "b" ]) ),
+            "100": AccessEntry( active = True, full_name = "Hundred",
+                permissions = frozenset() ),
+        }, [ "c", "b", "a" ] )
+
+        snapshot = Doorbot.ACLSnapshot.Snapshot( self.path )
+        self.assertEqual( snapshot.version, 7 )
+        self.assertEqual( len( snapshot ), 3 )
+        self.assertEqual( Doorbot.ACLSnapshot.file_version( self.path ), 7 )
+
+        self.assertEqual( snapshot.lookup( "10" ), AccessEntry(
+            active = True, full_name = "Ten",
+            permissions = frozenset([ "a", "c" ]) ) )
+        self.assertEqual( snapshot.lookup( "9" ), AccessEntry(
+            active = False, full_name = None,
+            permissions = frozenset([ "b" ]) ) )
+        self.assertEqual( snapshot.lookup( "100" ).full_name, "Hundred" )
+        self.assertIsNone( snapshot.lookup( "1" ), "Prefix not found" )
+        self.assertIsNone( snapshot.lookup( "1000" ), "Too long not found" )
+
+        self.assertTrue( snapshot.has_permission( "10", "c" ) )
+        self.assertFalse( snapshot.has_permission( "10", "b" ) )
+        self.assertFalse( snapshot.has_permission( "9", "b" ),
+            "Inactive tags don't have permissions" )
+        self.assertFalse( snapshot.has_permission( "10", "d" ) )
+        self.assertTrue( snapshot.is_known_permission( "b" ) )
+        self.assertFalse( snapshot.is_known_permission( "d" ) )
+
+    def test_empty( self ):
+        Doorbot.ACLSnapshot.write( self.path, 1, {}, [] )
+        snapshot = Doorbot.ACLSnapshot.Snapshot( self.path )
+        self.assertEqual( len( snapshot ), 0 )
+        self.assertIsNone( snapshot.lookup( RFID_FOO ) )
+
+    def test_bad_file( self ):
+        with open( self.path, "wb" ) as f:
+            f.write( b"not a snapshot at all, not even close" )
+        with self.assertRaises( Doorbot.ACLSnapshot.BadSnapshot ):
+            Doorbot.ACLSnapshot.Snapshot( self.path )
+        self.assertIsNone( Doorbot.ACLSnapshot.file_version( self.path ) )
+
+        cache = Doorbot.ACLSnapshot.SnapshotCache( path = self.path )
+        self.assertIsNone( cache.get(), "Bad file not used" )
+
+    def test_compile( self ):
+        version = Doorbot.ACLSnapshot.compile_snapshot( self.path )
+        snapshot = Doorbot.ACLSnapshot.Snapshot( self.path )
+        self.assertEqual( snapshot.version, version )
+
+        foo = snapshot.lookup( RFID_FOO )
+        self.assertTrue( foo.active )
+        self.assertEqual( foo.full_name, "Snapshot Foo" )
+        self.assertTrue(
+            snapshot.has_permission( RFID_FOO, "snapshot.front.door" ) )
+
+        bar = snapshot.lookup( RFID_BAR )
+        self.assertFalse( bar.active )
+        self.assertEqual( bar.full_name, "Snapshot Bär" )
+        self.assertFalse(
+            snapshot.has_permission( RFID_BAR, "snapshot.front.door" ) )
+        self.assertIsNone( snapshot.lookup( RFID_BAZ ) )
+
+    def test_cache( self ):
+        cache = Doorbot.ACLSnapshot.SnapshotCache(
+            path = self.path,
+            check_interval_seconds = 0,
+        )
+        self.assertIsNone( cache.get(), "No file yet" )
+
+        version = Doorbot.ACLSnapshot.compile_snapshot( self.path )
+        self.assertIsNotNone( cache.current( RFID_FOO ), "Up to date" )
+
+        cache.note_change( Doorbot.ACL.ACLChange( version = version + 1,
+            tags = frozenset([ RFID_FOO ]), everything = False ) )
+        self.assertIsNone( cache.current( RFID_FOO ),
+            "Not trusted for a changed tag" )
+        self.assertIsNotNone( cache.current( RFID_BAR ),
+            "Still trusted for others" )
+        self.assertIsNotNone( cache.get(), "Still there for outages" )
+
+        cache.note_change( Doorbot.ACL.ACLChange( version = None,
+            tags = frozenset(), everything = True ) )
+        self.assertIsNone( cache.current( RFID_BAR ),
+            "Not trusted after an unknown change" )
+
+        # A newer file replaces it
+        Doorbot.ACLSnapshot.write( self.path, version + 1, {}, [] )
+        snapshot = cache.current( RFID_FOO )
+        self.assertIsNotNone( snapshot, "Newer file trusted" )
+        self.assertEqual( snapshot.version, version + 1 )
+
+    def test_cache_behind_database( self ):
+        Doorbot.ACLSnapshot.write( self.path, 0, {}, [] )
+        cache = Doorbot.ACLSnapshot.SnapshotCache( path = self.path )
+        self.assertIsNone( cache.current( RFID_FOO ),
+            "Not trusted when the database is newer" )
+        self.assertIsNotNone( cache.get() )
+
+    def test_cache_database_down( self ):
+        class DownSnapshotCache( Doorbot.ACLSnapshot.SnapshotCache ):
+            is_down = True
+
+            def _database_version( self ):
+                if self.is_down:
+                    return None
+                return super()._database_version()
+
+        Doorbot.ACLSnapshot.compile_snapshot( self.path )
+        cache = DownSnapshotCache(
+            path = self.path,
+            check_interval_seconds = 0,
+        )
+        self.assertIsNone( cache.current( RFID_FOO ),
+            "Not trusted before it's checked" )
+        self.assertIsNotNone( cache.get(), "Still there for outages" )
+
+        cache.is_down = False
+        self.assertIsNotNone( cache.current( RFID_FOO ),
+            "Trusted once the database is back" )
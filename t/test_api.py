@@ -9,6 +9,7 @@ import sqlite3
 import Doorbot.Config
 import Doorbot.API
 import Doorbot.SQLAlchemy
+from datetime import datetime
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 from test_oauth_token import add_bearer_token, bearer_header
@@ -210,6 +211,44 @@ class TestAPI( flask_unittest.ClientTestCase ):
             "Matched quuux in a case insensitive way",
         )
 
+    def test_search_tags_ndjson( self, client ):
+        members = [
+            Doorbot.SQLAlchemy.Member(
+                full_name = "Bulk Member " + str( i ),
+                rfid = str( 700000 + i ),
+                active = i % 2 == 0,
+            )
+            for i in range( 600 )
+        ]
+        session = Session( engine )
+        session.add_all( members )
+        session.commit()
+        session.close()
+
+        rv = client.get( '/v1/search_tags?name=Bulk+Member&limit=1000',
+            headers = {
+                **bearer_header( TOKEN ),
+                'Accept': 'application/x-ndjson',
+            },
+        )
+        self.assertStatus( rv, 200 )
+        self.assertEqual( rv.mimetype, 'application/x-ndjson' )
+
+        rows = [ json.loads( line )
+            for line in rv.data.decode( "UTF-8" ).splitlines() ]
+        self.assertEqual( len( rows ), 600,
+            "Got every member past the old limit of 100" )
+        by_rfid = { row[ "rfid" ]: row for row in rows }
+        self.assertTrue( by_rfid[ "700000" ][ "active" ] )
+        self.assertFalse( by_rfid[ "700001" ][ "active" ] )
+        self.assertEqual( by_rfid[ "700001" ][ "full_name" ], "Bulk Member 1" )
+
+        rv = client.get( '/v1/search_tags?name=Bulk+Member&limit=1000',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertEqual( len( rv.data.decode( "UTF-8" ).splitlines() ), 600,
+            "Same rows as plain text" )
+
     def test_search_entry_log( self, client ):
         session = Session( engine )
         stmt = select( Doorbot.SQLAlchemy.Location ).where(
@@ -255,7 +294,7 @@ class TestAPI( flask_unittest.ClientTestCase ):
         session.add_all( entries )
         session.commit()
 
-        rv = client.get( '/v1/search_entry_log?tag=09876&offset=0&limit=1',
+        rv = client.get( '/v1/search_entry_log?tag=09876&offset=0&limit=2',
             headers = bearer_header( TOKEN )
         )
         data = rv.data.decode( "UTF-8" )
@@ -263,6 +302,140 @@ class TestAPI( flask_unittest.ClientTestCase ):
             match_cleanroom.match( data ),
             "Matched bar",
         )
+        self.assertEqual( len( data.splitlines() ), 2,
+            "Entry with blank location is listed" )
+
+    def test_search_entry_log_cursor( self, client ):
+        session = Session( engine )
+        # Same entry time for all, so only the id tells them apart
+        entry_time = datetime( 2023, 1, 1, 12, 0, 0 )
+        session.add_all([
+            Doorbot.SQLAlchemy.EntryLog(
+                rfid = "56789",
+                is_active_tag = True,
+                is_found_tag = False,
+                entry_time = entry_time,
+            )
+            for _ in range( 5 )
+        ])
+        session.commit()
+        session.close()
+
+        seen = []
+        cursor = None
+        pages = 0
+        while True:
+            url = '/v1/search_entry_log?tag=56789&limit=2'
+            if cursor:
+                url += '&cursor=' + cursor
+            rv = client.get( url, headers = bearer_header( TOKEN ) )
+            self.assertStatus( rv, 200 )
+            pages += 1
+
+            seen.extend( rv.data.decode( "UTF-8" ).splitlines() )
+            cursor = rv.headers.get( 'X-Next-Cursor' )
+            if not cursor:
+                break
+
+        self.assertEqual( len( seen ), 5, "Every entry seen once" )
+
+        rv = client.get( '/v1/search_entry_log?tag=56789&format=ndjson',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
+        rows = [ json.loads( line )
+            for line in rv.data.decode( "UTF-8" ).splitlines() ]
+        self.assertEqual( len( rows ), 5, "All entries as NDJSON" )
+        self.assertEqual( rows[0][ "rfid" ], "56789" )
+        self.assertFalse( rows[0][ "was_found" ] )
+        self.assertEqual( pages, 3, "Paged through in three requests" )
+
+        rv = client.get( '/v1/search_entry_log?cursor=bogus',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 400 )
+
+    def test_search_entry_log_cursor_exact_pages( self, client ):
+        session = Session( engine )
+        session.add_all([
+            Doorbot.SQLAlchemy.EntryLog(
+                rfid = "56790",
+                is_active_tag = True,
+                is_found_tag = True,
+                entry_time = datetime( 2023, 1, 2, hour, 0, 0 ),
+            )
+            for hour in range( 4 )
+        ])
+        session.commit()
+
+        rv = client.get( '/v1/search_entry_log?tag=56790&limit=2',
+            headers = bearer_header( TOKEN ) )
+        self.assertEqual( len( rv.data.decode( "UTF-8" ).splitlines() ), 2 )
+        cursor = rv.headers.get( 'X-Next-Cursor' )
+        self.assertTrue( cursor, "More after the first page" )
+
+        rv = client.get( '/v1/search_entry_log?tag=56790&limit=2&cursor='
+            + cursor, headers = bearer_header( TOKEN ) )
+        self.assertEqual( len( rv.data.decode( "UTF-8" ).splitlines() ), 2 )
+        self.assertIsNone( rv.headers.get( 'X-Next-Cursor' ),
+            "No cursor to an empty page after a full last page" )
+
+        logs, cursor = Doorbot.API.search_scan_logs( "56790", 0, 2, session )
+        self.assertEqual( len( logs ), 2 )
+        logs, cursor = Doorbot.API.search_scan_logs( "56790", 0, 2, session,
+            cursor = cursor )
+        self.assertEqual( len( logs ), 2 )
+        self.assertIsNone( cursor, "Same for searches that aren't streamed" )
+        session.close()
+
+    def test_search_entry_log_name( self, client ):
+        session = Session( engine )
+        session.add_all([
+            Doorbot.SQLAlchemy.Member(
+                full_name = "Jane Quuuuux",
+                rfid = "67890",
+            ),
+            Doorbot.SQLAlchemy.Member(
+                full_name = "Janet Quuuuux",
+                rfid = "67891",
+            ),
+        ])
+        session.add_all([
+            Doorbot.SQLAlchemy.EntryLog(
+                rfid = rfid,
+                is_active_tag = True,
+                is_found_tag = True,
+                entry_time = datetime( 2023, 2, 1, hour, 0, 0 ),
+            )
+            for hour, rfid in ( ( 8, "67890" ), ( 9, "67891" ),
+                ( 10, "67890" ) )
+        ])
+        session.commit()
+        session.close()
+
+        rv = client.get(
+            '/v1/search_entry_log?name=jane%20quuuuux&format=ndjson',
+            headers = bearer_header( TOKEN ),
+        )
+        self.assertStatus( rv, 200 )
+        rows = [ json.loads( line )
+            for line in rv.data.decode( "UTF-8" ).splitlines() ]
+        self.assertEqual( [ row[ "rfid" ] for row in rows ],
+            [ "67890", "67890" ], "Only Jane's scans, newest first" )
+
+        rv = client.get(
+            '/v1/search_entry_log?name=QUUUUUX&limit=2',
+            headers = bearer_header( TOKEN ),
+        )
+        self.assertStatus( rv, 200 )
+        self.assertEqual( len( rv.data.decode( "UTF-8" ).splitlines() ), 2 )
+        self.assertTrue( rv.headers.get( 'X-Next-Cursor' ),
+            "Name searches page like any other" )
+
+        rv = client.get( '/v1/search_entry_log?name=Nobody%20Here',
+            headers = bearer_header( TOKEN ) )
+        self.assertStatus( rv, 200 )
+        self.assertEqual( rv.data.decode( "UTF-8" ), "", "No matches" )
 
     def test_dump_tags( self, client ):
         members = [
@@ -297,6 +470,7 @@ class TestAPI( flask_unittest.ClientTestCase ):
             "12354" in data,
             "Did not fetch deactivated member",
         )
+        self.assertEqual( rv.content_type, "application/json" )
 
     def test_edit_tag( self, client ):
         rv = client.get( '/check_tag/09017', auth = USER_PASS )
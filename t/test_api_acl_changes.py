@@ -0,0 +1,154 @@
+import unittest
+import flask_unittest
+import os
+import threading
+import time
+import Doorbot.Config
+import Doorbot.ACL
+import Doorbot.ACLFeed
+import Doorbot.API
+import Doorbot.SQLAlchemy
+from flask import json
+from sqlalchemy.orm import Session
+from test_oauth_token import add_bearer_token, bearer_header
+
+
+RFID1 = "1234"
+RFID2 = "2345"
+TOKEN = "0123456789abcdef"
+
+
+class TestACLChangesAPI( flask_unittest.ClientTestCase ):
+    app = Doorbot.API.app
+    app.config[ 'is_testing' ] = True
+
+    @classmethod
+    def setUpClass( cls ):
+        if 'PG' != os.environ.get( 'DB' ):
+            Doorbot.SQLAlchemy.set_engine_sqlite()
+
+        global engine
+        engine = Doorbot.SQLAlchemy.get_engine()
+
+        permission = Doorbot.SQLAlchemy.Permission(
+            name = "front.door",
+        )
+        role = Doorbot.SQLAlchemy.Role(
+            name = "doors",
+        )
+        role.permissions.append( permission )
+
+        members = [
+            Doorbot.SQLAlchemy.Member(
+                full_name = "Foo Foo",
+                rfid = RFID1,
+            ),
+            Doorbot.SQLAlchemy.Member(
+                full_name = "Bar Baz",
+                rfid = RFID2,
+            ),
+        ]
+        members[0].roles.append( role )
+        members[1].roles.append( role )
+
+        session = Session( engine )
+        add_bearer_token( TOKEN, members[0], session )
+        session.add_all( members )
+        session.add_all([ permission, role ])
+        session.commit()
+        session.close()
+
+    def current_version( self ):
+        session = Session( engine )
+        version = Doorbot.ACL.current_version( session )
+        session.close()
+        return version
+
+    def test_no_since( self, client ):
+        rv = client.get( '/v1/acl_changes',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
+        data = json.loads( rv.data.decode( "UTF-8" ) )
+        self.assertEqual( data[ "version" ], self.current_version() )
+        self.assertTrue( data[ "everything" ],
+            "Client without a version needs everything" )
+
+    def test_timeout_without_changes( self, client ):
+        version = self.current_version()
+        rv = client.get( '/v1/acl_changes?timeout=0.1&since=' + str( version ),
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
+        data = json.loads( rv.data.decode( "UTF-8" ) )
+        self.assertEqual( data, {
+            "version": version,
+            "everything": False,
+            "tags": {},
+        }, "Nothing changed" )
+
+    def test_changed_tag( self, client ):
+        version = self.current_version()
+        rv = client.post( '/v1/deactivate_tag/' + RFID2,
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
+
+        rv = client.get( '/v1/acl_changes?since=' + str( version ),
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
+        data = json.loads( rv.data.decode( "UTF-8" ) )
+        self.assertGreater( data[ "version" ], version, "Version moved on" )
+        self.assertFalse( data[ "everything" ], "Change narrowed to tags" )
+        self.assertEqual( data[ "tags" ], {
+            RFID2: {
+                "active": False,
+                "permissions": [ "front.door" ],
+            },
+        }, "Deactivated tag is listed" )
+
+        rv = client.post( '/v1/reactivate_tag/' + RFID2,
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
+
+    def test_lost_history( self, client ):
+        rv = client.get( '/v1/acl_changes?since=-1',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
+        data = json.loads( rv.data.decode( "UTF-8" ) )
+        self.assertTrue( data[ "everything" ],
+            "Versions missing from the history mean everything" )
+
+
+class TestACLFeed( unittest.TestCase ):
+    @classmethod
+    def setUpClass( cls ):
+        if 'PG' != os.environ.get( 'DB' ):
+            Doorbot.SQLAlchemy.set_engine_sqlite()
+
+    def test_notify_wakes_waiter( self ):
+        feed = Doorbot.ACLFeed.ACLFeed( poll_interval_seconds = 30 )
+        version = feed.latest_version()
+
+        timer = threading.Timer( 0.1, feed.notify, [ version + 1 ] )
+        timer.start()
+        start = time.monotonic()
+        new_version = feed.wait_for_change( version, 10 )
+        timer.join()
+
+        self.assertEqual( new_version, version + 1, "Got new version" )
+        self.assertLess( time.monotonic() - start, 5,
+            "Woke up without waiting for the timeout" )
+
+    def test_too_many_waiters( self ):
+        feed = Doorbot.ACLFeed.ACLFeed( max_waiters = 0 )
+        version = feed.latest_version()
+
+        with self.assertRaises( Doorbot.ACLFeed.TooManyWaiters ):
+            feed.wait_for_change( version, 1 )
+
+        self.assertEqual( feed.wait_for_change( version - 1, 1 ), version,
+            "Clients behind the current version don't wait" )
@@ -8,7 +8,9 @@ import re
 import sqlite3
 import Doorbot.Config
 import Doorbot.API
+import Doorbot.AuthCache
 import Doorbot.SQLAlchemy
+from sqlalchemy import event
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 from test_oauth_token import add_bearer_token, bearer_header
@@ -16,6 +18,8 @@ from test_oauth_token import add_bearer_token, bearer_header
 
 USER_PASS = ( "user", "pass" )
 TOKEN = "0123456789abcdef"
+CACHED_USER_PASS = ( "cached_user", "cached_pass" )
+CACHED_RFID = "cached_tag"
 
 class TestAPIChangePassword( flask_unittest.ClientTestCase ):
     app = Doorbot.API.app
@@ -60,3 +64,78 @@ class TestAPIChangePassword( flask_unittest.ClientTestCase ):
         member = Doorbot.SQLAlchemy.Member.get_by_tag( USER_PASS[0], session )
         assert not member.check_password( USER_PASS[1], session ), "Old password no longer works"
         assert member.check_password( USER_PASS[1] + "foo", session ), "New password works"
+
+    def test_change_password_clears_basic_auth_cache( self, client ):
+        member = Doorbot.SQLAlchemy.Member(
+            full_name = "_cached_tester",
+            rfid = CACHED_RFID,
+            username = CACHED_USER_PASS[0],
+        )
+        member.set_password( "old_pass", {
+            "type": "plaintext",
+        })
+        session = Session( engine )
+        session.add( member )
+        session.commit()
+        session.close()
+
+        rv = client.get( '/secure/dump_active_tags',
+            auth = CACHED_USER_PASS )
+        self.assertStatus( rv, 401 )
+
+        rv = client.put( '/v1/change_passwd/' + CACHED_RFID, data = {
+            "new_pass": CACHED_USER_PASS[1],
+            "new_pass2": CACHED_USER_PASS[1],
+        }, headers = bearer_header( TOKEN ) )
+        self.assertStatus( rv, 200 )
+
+        rv = client.get( '/secure/dump_active_tags',
+            auth = CACHED_USER_PASS )
+        self.assertStatus( rv, 200 )
+        self.assertIsNotNone(
+            Doorbot.AuthCache.get_credential_cache().get(
+                CACHED_USER_PASS[0] ),
+            "Login was cached",
+        )
+
+        rv = client.put( '/v1/change_passwd/' + CACHED_RFID, data = {
+            "new_pass": "other_pass",
+            "new_pass2": "other_pass",
+        }, headers = bearer_header( TOKEN ) )
+        self.assertStatus( rv, 200 )
+
+        rv = client.get( '/secure/dump_active_tags',
+            auth = CACHED_USER_PASS )
+        self.assertStatus( rv, 401 )
+
+        rv = client.get( '/secure/dump_active_tags',
+            auth = ( CACHED_USER_PASS[0], "other_pass" ) )
+        self.assertStatus( rv, 200 )
+
+    def test_password_changed_during_login( self, client ):
+        member = Doorbot.SQLAlchemy.Member(
+            full_name = "_racing_tester",
+            rfid = "racing_tag",
+            username = "racing_user",
+        )
+        member.set_password( "racing_pass", {
+            "type": "plaintext",
+        })
+        session = Session( engine )
+        session.add( member )
+        session.commit()
+        session.close()
+
+        # Changed by someone else after the check started
+        session = Session( engine )
+        event.listen( session, "do_orm_execute",
+            lambda state: Doorbot.AuthCache.invalidate_credentials(
+                "racing_user" ) )
+        is_valid = Doorbot.AuthCache.verify_credentials(
+            "racing_user", "racing_pass", session )
+        session.close()
+
+        self.assertTrue( is_valid, "Checked before it was changed" )
+        self.assertIsNone(
+            Doorbot.AuthCache.get_credential_cache().get( "racing_user" ),
+            "Not cached after the change" )
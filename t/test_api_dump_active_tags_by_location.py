@@ -1,4 +1,5 @@
 import unittest
+import gzip
 import flask_unittest
 import flask.globals
 from flask import json
@@ -7,8 +8,11 @@ import psycopg2
 import re
 import sqlite3
 import Doorbot.Config
+import Doorbot.ACLExport
 import Doorbot.API
+import Doorbot.ResponseCache
 import Doorbot.SQLAlchemy
+from sqlalchemy import event
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 from test_oauth_token import add_bearer_token, bearer_header
@@ -19,6 +23,7 @@ RFID1 = "1234"
 RFID2 = "2345"
 RFID3 = "3456"
 TOKEN = "0123456789abcdef"
+ETAG_USER_PASS = ( "etag_user", "etag_pass" )
 
 class TestDumpTagsByLocationAPI( flask_unittest.ClientTestCase ):
     app = Doorbot.API.app
@@ -125,3 +130,215 @@ class TestDumpTagsByLocationAPI( flask_unittest.ClientTestCase ):
             headers = bearer_header( TOKEN )
         )
         self.assertStatus( rv, 404 )
+
+    def test_dump_active_tags_packed( self, client ):
+        headers = {
+            **bearer_header( TOKEN ),
+            'Accept': Doorbot.ACLExport.PACKED_MIMETYPE,
+        }
+        rv = client.get( '/v1/dump_active_tags/back.door',
+            headers = headers
+        )
+        self.assertStatus( rv, 200 )
+        self.assertEqual( rv.content_type, Doorbot.ACLExport.PACKED_MIMETYPE )
+        self.assertTrue( rv.headers.get( 'ETag' ).endswith( '-packed"' ),
+            "ETag is specific to the format" )
+
+        version, tags = Doorbot.ACLExport.decode_packed( rv.data )
+        self.assertEqual( tags, [ RFID1, RFID2 ],
+            "Active tags with permission, sorted" )
+
+    def test_dump_active_tags_unexportable( self, client ):
+        long_tag = "9" * ( Doorbot.ACLExport.MAX_TAG_WIDTH + 1 )
+        role = Doorbot.SQLAlchemy.Role(
+            name = "long.tags",
+        )
+        role.permissions.append( Doorbot.SQLAlchemy.Permission(
+            name = "long.tag.door",
+        ))
+        member = Doorbot.SQLAlchemy.Member(
+            full_name = "Long Tag",
+            rfid = long_tag,
+        )
+        member.roles.append( role )
+        session = Session( engine )
+        session.add_all([ role, member ])
+        session.commit()
+        session.close()
+
+        rv = client.get( '/v1/dump_active_tags/long.tag.door',
+            headers = {
+                **bearer_header( TOKEN ),
+                'Accept': Doorbot.ACLExport.PACKED_MIMETYPE,
+            },
+        )
+        self.assertStatus( rv, 200 )
+        self.assertEqual( rv.content_type, 'application/json',
+            "JSON rather than leaving the tag out" )
+        self.assertIn( long_tag, json.loads( rv.data ) )
+
+    def test_dump_active_tags_bloom( self, client ):
+        headers = {
+            **bearer_header( TOKEN ),
+            'Accept': Doorbot.ACLExport.BLOOM_MIMETYPE,
+        }
+        rv = client.get( '/v1/dump_active_tags/woodshop.tablesaw?fp_rate=0.001',
+            headers = headers
+        )
+        self.assertStatus( rv, 200 )
+        self.assertEqual( rv.content_type, Doorbot.ACLExport.BLOOM_MIMETYPE )
+        self.assertTrue( Doorbot.ACLExport.bloom_contains( rv.data, RFID1 ),
+            "Tag with permission is in filter" )
+
+        rv = client.get( '/v1/dump_active_tags/woodshop.tablesaw?fp_rate=2',
+            headers = headers
+        )
+        self.assertStatus( rv, 400 )
+
+    def test_dump_active_tags_single_checkout( self, client ):
+        checkouts = []
+        def count_checkout( *args ):
+            checkouts.append( args )
+
+        event.listen( engine, "checkout", count_checkout )
+        try:
+            rv = client.get( '/v1/dump_active_tags/front.door',
+                headers = bearer_header( TOKEN )
+            )
+        finally:
+            event.remove( engine, "checkout", count_checkout )
+        self.assertStatus( rv, 200 )
+
+        self.assertLessEqual( len( checkouts ), 1,
+            "Request used at most one connection checkout" )
+
+    def test_dump_active_tags_cached( self, client ):
+        rv = client.get( '/v1/dump_active_tags/back.door',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
+        data = rv.data
+
+        statements = []
+        def count_statement( conn, cursor, statement, *args ):
+            statements.append( statement )
+
+        event.listen( engine, "before_cursor_execute", count_statement )
+        try:
+            rv = client.get( '/v1/dump_active_tags/back.door',
+                headers = bearer_header( TOKEN )
+            )
+            gzip_rv = client.get( '/v1/dump_active_tags/back.door',
+                headers = {
+                    **bearer_header( TOKEN ),
+                    'Accept-Encoding': 'gzip',
+                },
+            )
+        finally:
+            event.remove( engine, "before_cursor_execute", count_statement )
+
+        self.assertStatus( rv, 200 )
+        self.assertEqual( rv.data, data, "Same response" )
+        self.assertEqual( statements, [], "Served without a query" )
+
+        self.assertStatus( gzip_rv, 200 )
+        self.assertEqual( gzip_rv.headers.get( 'Content-Encoding' ), 'gzip' )
+        self.assertEqual( gzip.decompress( gzip_rv.data ), data,
+            "Gzipped copy" )
+        self.assertIn( 'Accept-Encoding', gzip_rv.headers.get( 'Vary' ) )
+
+        rv = client.get( '/v1/dump_locations',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
+        self.assertIsInstance( json.loads( rv.data ), list,
+            "Locations from the cache are still a list" )
+
+    def test_dump_active_tags_not_modified_on_miss( self, client ):
+        rv = client.get( '/v1/dump_active_tags/back.door',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
+        etag = rv.headers.get( 'ETag' )
+        Doorbot.ResponseCache.get_cache().invalidate()
+
+        statements = []
+        def count_statement( conn, cursor, statement, *args ):
+            statements.append( statement )
+
+        event.listen( engine, "before_cursor_execute", count_statement )
+        try:
+            rv = client.get( '/v1/dump_active_tags/back.door',
+                headers = {
+                    **bearer_header( TOKEN ),
+                    'If-None-Match': etag,
+                },
+            )
+        finally:
+            event.remove( engine, "before_cursor_execute", count_statement )
+
+        self.assertStatus( rv, 304 )
+        self.assertFalse(
+            any( "members" in statement for statement in statements ),
+            "Tags weren't queried" )
+
+    def test_dump_active_tags_etag( self, client ):
+        # Someone who can log in to /secure, added before the ETag is taken
+        member = Doorbot.SQLAlchemy.Member(
+            full_name = "ETag Member",
+            rfid = ETAG_USER_PASS[0],
+            username = ETAG_USER_PASS[0],
+        )
+        member.set_password( ETAG_USER_PASS[1], {
+            "type": "plaintext",
+        })
+        session = Session( engine )
+        session.add( member )
+        session.commit()
+        session.close()
+
+        rv = client.get( '/v1/dump_active_tags/back.door',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
+        etag = rv.headers.get( 'ETag' )
+        self.assertIsNotNone( etag, "Response has an ETag" )
+
+        headers = {
+            **bearer_header( TOKEN ),
+            'If-None-Match': etag,
+        }
+        rv = client.get( '/v1/dump_active_tags/back.door',
+            headers = headers
+        )
+        self.assertStatus( rv, 304 )
+        self.assertEqual( rv.headers.get( 'ETag' ), etag, "Same ETag" )
+
+        rv = client.get( '/secure/dump_active_tags',
+            auth = ETAG_USER_PASS,
+            headers = { 'If-None-Match': etag },
+        )
+        self.assertStatus( rv, 304 )
+
+        # Any change to the ACL gives a new version
+        rv = client.post( '/v1/deactivate_tag/' + RFID2,
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
+
+        headers = {
+            **bearer_header( TOKEN ),
+            'If-None-Match': etag,
+        }
+        rv = client.get( '/v1/dump_active_tags/back.door',
+            headers = headers
+        )
+        self.assertStatus( rv, 200 )
+        self.assertNotEqual( rv.headers.get( 'ETag' ), etag, "New ETag" )
+        data = json.loads( rv.data.decode( "UTF-8" ) )
+        assert not RFID2 in data, "Deactivated user no longer listed"
+
+        rv = client.post( '/v1/reactivate_tag/' + RFID2,
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
@@ -0,0 +1,109 @@
+import unittest
+import flask_unittest
+import csv
+import io
+import os
+import Doorbot.Config
+import Doorbot.API
+import Doorbot.SQLAlchemy
+from datetime import datetime
+from flask import json
+from sqlalchemy.orm import Session
+from test_oauth_token import add_bearer_token, bearer_header
+
+
+TOKEN = "0123456789abcdef"
+
+
+class TestExportEntryLogAPI( flask_unittest.ClientTestCase ):
+    app = Doorbot.API.app
+    app.config[ 'is_testing' ] = True
+
+    @classmethod
+    def setUpClass( cls ):
+        if 'PG' != os.environ.get( 'DB' ):
+            Doorbot.SQLAlchemy.set_engine_sqlite()
+
+        global engine
+        engine = Doorbot.SQLAlchemy.get_engine()
+
+        front_door = Doorbot.SQLAlchemy.Location( name = "front.door" )
+        back_door = Doorbot.SQLAlchemy.Location( name = "back.door" )
+        member = Doorbot.SQLAlchemy.Member(
+            full_name = "Foo, Bar",
+            rfid = "1234",
+        )
+
+        entries = [
+            # One at the very start of March, and one just before April
+            ( datetime( 2023, 3, 1, 0, 0, 0 ), front_door ),
+            ( datetime( 2023, 3, 15, 8, 30, 0 ), back_door ),
+            ( datetime( 2023, 3, 31, 23, 59, 59 ), front_door ),
+            ( datetime( 2023, 4, 1, 0, 0, 0 ), front_door ),
+            ( datetime( 2023, 2, 28, 23, 59, 59 ), front_door ),
+        ]
+
+        session = Session( engine )
+        add_bearer_token( TOKEN, member, session )
+        session.add_all([ front_door, back_door, member ])
+        session.add_all([
+            Doorbot.SQLAlchemy.EntryLog(
+                rfid = "1234",
+                is_active_tag = True,
+                is_found_tag = True,
+                entry_time = entry_time,
+                mapped_location = location,
+            )
+            for entry_time, location in entries
+        ])
+        session.commit()
+        session.close()
+
+    def test_export_csv( self, client ):
+        rv = client.get( '/v1/export_entry_log?from=2023-03-01&to=2023-04-01',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
+        self.assertEqual( rv.mimetype, 'text/csv' )
+        self.assertIn( 'attachment', rv.headers.get( 'Content-Disposition' ) )
+
+        rows = list( csv.DictReader( io.StringIO( rv.data.decode( "UTF-8" ) ) ) )
+        self.assertEqual( len( rows ), 3, "Only rows in March" )
+        self.assertEqual( rows[0][ "full_name" ], "Foo, Bar",
+            "Comma in name is quoted" )
+        self.assertEqual(
+            [ row[ "location" ] for row in rows ],
+            [ "front.door", "back.door", "front.door" ],
+            "Rows in the order they were logged",
+        )
+
+    def test_export_ndjson_by_location( self, client ):
+        rv = client.get( '/v1/export_entry_log?from=2023-03-01&to=2023-04-01'
+            + '&location=front.door&format=ndjson',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
+        self.assertEqual( rv.mimetype, 'application/x-ndjson' )
+
+        rows = [ json.loads( line )
+            for line in rv.data.decode( "UTF-8" ).splitlines() ]
+        self.assertEqual( len( rows ), 2, "Only rows at the front door" )
+        self.assertTrue( all( row[ "location" ] == "front.door"
+            for row in rows ) )
+
+    def test_export_bad_input( self, client ):
+        rv = client.get( '/v1/export_entry_log?from=yesterday&to=2023-04-01',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 400 )
+
+        rv = client.get( '/v1/export_entry_log?from=2023-03-01',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 400 )
+
+        rv = client.get( '/v1/export_entry_log?from=2023-03-01&to=2023-04-01'
+            + '&location=no.such.door',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 404 )
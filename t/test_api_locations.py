@@ -0,0 +1,95 @@
+import unittest
+import flask_unittest
+from flask import json
+import os
+import Doorbot.Config
+import Doorbot.API
+import Doorbot.LocationRegistry
+import Doorbot.SQLAlchemy
+from sqlalchemy.orm import Session
+from test_oauth_token import add_bearer_token, bearer_header
+
+
+USER_PASS = ( "user", "pass" )
+RFID1 = "1234"
+TOKEN = "0123456789abcdef"
+
+class TestAPILocations( flask_unittest.ClientTestCase ):
+    app = Doorbot.API.app
+    app.config[ 'is_testing' ] = True
+    engine = None
+
+    @classmethod
+    def setUpClass( cls ):
+        if 'PG' != os.environ.get( 'DB' ):
+            Doorbot.SQLAlchemy.set_engine_sqlite()
+
+        global engine
+        engine = Doorbot.SQLAlchemy.get_engine()
+
+        member = Doorbot.SQLAlchemy.Member(
+            full_name = "_tester",
+            rfid = RFID1,
+            username = USER_PASS[0],
+        )
+        member.set_password( USER_PASS[1], {
+            "type": "plaintext",
+        })
+        location = Doorbot.SQLAlchemy.Location(
+            name = "cleanroom.door",
+        )
+
+        session = Session( engine )
+        add_bearer_token( TOKEN, member, session )
+        session.add_all([ member, location ])
+        session.commit()
+
+    def test_location_lifecycle( self, client ):
+        rv = client.get( '/v1/dump_locations',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
+        self.assertEqual( json.loads( rv.data ), [ "cleanroom.door" ] )
+
+        rv = client.get( '/v1/entry/' + RFID1 + '/garage.door',
+            auth = USER_PASS )
+        self.assertStatus( rv, 404 )
+
+        rv = client.put( '/v1/new_location/garage.door/garage-bot',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 201 )
+
+        rv = client.get( '/v1/dump_locations',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertEqual( json.loads( rv.data ),
+            [ "cleanroom.door", "garage.door" ] )
+
+        rv = client.get( '/v1/entry/' + RFID1 + '/garage.door',
+            auth = USER_PASS )
+        self.assertStatus( rv, 200 )
+
+        rv = client.post( '/v1/edit_location/garage.door/garage-bot2',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 201 )
+        location = Doorbot.LocationRegistry.get_registry().lookup(
+            "garage.door" )
+        self.assertEqual( location.hostname, "garage-bot2",
+            "Registry has new hostname" )
+
+        rv = client.delete( '/v1/delete_location/garage.door',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 204 )
+
+        rv = client.get( '/v1/dump_locations',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertEqual( json.loads( rv.data ), [ "cleanroom.door" ] )
+
+        rv = client.delete( '/v1/delete_location/garage.door',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 404 )
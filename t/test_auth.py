@@ -5,6 +5,7 @@ import re
 import sqlite3
 import Doorbot.Config
 import Doorbot.SQLAlchemy
+from sqlalchemy import event
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 
@@ -161,6 +162,44 @@ class TestAuth( unittest.TestCase ):
             "front.door",
         ], "Permissions found as expected" )
 
+    def test_role_summaries( self ):
+        session = Session( engine )
+        statements = []
+
+        def count( conn, cursor, statement, *args ):
+            statements.append( statement )
+
+        event.listen( engine, "before_cursor_execute", count )
+        try:
+            summaries = Doorbot.SQLAlchemy.Role.summaries( session )
+        finally:
+            event.remove( engine, "before_cursor_execute", count )
+
+        summaries = {
+            name: ( sorted( permission_names ), member_count )
+            for name, permission_names, member_count in summaries
+        }
+        self.assertEqual( summaries[ "doors" ],
+            ( [ "back.door", "front.door" ], 2 ) )
+        self.assertEqual( summaries[ "woodshop" ],
+            ( [ "woodshop.bandsaw", "woodshop.tablesaw" ], 2 ) )
+        self.assertEqual( len( statements ), 2,
+            "Same number of queries for any number of roles" )
+
+        self.assertEqual(
+            sorted( Doorbot.SQLAlchemy.Role.member_names( "doors", session ) ),
+            [ "baz", "foo" ],
+        )
+        self.assertEqual(
+            Doorbot.SQLAlchemy.Role.permission_names( "woodshop", session ),
+            [ "woodshop.bandsaw", "woodshop.tablesaw" ],
+        )
+        self.assertEqual(
+            Doorbot.SQLAlchemy.Role.member_names( "no_such_role", session ),
+            [],
+        )
+        session.close()
+
     def test_all_members_with_permission( self ):
         session = Session( engine )
 
@@ -179,3 +218,34 @@ class TestAuth( unittest.TestCase ):
             RFID_BAR,
             RFID_BAZ,
         ], "Members found as expected" )
+
+    def test_check_permission_by_tag( self ):
+        session = Session( engine )
+
+        result = Doorbot.SQLAlchemy.Member.check_permission_by_tag(
+            RFID_FOO, "back.door", session )
+        self.assertTrue( result.active, "Member is active" )
+        self.assertEqual( result.full_name, "foo", "Fetched member name" )
+        self.assertTrue( result.has_permission,
+            "Member has back.door permission via role" )
+
+        result = Doorbot.SQLAlchemy.Member.check_permission_by_tag(
+            RFID_FOO, "woodshop.bandsaw", session )
+        self.assertFalse( result.has_permission,
+            "Member does not have woodshop.bandsaw permission" )
+
+        result = Doorbot.SQLAlchemy.Member.check_permission_by_tag(
+            "9999", "back.door", session )
+        self.assertIsNone( result, "Unknown tag not found" )
+
+    def test_tags_with_permission( self ):
+        session = Session( engine )
+
+        tags = Doorbot.SQLAlchemy.Permission.tags_with_permission(
+            "front.door", session )
+        tags.sort()
+
+        self.assertEqual( tags, [
+            RFID_FOO,
+            RFID_BAZ,
+        ], "Tags found as expected" )
@@ -0,0 +1,53 @@
+import unittest
+import os
+import Doorbot.Config
+import Doorbot.EntryLogPartitions
+import Doorbot.SQLAlchemy
+from datetime import date, datetime
+
+
+class TestEntryLogPartitions( unittest.TestCase ):
+    @classmethod
+    def setUpClass( cls ):
+        if 'PG' != os.environ.get( 'DB' ):
+            Doorbot.SQLAlchemy.set_engine_sqlite()
+
+    def test_months( self ):
+        partitions = Doorbot.EntryLogPartitions
+
+        self.assertEqual(
+            partitions.month_start( datetime( 2023, 12, 31, 23, 59 ) ),
+            date( 2023, 12, 1 ),
+        )
+        self.assertEqual(
+            partitions.add_months( date( 2023, 11, 1 ), 3 ),
+            date( 2024, 2, 1 ),
+            "Adding months wraps the year",
+        )
+        self.assertEqual(
+            partitions.add_months( date( 2024, 1, 1 ), -1 ),
+            date( 2023, 12, 1 ),
+            "Going back wraps the year",
+        )
+
+        name = partitions.partition_name( date( 2024, 3, 1 ) )
+        self.assertEqual( name, "entry_log_y2024m03" )
+        self.assertEqual( partitions.partition_month( name ),
+            date( 2024, 3, 1 ) )
+        self.assertIsNone( partitions.partition_month( "entry_log_default" ),
+            "Default partition isn't a monthly one" )
+
+    @unittest.skipIf( 'PG' == os.environ.get( 'DB' ), "SQLite only" )
+    def test_sqlite_does_nothing( self ):
+        self.assertEqual( Doorbot.EntryLogPartitions.maintain(), ( [], [] ),
+            "Nothing to do without partitioning" )
+
+    @unittest.skipUnless( 'PG' == os.environ.get( 'DB' ), "PostgreSQL only" )
+    def test_maintain( self ):
+        now = datetime( 2031, 6, 15 )
+        created, retired = Doorbot.EntryLogPartitions.maintain( now = now )
+        self.assertIn( "entry_log_y2031m06", created,
+            "Created this month's partition" )
+
+        created, retired = Doorbot.EntryLogPartitions.maintain( now = now )
+        self.assertEqual( created, [], "Nothing new the second time" )
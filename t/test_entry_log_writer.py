@@ -0,0 +1,113 @@
+import unittest
+import os
+import tempfile
+import Doorbot.Config
+import Doorbot.EntryLogWriter
+import Doorbot.SQLAlchemy
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+
+RFID_FOO = "1234"
+
+
+class TestEntryLogWriter( unittest.TestCase ):
+    @classmethod
+    def setUpClass( cls ):
+        global db_dir
+        db_dir = tempfile.TemporaryDirectory()
+
+        if 'PG' != os.environ.get( 'DB' ):
+            # Background writes need a database other connections can see
+            Doorbot.SQLAlchemy.set_engine_sqlite(
+                os.path.join( db_dir.name, "entry_log.db" )
+            )
+
+        global engine
+        engine = Doorbot.SQLAlchemy.get_engine()
+
+        global location_id
+        location = Doorbot.SQLAlchemy.Location(
+            name = "cleanroom.door",
+        )
+        session = Session( engine )
+        session.add( location )
+        session.commit()
+        location_id = location.id
+        session.close()
+
+    @classmethod
+    def tearDownClass( cls ):
+        engine.dispose()
+        db_dir.cleanup()
+
+    def count_entries( self ):
+        session = Session( engine )
+        count = session.scalar(
+            select( func.count() ).select_from( Doorbot.SQLAlchemy.EntryLog )
+        )
+        session.close()
+        return count
+
+    def test_batched_writes( self ):
+        writer = Doorbot.EntryLogWriter.EntryLogWriter(
+            batch_size = 2,
+            flush_interval_seconds = 60,
+        )
+        start_count = self.count_entries()
+
+        for i in range( 5 ):
+            writer.log(
+                rfid = RFID_FOO,
+                location_id = location_id,
+                is_active_tag = True,
+                is_found_tag = True,
+            )
+        writer.stop()
+
+        self.assertEqual( writer.pending(), 0, "Queue was drained" )
+        self.assertEqual( self.count_entries(), start_count + 5,
+            "All entries written" )
+
+    def test_direct_writes( self ):
+        writer = Doorbot.EntryLogWriter.EntryLogWriter(
+            write_behind = False,
+        )
+        start_count = self.count_entries()
+
+        writer.log(
+            rfid = RFID_FOO,
+            location_id = location_id,
+            is_active_tag = False,
+            is_found_tag = False,
+        )
+
+        self.assertEqual( self.count_entries(), start_count + 1,
+            "Entry written right away" )
+
+    def test_stats_failure_keeps_scans( self ):
+        writer = Doorbot.EntryLogWriter.EntryLogWriter(
+            write_behind = False,
+        )
+        start_count = self.count_entries()
+
+        # Updating the rollups fails without their table
+        with engine.begin() as conn:
+            conn.execute( text( "ALTER TABLE scan_stats_hourly"
+                " RENAME TO scan_stats_hourly_away" ) )
+        try:
+            writer.log(
+                rfid = RFID_FOO,
+                location_id = location_id,
+                is_active_tag = True,
+                is_found_tag = True,
+            )
+        finally:
+            with engine.begin() as conn:
+                conn.execute( text( "ALTER TABLE scan_stats_hourly_away"
+                    " RENAME TO scan_stats_hourly" ) )
+
+        self.assertEqual( self.count_entries(), start_count + 1,
+            "Entry written even though the stats weren't" )
@@ -0,0 +1,168 @@
+import unittest
+import json
+import os
+import Doorbot.ACL
+import Doorbot.AuthCache
+import Doorbot.InvalidationBus
+import Doorbot.LocationRegistry
+import Doorbot.SQLAlchemy
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+
+TOPIC = "test"
+
+
+class TestInvalidationBus( unittest.TestCase ):
+    @classmethod
+    def setUpClass( cls ):
+        if 'PG' != os.environ.get( 'DB' ):
+            Doorbot.SQLAlchemy.set_engine_sqlite()
+
+        global engine
+        engine = Doorbot.SQLAlchemy.get_engine()
+
+    def setUp( self ):
+        self.received = []
+        self.listener = Doorbot.InvalidationBus.add_listener(
+            TOPIC, self.received.append )
+
+    def tearDown( self ):
+        Doorbot.InvalidationBus.LISTENERS[ TOPIC ].remove( self.listener )
+
+    def message( self, topic, data, sender = "someone else" ):
+        return json.dumps({
+            "sender": sender,
+            "topic": topic,
+            "data": data,
+        })
+
+    def test_handle( self ):
+        bus = Doorbot.InvalidationBus.InvalidationBus()
+
+        bus.handle( self.message( TOPIC, { "keys": [ 1, 2 ] } ) )
+        self.assertEqual( self.received, [ { "keys": [ 1, 2 ] } ],
+            "Message passed to the listener" )
+
+        bus.handle( self.message( TOPIC, { "keys": [ 3 ] },
+            sender = Doorbot.InvalidationBus.sender_id() ) )
+        bus.handle( "not json" )
+        self.assertEqual( len( self.received ), 1,
+            "Own and bad messages ignored" )
+
+    def test_forked_worker( self ):
+        # uwsgi forks workers from C, so nothing can be set up at fork time
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close( read_fd )
+                Doorbot.InvalidationBus.start()
+                payload = Doorbot.InvalidationBus.encode_message(
+                    TOPIC, "from child" )
+                os.write( write_fd, payload.encode( 'utf-8' ) )
+            finally:
+                os._exit( 0 )
+
+        os.close( write_fd )
+        with os.fdopen( read_fd, "rb" ) as f:
+            payload = f.read().decode( 'utf-8' )
+        os.waitpid( pid, 0 )
+
+        self.assertNotEqual( json.loads( payload )[ "sender" ],
+            Doorbot.InvalidationBus.sender_id(), "Child has its own id" )
+        Doorbot.InvalidationBus.InvalidationBus().handle( payload )
+        self.assertEqual( self.received, [ "from child" ],
+            "Parent hears the child" )
+
+    def test_encode_message( self ):
+        payload = json.loads(
+            Doorbot.InvalidationBus.encode_message( TOPIC, [ "a" ] ) )
+        self.assertEqual( payload[ "topic" ], TOPIC )
+        self.assertEqual( payload[ "data" ], [ "a" ] )
+        self.assertEqual( payload[ "sender" ],
+            Doorbot.InvalidationBus.sender_id() )
+
+        big = [ "%010d" % i for i in range( 1000 ) ]
+        payload = Doorbot.InvalidationBus.encode_message( TOPIC, big )
+        self.assertLess( len( payload ),
+            Doorbot.InvalidationBus.MAX_PAYLOAD_BYTES, "Fits in a NOTIFY" )
+        self.assertIsNone( json.loads( payload )[ "data" ],
+            "Data too big to send means everything changed" )
+
+    @unittest.skipIf( 'PG' == os.environ.get( 'DB' ), "SQLite only" )
+    def test_poll_generation( self ):
+        bus = Doorbot.InvalidationBus.get_bus()
+        self.assertFalse( bus.poll_once(), "First poll sets where we start" )
+
+        session = Session( engine )
+        session.add( Doorbot.SQLAlchemy.Location( name = "bus.test" ) )
+        session.commit()
+        session.close()
+        self.assertFalse( bus.poll_once(), "Own commits aren't news" )
+        self.assertEqual( self.received, [] )
+
+        # Another process bumps it
+        with engine.begin() as conn:
+            conn.execute(
+                update( Doorbot.SQLAlchemy.cache_generation_table ).values(
+                    generation = Doorbot.SQLAlchemy.cache_generation_table \
+                        .c.generation + 1
+                )
+            )
+        self.assertTrue( bus.poll_once(), "Other commits are news" )
+        self.assertEqual( self.received, [ None ],
+            "Listeners told everything changed" )
+        self.assertFalse( bus.poll_once(), "Only told once" )
+
+    def test_remote_acl_change( self ):
+        changes = []
+        listener = Doorbot.ACL.add_listener( changes.append )
+        try:
+            bus = Doorbot.InvalidationBus.InvalidationBus()
+            bus.handle( self.message( Doorbot.ACL.BUS_TOPIC, {
+                "version": 42,
+                "tags": [ "1234" ],
+                "everything": False,
+            }) )
+            bus.handle( self.message( Doorbot.ACL.BUS_TOPIC, None ) )
+        finally:
+            Doorbot.ACL.LISTENERS.remove( listener )
+
+        self.assertEqual( changes, [
+            Doorbot.ACL.ACLChange( version = 42, tags = frozenset([ "1234" ]),
+                everything = False ),
+            Doorbot.ACL.ACLChange( version = None, tags = frozenset(),
+                everything = True ),
+        ])
+
+    def test_remote_auth_change( self ):
+        token_cache = Doorbot.AuthCache.get_token_cache()
+        credential_cache = Doorbot.AuthCache.get_credential_cache()
+        token_cache.set(
+            Doorbot.AuthCache.token_digest( "token.foo" ), 1, 60 )
+        token_cache.set(
+            Doorbot.AuthCache.token_digest( "token.bar" ), 2, 60 )
+        credential_cache.set( "foo", b"digest", 60 )
+
+        bus = Doorbot.InvalidationBus.InvalidationBus()
+        bus.handle( self.message( Doorbot.AuthCache.BUS_TOPIC, {
+            "tokens": [ Doorbot.AuthCache.token_digest( "token.foo" ).hex() ],
+            "usernames": [ "foo" ],
+        }) )
+
+        self.assertIsNone( token_cache.get(
+            Doorbot.AuthCache.token_digest( "token.foo" ) ), "Token evicted" )
+        self.assertEqual( token_cache.get(
+            Doorbot.AuthCache.token_digest( "token.bar" ) ), 2,
+            "Other token kept" )
+        self.assertIsNone( credential_cache.get( "foo" ), "Login evicted" )
+
+    def test_remote_location_change( self ):
+        registry = Doorbot.LocationRegistry.get_registry()
+        generation = registry.generation()
+
+        bus = Doorbot.InvalidationBus.InvalidationBus()
+        bus.handle( self.message( Doorbot.LocationRegistry.BUS_TOPIC, None ) )
+        self.assertGreater( registry.generation(), generation,
+            "Locations reloaded" )
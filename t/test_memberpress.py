@@ -0,0 +1,132 @@
+import unittest
+import json
+import threading
+import Doorbot.MemberPress
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+
+TOTAL_MEMBERS = 23
+PER_PAGE = 5
+
+
+class FakeMemberPress( BaseHTTPRequestHandler ):
+    """Serves TOTAL_MEMBERS members, failing some pages the first time"""
+
+    send_total = False
+    past_end_status = None
+    fail_pages = set()
+    requested = []
+
+    def do_GET( self ):
+        query = parse_qs( urlparse( self.path ).query )
+        page = int( query[ 'page' ][0] )
+        per_page = int( query[ 'per_page' ][0] )
+        self.requested.append( page )
+
+        if page in self.fail_pages:
+            self.fail_pages.discard( page )
+            self.send_response( 503 )
+            self.end_headers()
+            return
+
+        start = ( page - 1 ) * per_page
+        if self.past_end_status is not None and start >= TOTAL_MEMBERS:
+            self.send_response( self.past_end_status )
+            self.end_headers()
+            return
+
+        members = [
+            { 'id': i } for i in range( start, min( start + per_page,
+                TOTAL_MEMBERS ) )
+        ]
+        body = json.dumps( members ).encode( 'utf-8' )
+        self.send_response( 200 )
+        self.send_header( 'Content-Type', 'application/json' )
+        self.send_header( 'Content-Length', str( len( body ) ) )
+        if self.send_total:
+            pages = ( TOTAL_MEMBERS + per_page - 1 ) // per_page
+            self.send_header( 'X-WP-TotalPages', str( pages ) )
+        self.end_headers()
+        self.wfile.write( body )
+
+    def log_message( self, *args ):
+        pass
+
+
+class TestMemberPress( unittest.TestCase ):
+    @classmethod
+    def setUpClass( cls ):
+        cls.server = ThreadingHTTPServer( ( '127.0.0.1', 0 ), FakeMemberPress )
+        cls.thread = threading.Thread(
+            target = cls.server.serve_forever,
+            daemon = True,
+        )
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass( cls ):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp( self ):
+        FakeMemberPress.send_total = False
+        FakeMemberPress.past_end_status = None
+        FakeMemberPress.fail_pages = set()
+        FakeMemberPress.requested = []
+        host, port = self.server.server_address
+        self.client = Doorbot.MemberPress.MemberPressClient(
+            base_url = f'http://{host}:{port}',
+            user = 'user',
+            passwd = 'pass',
+            per_page = PER_PAGE,
+            max_workers = 3,
+            backoff_seconds = 0,
+        )
+
+    def tearDown( self ):
+        self.client.close()
+
+    def test_fetch_all_members( self ):
+        pages = []
+        members = self.client.fetch_all_members( progress = pages.append )
+        self.assertEqual( [ m[ 'id' ] for m in members ],
+            list( range( TOTAL_MEMBERS ) ), "All members, in order" )
+        # Pages past the end may be fetched along with the last one
+        self.assertLessEqual( { 1, 2, 3, 4, 5 }, set( pages ),
+            "Progress for each page" )
+
+    def test_fetch_with_total( self ):
+        FakeMemberPress.send_total = True
+        members = self.client.fetch_all_members()
+        self.assertEqual( [ m[ 'id' ] for m in members ],
+            list( range( TOTAL_MEMBERS ) ), "All members, in order" )
+        self.assertEqual( sorted( FakeMemberPress.requested ),
+            [ 1, 2, 3, 4, 5 ], "No pages past the end" )
+
+    def test_past_end_error( self ):
+        FakeMemberPress.past_end_status = 400
+        members = self.client.fetch_all_members()
+        self.assertEqual( [ m[ 'id' ] for m in members ],
+            list( range( TOTAL_MEMBERS ) ), "Errors past the end ignored" )
+
+        # No short page at all when the last one is exactly full
+        self.client.per_page = TOTAL_MEMBERS
+        members = self.client.fetch_all_members()
+        self.assertEqual( len( members ), TOTAL_MEMBERS,
+            "An error on the next page ends the list" )
+
+    def test_retry( self ):
+        FakeMemberPress.fail_pages = { 1, 3 }
+        members = self.client.fetch_all_members()
+        self.assertEqual( len( members ), TOTAL_MEMBERS )
+        self.assertEqual( FakeMemberPress.requested.count( 3 ), 2,
+            "Failed page fetched again" )
+
+    def test_give_up( self ):
+        self.client.max_retries = 0
+        FakeMemberPress.fail_pages = { 1 }
+        with self.assertRaises( Doorbot.MemberPress.MemberPressError ):
+            self.client.fetch_all_members()
@@ -0,0 +1,111 @@
+import unittest
+import os
+import Doorbot.Migrations
+import Doorbot.SQLAlchemy
+from sqlalchemy import inspect
+from sqlalchemy import text
+
+
+class TestMigrations( unittest.TestCase ):
+    @classmethod
+    def setUpClass( cls ):
+        if 'PG' != os.environ.get( 'DB' ):
+            Doorbot.SQLAlchemy.set_engine_sqlite()
+
+    def test_applied( self ):
+        engine = Doorbot.SQLAlchemy.get_engine()
+        self.assertEqual( Doorbot.Migrations.pending( engine ), [],
+            "Everything applied" )
+        self.assertEqual( Doorbot.Migrations.upgrade( engine ), [],
+            "Nothing to do the second time" )
+
+        with engine.begin() as conn:
+            versions = Doorbot.Migrations.applied_versions( conn )
+        self.assertEqual(
+            versions,
+            { m.version for m in Doorbot.Migrations.MIGRATIONS },
+            "Versions recorded",
+        )
+
+    def test_hot_path_indexes( self ):
+        inspector = inspect( Doorbot.SQLAlchemy.get_engine() )
+
+        def index_names( table ):
+            return { index[ "name" ] for index in inspector.get_indexes( table ) }
+
+        self.assertIn( "entry_log_rfid_time_id_idx",
+            index_names( "entry_log" ) )
+        self.assertIn( "entry_log_location_time_idx",
+            index_names( "entry_log" ) )
+        self.assertIn( "oauth_tokens_expiration_date_idx",
+            index_names( "oauth_tokens" ) )
+        self.assertIn( "members_active_rfid_idx", index_names( "members" ) )
+
+    def test_upgrade_in_order( self ):
+        engine = Doorbot.SQLAlchemy.get_engine()
+        ran = []
+
+        def make( version ):
+            def upgrade( conn ):
+                conn.execute( text( "SELECT 1" ) )
+                ran.append( version )
+            return upgrade
+
+        migrations = [
+            Doorbot.Migrations.Migration( 1002, "second", make( 1002 ) ),
+            Doorbot.Migrations.Migration( 1001, "first", make( 1001 ) ),
+        ]
+        done = Doorbot.Migrations.upgrade( engine, migrations )
+        self.assertEqual( [ m.version for m in done ], [ 1001, 1002 ],
+            "Applied in order of version" )
+        self.assertEqual( ran, [ 1001, 1002 ] )
+
+        def fail( conn ):
+            raise RuntimeError( "Broken migration" )
+
+        migrations.append(
+            Doorbot.Migrations.Migration( 1003, "broken", fail ) )
+        with self.assertRaises( RuntimeError ):
+            Doorbot.Migrations.upgrade( engine, migrations )
+        self.assertEqual(
+            [ m.version for m in
+                Doorbot.Migrations.pending( engine, migrations ) ],
+            [ 1003 ],
+            "Failed migration isn't recorded",
+        )
+        self.assertEqual( ran, [ 1001, 1002 ], "Earlier ones didn't run again" )
+
+    def test_upgrade_without_transaction( self ):
+        engine = Doorbot.SQLAlchemy.get_engine()
+
+        def upgrade( conn ):
+            Doorbot.Migrations.create_index( conn,
+                "entry_log_test_time_idx", "entry_log", "entry_time, id" )
+            Doorbot.Migrations.create_index( conn,
+                "members_test_name_idx", "members", "full_name" )
+
+        migrations = [
+            Doorbot.Migrations.Migration( 1101, "indexes", upgrade,
+                in_transaction = False ),
+        ]
+        done = Doorbot.Migrations.upgrade( engine, migrations )
+        self.assertEqual( [ m.version for m in done ], [ 1101 ] )
+        self.assertEqual( Doorbot.Migrations.upgrade( engine, migrations ),
+            [], "Recorded" )
+
+        inspector = inspect( engine )
+        names = {
+            index[ "name" ]
+            for table in ( "entry_log", "members" )
+            for index in inspector.get_indexes( table )
+        }
+        self.assertIn( "entry_log_test_time_idx", names )
+        self.assertIn( "members_test_name_idx", names )
+
+        with engine.begin() as conn:
+            conn.execute( text( "DROP INDEX entry_log_test_time_idx" ) )
+            conn.execute( text( "DROP INDEX members_test_name_idx" ) )
+
+
+if __name__ == '__main__':
+    unittest.main()
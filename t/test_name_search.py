@@ -0,0 +1,116 @@
+import unittest
+import flask_unittest
+import os
+import Doorbot.API
+import Doorbot.NameSearch
+import Doorbot.SQLAlchemy
+from flask import json
+from sqlalchemy.orm import Session
+from test_oauth_token import add_bearer_token, bearer_header
+
+
+TOKEN = "0123456789abcdef"
+
+
+class TestNameSearch( flask_unittest.ClientTestCase ):
+    app = Doorbot.API.app
+    app.config[ 'is_testing' ] = True
+
+    @classmethod
+    def setUpClass( cls ):
+        if 'PG' != os.environ.get( 'DB' ):
+            Doorbot.SQLAlchemy.set_engine_sqlite()
+
+        global engine
+        engine = Doorbot.SQLAlchemy.get_engine()
+
+        members = [
+            Doorbot.SQLAlchemy.Member(
+                full_name = "Robert Smith",
+                rfid = "1001",
+            ),
+            Doorbot.SQLAlchemy.Member(
+                full_name = "Roberta Smythe",
+                rfid = "1002",
+            ),
+            Doorbot.SQLAlchemy.Member(
+                full_name = "Alice Jones",
+                rfid = "1003",
+            ),
+        ]
+
+        session = Session( engine )
+        add_bearer_token( TOKEN, members[2], session )
+        session.add_all( members )
+        session.commit()
+        session.close()
+
+    def test_similarity( self, client ):
+        search = Doorbot.NameSearch
+
+        self.assertEqual(
+            search.trigrams( "Word" ),
+            { "  w", " wo", "wor", "ord", "rd " },
+            "Words are lowercased and padded",
+        )
+        self.assertAlmostEqual(
+            search.similarity( "word", "two words" ),
+            4 / 11,
+            msg = "Same as pg_trgm",
+        )
+        self.assertEqual( search.similarity( "Alice", "alice" ), 1.0 )
+        self.assertEqual( search.similarity( "", "alice" ), 0.0 )
+
+    def search( self, name, tag = None ):
+        session = Session( engine )
+        members = Doorbot.API.search_tag_list( name, tag, 0, 10,
+            session = session, fuzzy = True )
+        names = [ member.full_name for member in members ]
+        session.close()
+        return names
+
+    def test_ranked( self, client ):
+        self.assertEqual( self.search( "Robret Smith" ), [ "Robert Smith" ],
+            "Misspelled name found" )
+        self.assertEqual(
+            self.search( "Robert Smit" ),
+            [ "Robert Smith", "Roberta Smythe" ],
+            "Closest first",
+        )
+        self.assertEqual( self.search( "roberta smythe" )[0], "Roberta Smythe",
+            "Exact match comes first" )
+        self.assertIn( "Alice Jones", self.search( "lice" ),
+            "Partial names match" )
+        self.assertEqual( self.search( "Zzyzx" ), [], "Nothing alike" )
+        self.assertEqual( self.search( "Robert", "1002" ), [ "Roberta Smythe" ],
+            "Narrowed by tag" )
+
+    def test_new_member_found( self, client ):
+        self.assertEqual( self.search( "Quentin Blake" ), [] )
+
+        session = Session( engine )
+        session.add( Doorbot.SQLAlchemy.Member(
+            full_name = "Quentin Blake",
+            rfid = "1004",
+        ) )
+        session.commit()
+        session.close()
+
+        self.assertEqual( self.search( "Quentin Blake" ), [ "Quentin Blake" ],
+            "Index picked up the new member" )
+
+    def test_search_tags_fuzzy( self, client ):
+        rv = client.get(
+            '/v1/search_tags?name=Smyth&match=fuzzy&format=ndjson',
+            headers = bearer_header( TOKEN ),
+        )
+        self.assertStatus( rv, 200 )
+        rows = [
+            json.loads( line )
+            for line in rv.get_data( as_text = True ).splitlines()
+        ]
+        self.assertEqual( rows[0][ "full_name" ], "Roberta Smythe" )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,9 +5,11 @@ import os
 import re
 import sqlite3
 import Doorbot.API
+import Doorbot.AuthCache
 import Doorbot.Config
 import Doorbot.SQLAlchemy
 from datetime import timedelta, datetime
+from sqlalchemy import event
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 
@@ -15,17 +17,23 @@ from sqlalchemy.orm import Session
 RFID_FOO = "1234"
 TOKEN_GOOD = "0123456789abcdef"
 TOKEN_WRONG = "fedcba9876543210"
+TOKEN_EXPIRED = "00112233445566778899"
+TOKEN_LATE = "99887766554433221100"
 
 
-def add_bearer_token( token_str, member, session ):
+def add_bearer_token(
+    token_str,
+    member,
+    session,
+    expires_delta = timedelta( weeks = 1 ),
+):
     now = datetime.now()
-    week_delta = timedelta( weeks = 1 )
-    week_later = now + week_delta
+    expires = now + expires_delta
 
     token = Doorbot.SQLAlchemy.OauthToken(
         name = "foo_oauth",
         token = token_str,
-        expiration_date = week_later,
+        expiration_date = expires,
         member = member
     )
 
@@ -55,6 +63,8 @@ class TestOauthToken( flask_unittest.ClientTestCase ):
             rfid = RFID_FOO,
         )
         add_bearer_token( TOKEN_GOOD, member, session )
+        add_bearer_token( TOKEN_EXPIRED, member, session,
+            expires_delta = timedelta( days = -1 ) )
 
         session.add( member )
         session.commit()
@@ -71,3 +81,57 @@ class TestOauthToken( flask_unittest.ClientTestCase ):
             headers = bearer_header( TOKEN_WRONG ),
         )
         self.assertStatus( rv, 401 )
+
+    def test_oauth_expired( self, client ):
+        rv = client.post( '/v1/deactivate_tag/' + RFID_FOO,
+            headers = bearer_header( TOKEN_EXPIRED ),
+        )
+        self.assertStatus( rv, 401 )
+
+    def test_oauth_cached( self, client ):
+        rv = client.post( '/v1/deactivate_tag/' + RFID_FOO,
+            headers = bearer_header( TOKEN_GOOD ),
+        )
+        self.assertStatus( rv, 200 )
+
+        cache = Doorbot.AuthCache.get_token_cache()
+        key = Doorbot.AuthCache.token_digest( TOKEN_GOOD )
+        self.assertIsNotNone( cache.get( key ), "Token was cached" )
+        self.assertIsNone( cache.get( TOKEN_GOOD ),
+            "Token is not cached by plaintext" )
+
+    def test_oauth_new_token_clears_negative_cache( self, client ):
+        rv = client.post( '/v1/deactivate_tag/' + RFID_FOO,
+            headers = bearer_header( TOKEN_LATE ),
+        )
+        self.assertStatus( rv, 401 )
+
+        session = Session( engine )
+        member = Doorbot.SQLAlchemy.Member.get_by_tag( RFID_FOO, session )
+        add_bearer_token( TOKEN_LATE, member, session )
+        session.commit()
+        session.close()
+
+        rv = client.post( '/v1/deactivate_tag/' + RFID_FOO,
+            headers = bearer_header( TOKEN_LATE ),
+        )
+        self.assertStatus( rv, 200 )
+
+    def test_oauth_revoked_during_lookup( self, client ):
+        cache = Doorbot.AuthCache.get_token_cache()
+        key = Doorbot.AuthCache.token_digest( TOKEN_GOOD )
+        cache.discard( key )
+
+        # Revoked by someone else after the lookup started
+        session = Session( engine )
+        event.listen( session, "do_orm_execute",
+            lambda state: Doorbot.AuthCache.invalidate_token( TOKEN_GOOD ) )
+        member_id = Doorbot.AuthCache.verify_token( TOKEN_GOOD, session )
+        session.close()
+
+        self.assertIsNotNone( member_id, "Found before it was revoked" )
+        self.assertIsNone( cache.get( key ), "Not cached after revoking" )
+
+        self.assertIsNotNone(
+            Doorbot.AuthCache.verify_token( TOKEN_GOOD ) )
+        self.assertIsNotNone( cache.get( key ), "Cached once nothing moved" )
@@ -0,0 +1,99 @@
+import unittest
+import flask_unittest
+import os
+import Doorbot.API
+import Doorbot.QueryCheck
+import Doorbot.SQLAlchemy
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from test_oauth_token import add_bearer_token, bearer_header
+
+
+TOKEN = "0123456789abcdef"
+USER_PASS = ( "query_check", "query_check" )
+
+
+@unittest.skipIf( 'PG' == os.environ.get( 'DB' ),
+    "PostgreSQL plans depend on table size" )
+class TestQueryCheck( flask_unittest.ClientTestCase ):
+    app = Doorbot.API.app
+    app.config[ 'is_testing' ] = True
+
+    @classmethod
+    def setUpClass( cls ):
+        Doorbot.SQLAlchemy.set_engine_sqlite()
+
+        global engine
+        engine = Doorbot.SQLAlchemy.get_engine()
+
+        member = Doorbot.SQLAlchemy.Member(
+            full_name = "Query, Check",
+            rfid = "1234",
+            username = USER_PASS[0],
+        )
+        member.set_password( USER_PASS[1], {
+            "type": "plaintext",
+        })
+        location = Doorbot.SQLAlchemy.Location( name = "front.door" )
+
+        session = Session( engine )
+        add_bearer_token( TOKEN, member, session )
+        session.add_all([ member, location ])
+        session.commit()
+        session.close()
+
+        Doorbot.QueryCheck.enable()
+
+    @classmethod
+    def tearDownClass( cls ):
+        Doorbot.QueryCheck.disable()
+        Doorbot.QueryCheck.clear()
+
+    def setUp( self, client ):
+        Doorbot.QueryCheck.clear()
+
+    def test_hot_paths_use_indexes( self, client ):
+        urls = [
+            '/check_tag/1234',
+            '/entry/1234/front.door',
+            '/v1/search_entry_log?tag=1234',
+            '/v1/search_entry_log?name=Check',
+            '/v1/search_entry_log?limit=1',
+            '/v1/export_entry_log?from=2023-01-01&to=2023-02-01'
+                '&location=front.door',
+            '/v1/scan_stats?from=2023-01-01&to=2023-02-01',
+            '/secure/dump_active_tags',
+            '/v1/acl_changes?since=1&timeout=0',
+        ]
+        for url in urls:
+            # Some take a password and some take a token
+            statuses = set()
+            for kwargs in (
+                { "auth": USER_PASS },
+                { "headers": bearer_header( TOKEN ) },
+            ):
+                rv = client.get( url, **kwargs )
+                rv.get_data()
+                statuses.add( rv.status_code )
+            self.assertIn( 200, statuses, url )
+
+        self.assertEqual( Doorbot.QueryCheck.findings(), [],
+            "No full scans" )
+
+    def test_reports_full_scan( self, client ):
+        session = Session( engine )
+        session.execute(
+            select( Doorbot.SQLAlchemy.EntryLog ).where(
+                Doorbot.SQLAlchemy.EntryLog.is_found_tag == False
+            )
+        ).all()
+        session.close()
+
+        findings = Doorbot.QueryCheck.findings()
+        self.assertEqual( [ f.table for f in findings ], [ "entry_log" ],
+            "Reported scan of unindexed column" )
+        self.assertIn( "is_found_tag", findings[0].statement )
+
+
+if __name__ == '__main__':
+    unittest.main()
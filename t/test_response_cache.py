@@ -0,0 +1,96 @@
+import unittest
+import gzip
+import os
+import threading
+import time
+import Doorbot.ResponseCache
+import Doorbot.SQLAlchemy
+
+
+def make_entry( body ):
+    return Doorbot.ResponseCache.CachedResponse(
+        body = body,
+        gzip_body = gzip.compress( body ),
+        content_type = 'application/json',
+        etag = None,
+    )
+
+
+class TestResponseCache( unittest.TestCase ):
+    @classmethod
+    def setUpClass( cls ):
+        if 'PG' != os.environ.get( 'DB' ):
+            Doorbot.SQLAlchemy.set_engine_sqlite()
+
+    def test_get_or_build( self ):
+        cache = Doorbot.ResponseCache.ResponseCache()
+        builds = []
+
+        def build():
+            builds.append( 1 )
+            return make_entry( b"{}" )
+
+        self.assertEqual( cache.get_or_build( "key", build ).body, b"{}" )
+        self.assertEqual( cache.get_or_build( "key", build ).body, b"{}" )
+        self.assertEqual( len( builds ), 1, "Built once" )
+
+        self.assertIsNone( cache.get_or_build( "none", lambda: None ) )
+        self.assertIsNone( cache.get( "none" ), "None isn't cached" )
+
+        cache.invalidate()
+        self.assertIsNone( cache.get( "key" ), "Invalidated" )
+
+    def test_max_age( self ):
+        cache = Doorbot.ResponseCache.ResponseCache( max_age_seconds = 0.05 )
+        cache.get_or_build( "key", lambda: make_entry( b"{}" ) )
+        self.assertIsNotNone( cache.get( "key" ) )
+        time.sleep( 0.1 )
+        self.assertIsNone( cache.get( "key" ), "Expired" )
+
+    def test_max_size( self ):
+        cache = Doorbot.ResponseCache.ResponseCache( max_size = 2 )
+        for key in ( "a", "b", "c" ):
+            cache.get_or_build( key, lambda: make_entry( b"{}" ) )
+        self.assertEqual( len( cache ), 2 )
+        self.assertIsNone( cache.get( "a" ), "Oldest dropped" )
+
+    def test_single_build( self ):
+        cache = Doorbot.ResponseCache.ResponseCache()
+        builds = []
+
+        def build():
+            builds.append( 1 )
+            time.sleep( 0.05 )
+            return make_entry( b"{}" )
+
+        results = []
+        threads = [
+            threading.Thread(
+                target = lambda: results.append(
+                    cache.get_or_build( "key", build ) )
+            )
+            for _ in range( 10 )
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual( len( results ), 10 )
+        self.assertEqual( len( builds ), 1,
+            "Only one request built it while the others waited" )
+
+    def test_invalidate_while_building( self ):
+        cache = Doorbot.ResponseCache.ResponseCache()
+
+        def build():
+            cache.invalidate()
+            return make_entry( b"stale" )
+
+        self.assertEqual( cache.get_or_build( "key", build ).body, b"stale",
+            "Builder still gets its response" )
+        self.assertIsNone( cache.get( "key" ), "But it isn't kept" )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import unittest
+import flask_unittest
+import os
+import Doorbot.Config
+import Doorbot.API
+import Doorbot.EntryLogWriter
+import Doorbot.ScanStats
+import Doorbot.SQLAlchemy
+from datetime import datetime, timezone
+from flask import json
+from sqlalchemy.orm import Session
+from test_oauth_token import add_bearer_token, bearer_header
+
+
+TOKEN = "0123456789abcdef"
+HOUR = datetime( 2023, 5, 1, 14, 0, 0, tzinfo = timezone.utc )
+SCANS = [
+    # rfid, minute, active, found
+    ( "1234", 5, True, True ),
+    ( "1234", 10, True, True ),
+    ( "2345", 20, False, True ),
+    ( "9999", 30, False, False ),
+]
+
+
+class TestScanStats( flask_unittest.ClientTestCase ):
+    app = Doorbot.API.app
+    app.config[ 'is_testing' ] = True
+
+    @classmethod
+    def setUpClass( cls ):
+        if 'PG' != os.environ.get( 'DB' ):
+            Doorbot.SQLAlchemy.set_engine_sqlite()
+
+        global engine
+        engine = Doorbot.SQLAlchemy.get_engine()
+
+        woodshop = Doorbot.SQLAlchemy.Location( name = "woodshop.door" )
+        member = Doorbot.SQLAlchemy.Member(
+            full_name = "Foo",
+            rfid = "1234",
+        )
+        session = Session( engine )
+        add_bearer_token( TOKEN, member, session )
+        session.add_all([ woodshop, member ])
+        session.commit()
+
+        global woodshop_id
+        woodshop_id = woodshop.id
+        session.close()
+
+        writer = Doorbot.EntryLogWriter.EntryLogWriter( write_behind = False )
+        for rfid, minute, is_active, is_found in SCANS:
+            writer.log(
+                rfid,
+                woodshop_id,
+                is_active,
+                is_found,
+                entry_time = HOUR.replace( minute = minute ),
+            )
+        # One in the next hour by a tag already seen
+        writer.log( "1234", woodshop_id, True, True,
+            entry_time = HOUR.replace( hour = 15 ) )
+
+    def assert_rollups( self ):
+        session = Session( engine )
+        end = HOUR.replace( hour = 16 )
+        rows = Doorbot.ScanStats.hourly( session, HOUR, end )
+        totals = Doorbot.ScanStats.totals( session, HOUR, end )
+        session.close()
+
+        self.assertEqual( len( rows ), 2, "One row per hour" )
+        self.assertEqual( rows[0].location, "woodshop.door" )
+        self.assertEqual(
+            ( rows[0].total_scans, rows[0].active_scans,
+                rows[0].found_scans, rows[0].unique_tags ),
+            ( 4, 2, 3, 3 ),
+            "Counts for first hour",
+        )
+        self.assertEqual( totals, {
+            "woodshop.door": {
+                "total_scans": 5,
+                "active_scans": 3,
+                "found_scans": 4,
+                "unique_tags": 3,
+            },
+        }, "Unique tags counted over the whole range" )
+
+    def test_rollups( self, client ):
+        self.assert_rollups()
+
+    def test_rebuild( self, client ):
+        Doorbot.ScanStats.rebuild( HOUR, HOUR.replace( hour = 16 ) )
+        self.assert_rollups()
+
+    def test_api( self, client ):
+        rv = client.get( '/v1/scan_stats?from=2023-05-01&to=2023-05-02'
+            + '&location=woodshop.door',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 200 )
+        data = json.loads( rv.data.decode( "UTF-8" ) )
+        self.assertEqual( data[ "totals" ][ "woodshop.door" ][ "total_scans" ],
+            5 )
+        self.assertEqual( [ hour[ "hour" ] for hour in data[ "hours" ] ], [
+            "2023-05-01T14:00:00+00:00",
+            "2023-05-01T15:00:00+00:00",
+        ], "Hours in order" )
+
+        rv = client.get( '/v1/scan_stats?location=no.such.door',
+            headers = bearer_header( TOKEN )
+        )
+        self.assertStatus( rv, 404 )